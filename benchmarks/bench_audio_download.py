@@ -0,0 +1,78 @@
+"""
+Compare the old 2048-byte read loop into a BytesIO with the preallocated readinto path
+used by S3SERVICE.get_audio_buffer, for typical 16 kHz mono s16 WAV chunk sizes.
+
+Runs without AWS: the S3 body is simulated by an in-memory stream that exposes the same
+read(amt) / _raw_stream.readinto surface as botocore's StreamingBody.
+
+    python benchmarks/bench_audio_download.py
+"""
+import io
+import os
+import sys
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.stream_io import BufferReader, read_into_buffer  # noqa: E402
+
+SAMPLE_RATE = 16000
+CHUNK_SECONDS = [2, 5, 30]
+REPEATS = 200
+
+
+class FakeStreamingBody:
+    def __init__(self, data: bytes):
+        self._raw_stream = io.BufferedReader(io.BytesIO(data))
+
+    def read(self, amt=None):
+        return self._raw_stream.read(amt)
+
+
+def make_wav(seconds: int) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(os.urandom(SAMPLE_RATE * 2 * seconds))
+    return buffer.getvalue()
+
+
+def read_loop(data: bytes):
+    audio_stream = io.BytesIO()
+    stream = FakeStreamingBody(data)
+    while True:
+        chunk = stream.read(2048)
+        if not chunk:
+            break
+        audio_stream.write(chunk)
+    audio_stream.seek(0)
+    return audio_stream
+
+
+def read_preallocated(data: bytes):
+    return BufferReader(read_into_buffer(FakeStreamingBody(data), len(data)))
+
+
+def bench(fn, data: bytes):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        fn(data)
+    elapsed = time.perf_counter() - start
+    return elapsed / REPEATS, (len(data) * REPEATS) / elapsed / (1024 * 1024)
+
+
+def main():
+    print(f"{'chunk':>6} {'bytes':>9} {'loop ms':>9} {'loop MB/s':>10} {'prealloc ms':>12} {'prealloc MB/s':>14}")
+    for seconds in CHUNK_SECONDS:
+        data = make_wav(seconds)
+        loop_time, loop_rate = bench(read_loop, data)
+        pre_time, pre_rate = bench(read_preallocated, data)
+        print(f"{seconds:>5}s {len(data):>9} {loop_time * 1000:>9.3f} {loop_rate:>10.1f} "
+              f"{pre_time * 1000:>12.3f} {pre_rate:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Publish/consume throughput of the in-process message bus (MESSAGE_BUS=memory|sqlite), with
+executor-sized JSON messages keyed by conversation, consumed through ConsumerRuntime with
+offset commits as the executors do. No broker or network is involved.
+
+    python benchmarks/bench_message_bus.py
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.kafka.consumer_runtime import ConsumerRuntime  # noqa: E402
+from services.kafka.message_bus import InMemoryLog, MessageBus, SQLiteLog  # noqa: E402
+
+MESSAGES = 20000
+CONVERSATIONS = 50
+TOPIC = "executor.asr"
+
+
+class BusService:
+    """Just enough of KafkaService for ConsumerRuntime."""
+
+    def __init__(self, bus, group_id):
+        self.group_id = group_id
+        self.topics = [TOPIC]
+        self.max_poll_records = 500
+        self.post_consumer = bus.consumer(TOPIC, group_id=group_id, max_poll_records=500)
+
+    def flush(self, timeout=None):
+        pass
+
+
+def message(n):
+    return {
+        "es_id": f"conv{n % CONVERSATIONS}_ASR_EXECUTOR",
+        "chunk_no": n // CONVERSATIONS,
+        "file_path": f"conv{n % CONVERSATIONS}/conv{n % CONVERSATIONS}_chunk{n // CONVERSATIONS}.wav",
+        "state": "SpeechToText",
+        "care_req_id": f"conv{n % CONVERSATIONS}",
+        "completed": False,
+        "start_time": "2024-01-01 00:00:00",
+    }
+
+
+def bench(name, bus):
+    producer = bus.producer(key_serializer=lambda x: x.encode('utf-8'),
+                            value_serializer=lambda x: json.dumps(x).encode('utf-8'))
+    start = time.perf_counter()
+    for n in range(MESSAGES):
+        data = message(n)
+        producer.send(TOPIC, key=data["care_req_id"], value=data)
+    publish_time = time.perf_counter() - start
+
+    handled = []
+    runtime = ConsumerRuntime(BusService(bus, "bench"), lambda message_dict, record: handled.append(1),
+                              commit_interval_ms=100)
+    start = time.perf_counter()
+    while len(handled) < MESSAGES:
+        runtime.poll_once()
+    runtime.commit()
+    consume_time = time.perf_counter() - start
+    print(f"{name:>7} publish {MESSAGES / publish_time:>10.0f} msg/s   consume {MESSAGES / consume_time:>10.0f} msg/s")
+
+
+def main():
+    bench("memory", MessageBus(InMemoryLog()))
+    with tempfile.TemporaryDirectory() as directory:
+        bench("sqlite", MessageBus(SQLiteLog(os.path.join(directory, "bus.sqlite3"))))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,53 @@
-import json
 import multiprocessing
-import traceback
 from datetime import datetime
 from executors.worker.ai_preds_executor import aiPreds
+from services.kafka.consumer_runtime import ConsumerRuntime, latest_chunk
+from services.kafka.debouncer import ConversationDebouncer
 from services.kafka.kafka_service import KafkaService
+from services.kafka.async_host import AsyncExecutorHost
+from services.kafka.keyed_executor import KeyedExecutor
+from services.kafka.lanes import LaneExecutor, highest_lane
 from config.logconfig import get_logger
 from utils import heconstants
-from concurrent.futures import ThreadPoolExecutor
 
 logger = get_logger()
 num_of_workers = lambda: (multiprocessing.cpu_count() * 2) + 1
-executor = ThreadPoolExecutor(max_workers=num_of_workers())
-kafka_service = KafkaService(group_id="aipreds")
-kafka_client = kafka_service.create_clients(group_id="aipreds")
+use_asyncio = heconstants.executor_runtime == "asyncio"
+# Live chunks are picked ahead of retries and backfill, by weight
+executor = AsyncExecutorHost() if use_asyncio else KeyedExecutor(LaneExecutor(max_workers=num_of_workers()))
+# Runs queued behind a newer chunk of the same conversation are skipped
+debouncer = ConversationDebouncer(stage="aipreds")
 
 
 class Executor:
     def __init__(self):
         pass
 
+    def dispatch_batch(self, groups):
+        results = {}
+        for (state, stream_key), items in groups.items():
+            items = [item for item in items if not item.message.get("completed")]
+            if state != "AiPred" or not items:
+                continue
+            # Each run re-reads every chunk of the conversation, so one run per conversation
+            # for the newest chunk in the batch covers the others
+            message_dict = latest_chunk(items)
+            lane = highest_lane(item.message for item in items)
+            start_time = datetime.utcnow()
+            aipreds = aiPreds()
+            file_path = message_dict.get("file_path")
+            logger.info(f"Starting AIPRED :: {stream_key} :: {file_path} :: {len(items)} messages")
+            execute = aipreds.execute_function_async if use_asyncio else aipreds.execute_function
+            results[(state, stream_key)] = debouncer.submit(executor, stream_key, message_dict.get("chunk_no"),
+                                                            execute, message_dict, start_time, lane=lane)
+        return results
+
+    def runtime(self):
+        # Offsets are committed once the submitted work finishes
+        return ConsumerRuntime(KafkaService(group_id="aipreds"), batch_handler=self.dispatch_batch, executor=executor)
+
     def executor_task(self):
-        try:
-            while True:
-                kafka_service.post_poll()
-                for consumer in kafka_service.post_consumer:
-                    if consumer.value.decode('utf-8') != '':
-                        if consumer.topic == heconstants.EXECUTOR_TOPIC:
-                            message_to_pass = consumer.value.decode('utf-8')
-                            # kafka_client.commit()
-                            start_time = datetime.utcnow()
-                            message_dict = json.loads(message_to_pass)
-                            if message_dict.get("state") == "AiPred" and not message_dict.get("completed"):
-                                aipreds = aiPreds()
-                                stream_key = message_dict.get("care_req_id")
-                                file_path = message_dict.get("file_path")
-                                logger.info(f"Starting AIPRED :: {stream_key} :: {file_path}")
-                                executor.submit(aipreds.execute_function, message_dict, start_time)
-
-        except Exception as exc:
-            msg = "post message polling failed :: {}".format(exc)
-            logger.error(msg)
-            trace = traceback.format_exc()
-            return msg, 500
+        self.runtime().run()
 
 
 if __name__ == "__main__":
@@ -1,48 +1,47 @@
-import json
-import logging
-import multiprocessing
-import traceback
-from datetime import datetime
-from services.kafka.kafka_service import KafkaService
-from utils import heconstants
-from concurrent.futures import ThreadPoolExecutor
-from executors.worker.asr_executor import ASRExecutor
-from config.logconfig import get_logger
+from utils.audio_pool import start_audio_pool
+
+# Fork the audio decode workers before anything below starts a thread
+start_audio_pool()
+
+import logging  # noqa: E402
+import multiprocessing  # noqa: E402
+from datetime import datetime  # noqa: E402
+from services.kafka.consumer_runtime import ConsumerRuntime  # noqa: E402
+from services.kafka.kafka_service import KafkaService  # noqa: E402
+from services.kafka.async_host import AsyncExecutorHost  # noqa: E402
+from services.kafka.keyed_executor import KeyedExecutor  # noqa: E402
+from services.kafka.lanes import LaneExecutor, message_lane  # noqa: E402
+from executors.worker.asr_executor import ASRExecutor  # noqa: E402
+from config.logconfig import get_logger  # noqa: E402
+from utils import heconstants  # noqa: E402
 
 logger = get_logger()
 num_of_workers = lambda: (multiprocessing.cpu_count() * 2) + 1
-executor = ThreadPoolExecutor(max_workers=num_of_workers())
-kafka_service = KafkaService(group_id="asr")
-kafka_client = kafka_service.create_clients(group_id="asr")
+use_asyncio = heconstants.executor_runtime == "asyncio"
+# Live chunks are picked ahead of retries and backfill, by weight
+executor = AsyncExecutorHost() if use_asyncio else KeyedExecutor(LaneExecutor(max_workers=num_of_workers()))
 
 
 class Executor:
     def __init__(self):
         pass
 
+    def dispatch(self, message_dict, record):
+        if message_dict.get("state") == "SpeechToText" and not message_dict.get("completed"):
+            start_time = datetime.utcnow()
+            asrexecutor = ASRExecutor()
+            stream_key = message_dict.get("care_req_id")
+            file_path = message_dict.get("file_path")
+            logger.info(f"Starting ASR  :: {stream_key} :: {file_path}")
+            execute = asrexecutor.execute_function_async if use_asyncio else asrexecutor.execute_function
+            return executor.submit_lane(message_lane(message_dict), stream_key, execute, message_dict, start_time)
+
+    def runtime(self):
+        # Offsets are committed once the submitted work finishes
+        return ConsumerRuntime(KafkaService(group_id="asr"), self.dispatch, executor=executor)
+
     def executor_task(self):
-        try:
-            while True:
-                kafka_service.post_poll()
-                for consumer in kafka_service.post_consumer:
-                    if consumer.value.decode('utf-8') != '':
-                        if consumer.topic == heconstants.EXECUTOR_TOPIC:
-                            message_to_pass = consumer.value.decode('utf-8')
-                            # kafka_client.commit()
-                            start_time = datetime.utcnow()
-                            message_dict = json.loads(message_to_pass)
-                            if message_dict.get("state") == "SpeechToText" and not message_dict.get("completed"):
-                                asrexecutor = ASRExecutor()
-                                stream_key = message_dict.get("care_req_id")
-                                file_path = message_dict.get("file_path")
-                                logger.info(f"Starting ASR  :: {stream_key} :: {file_path}")
-                                executor.submit(asrexecutor.execute_function, message_dict, start_time)
-
-        except Exception as exc:
-            msg = "post message polling failed :: {}".format(exc)
-            logger.error(msg)
-            trace = traceback.format_exc()
-            return msg, 500
+        self.runtime().run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import multiprocessing
+from datetime import datetime
+from executors.worker.compaction_executor import conversationCompactor
+from services.kafka.consumer_runtime import ConsumerRuntime
+from services.kafka.kafka_service import KafkaService
+from services.kafka.keyed_executor import KeyedExecutor
+from services.kafka.lanes import LaneExecutor, message_lane
+from config.logconfig import get_logger
+
+logger = get_logger()
+num_of_workers = lambda: (multiprocessing.cpu_count() * 2) + 1
+# Live chunks are picked ahead of retries and backfill, by weight
+executor = KeyedExecutor(LaneExecutor(max_workers=num_of_workers()))
+
+
+class Executor:
+    def __init__(self):
+        pass
+
+    def dispatch(self, message_dict, record):
+        if message_dict.get("state") == "Completed" and message_dict.get("completed"):
+            start_time = datetime.utcnow()
+            compactor = conversationCompactor()
+            stream_key = message_dict.get("care_req_id")
+            logger.info(f"Starting COMPACTION :: {stream_key}")
+            return executor.submit_lane(message_lane(message_dict), stream_key, compactor.execute_function,
+                                        message_dict, start_time)
+
+    def runtime(self):
+        # Offsets are committed once the submitted work finishes
+        return ConsumerRuntime(KafkaService(group_id="compaction"), self.dispatch, executor=executor)
+
+    def executor_task(self):
+        self.runtime().run()
+
+
+if __name__ == "__main__":
+    ExecutorInstance = Executor()
+    ExecutorInstance.executor_task()
@@ -1,47 +1,40 @@
-import json
 import multiprocessing
-import traceback
 from datetime import datetime
+from typing import Optional
+from services.kafka.consumer_runtime import ConsumerRuntime
 from services.kafka.kafka_service import KafkaService
+from services.kafka.keyed_executor import KeyedExecutor
+from services.kafka.lanes import LaneExecutor, message_lane
 from config.logconfig import get_logger
-from utils import heconstants
-from concurrent.futures import ThreadPoolExecutor
 from executors.worker.file_downloader_executor import fileDownloader
 
 logger = get_logger()
 num_of_workers = lambda: (multiprocessing.cpu_count() * 2) + 1
-executor = ThreadPoolExecutor(max_workers=num_of_workers())
-kafka_service = KafkaService(group_id="filedownloader")
-kafka_client = kafka_service.create_clients(group_id="filedownloader")
+# Live chunks are picked ahead of retries and backfill, by weight
+executor = KeyedExecutor(LaneExecutor(max_workers=num_of_workers()))
 
 
 class Executor:
     def __init__(self):
         pass
 
+    def dispatch(self, message_dict, record):
+        if message_dict.get("state") == "Init":
+            start_time = datetime.utcnow()
+            stream_key = message_dict.get("care_req_id")
+            user_type = message_dict.get("user_type")
+            filedownloader = fileDownloader()
+            logger.info(f"Starting Downloading File :: {stream_key}")
+            return executor.submit_lane(message_lane(message_dict), stream_key, filedownloader.save_rtmp_loop,
+                                        stream_key, user_type, start_time)
+
+    def runtime(self, kafka_service: Optional[KafkaService] = None):
+        # Offsets are committed once the submitted work finishes
+        kafka_service = kafka_service or KafkaService(group_id="filedownloader")
+        return ConsumerRuntime(kafka_service, self.dispatch, executor=executor)
+
     def executor_task(self):
-        try:
-            while True:
-                kafka_service.post_poll()
-                for consumer in kafka_service.post_consumer:
-                    if consumer.value.decode('utf-8') != '':
-                        if consumer.topic == heconstants.EXECUTOR_TOPIC:
-                            message_to_pass = consumer.value.decode('utf-8')
-                            # kafka_client.commit()
-                            start_time = datetime.utcnow()
-                            message_dict = json.loads(message_to_pass)
-                            if message_dict.get("state") == "Init":
-                                stream_key = message_dict.get("care_req_id")
-                                user_type = message_dict.get("user_type")
-                                filedownloader = fileDownloader()
-                                logger.info(f"Starting Downloading File :: {stream_key}")
-                                executor.submit(filedownloader.save_rtmp_loop, stream_key, user_type, start_time)
-
-        except Exception as exc:
-            msg = "post message polling failed :: {}".format(exc)
-            logger.error(msg)
-            trace = traceback.format_exc()
-            return msg, 500
+        self.runtime().run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,70 @@
+import signal
+import threading
+
+from utils import heconstants
+
+# Every stage runs in this process. Messages between stages go over the in-process bus, and
+# chunk audio, transcripts and manifests are read back from the memory tier of the storage
+# backend, which persists them to the configured STORAGE_BACKEND in the background.
+if heconstants.message_bus == "kafka":
+    heconstants.message_bus = "memory"
+if heconstants.storage_backend != "tiered":
+    heconstants.tiered_durable_backend = heconstants.storage_backend
+    heconstants.storage_backend = "tiered"
+
+from utils.audio_pool import start_audio_pool  # noqa: E402
+
+# Fork the audio decode workers before the stage executors start their threads
+start_audio_pool()
+
+from config.logconfig import get_logger  # noqa: E402
+from executors import ai_preds_executor, asr_executor, compaction_executor, file_downloader_executor, \
+    retry_executor, soap_executor  # noqa: E402
+from services.kafka.kafka_service import KafkaService  # noqa: E402
+from utils.metrics import start_metrics_server  # noqa: E402
+from utils.s3_operation import flush_all_writes  # noqa: E402
+
+logger = get_logger()
+
+
+class Executor:
+    def __init__(self):
+        pass
+
+    def runtimes(self):
+        # New streams still arrive from the websocket server on PIPELINE_INGRESS_BUS
+        ingress = KafkaService(group_id="filedownloader", message_bus=heconstants.pipeline_ingress_bus)
+        return [
+            file_downloader_executor.Executor().runtime(ingress),
+            asr_executor.Executor().runtime(),
+            ai_preds_executor.Executor().runtime(),
+            soap_executor.Executor().runtime(),
+            compaction_executor.Executor().runtime(),
+            retry_executor.Executor().runtime(),
+        ]
+
+    def executor_task(self):
+        runtimes = self.runtimes()
+        stopping = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: stopping.set())
+        start_metrics_server(heconstants.metrics_port)
+        threads = [threading.Thread(target=runtime.run, name=f"pipeline-{runtime.stage}", daemon=True)
+                   for runtime in runtimes]
+        for thread in threads:
+            thread.start()
+        logger.info(f"Pipeline started :: {', '.join(runtime.stage for runtime in runtimes)}")
+        while not stopping.wait(1):
+            pass
+        logger.info("Pipeline stopping")
+        for runtime in runtimes:
+            runtime.stop()
+        for thread in threads:
+            thread.join()
+        # Stage work still queued in memory is lost unless MESSAGE_BUS=sqlite; stored data is not
+        flush_all_writes()
+
+
+if __name__ == "__main__":
+    ExecutorInstance = Executor()
+    ExecutorInstance.executor_task()
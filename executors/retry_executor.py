@@ -0,0 +1,31 @@
+from services.kafka.consumer_runtime import ConsumerRuntime
+from services.kafka.kafka_service import KafkaService, RETRY_GROUP
+from services.kafka.retry import DelayScheduler, republish
+from config.logconfig import get_logger
+
+logger = get_logger()
+scheduler = DelayScheduler()
+producer = KafkaService()
+
+
+class Executor:
+    def __init__(self):
+        pass
+
+    def dispatch(self, message_dict, record):
+        # The offset stays uncommitted until the retry is back on its stage topic
+        stream_key = message_dict.get("care_req_id")
+        logger.info(f"Holding RETRY :: {record.topic} :: {stream_key} :: {message_dict.get('state')} :: "
+                    f"attempt {message_dict.get('retry_count')}")
+        return scheduler.schedule(message_dict.get("retry_due_at") or 0, republish, producer, message_dict)
+
+    def runtime(self):
+        return ConsumerRuntime(KafkaService(group_id=RETRY_GROUP), self.dispatch, executor=scheduler)
+
+    def executor_task(self):
+        self.runtime().run()
+
+
+if __name__ == "__main__":
+    ExecutorInstance = Executor()
+    ExecutorInstance.executor_task()
@@ -1,57 +1,58 @@
-import json
 import multiprocessing
-import traceback
 from datetime import datetime
-from executors.worker.soap_executor import soap
+from executors.worker.soap_executor import SUMMARIES, soap
+from services.kafka.consumer_runtime import ConsumerRuntime, latest_chunk
+from services.kafka.debouncer import ConversationDebouncer
 from services.kafka.kafka_service import KafkaService
+from services.kafka.async_host import AsyncExecutorHost
+from services.kafka.keyed_executor import KeyedExecutor
+from services.kafka.lanes import LaneExecutor, highest_lane
 from config.logconfig import get_logger
 from utils import heconstants
-from concurrent.futures import ThreadPoolExecutor
 
 logger = get_logger()
 num_of_workers = lambda: (multiprocessing.cpu_count() * 2) + 1
-executor = ThreadPoolExecutor(max_workers=num_of_workers())
-kafka_service = KafkaService(group_id="soap")
-kafka_client = kafka_service.create_clients(group_id="soap")
+use_asyncio = heconstants.executor_runtime == "asyncio"
+# Live chunks are picked ahead of retries and backfill, by weight
+executor = AsyncExecutorHost() if use_asyncio else KeyedExecutor(LaneExecutor(max_workers=num_of_workers()))
+# Summaries queued behind a newer chunk of the same conversation are skipped
+debouncer = ConversationDebouncer(stage="soap")
 
 
 class Executor:
     def __init__(self):
         pass
 
+    def dispatch_batch(self, groups):
+        results = {}
+        for (state, stream_key), items in groups.items():
+            items = [item for item in items if not item.message.get("completed")]
+            if state != "Analytics" or not items:
+                continue
+            # Summaries are rebuilt from the whole conversation, so one run per batch is enough
+            message_dict = latest_chunk(items)
+            lane = highest_lane(item.message for item in items)
+            start_time = datetime.utcnow()
+            summary = soap()
+            file_path = message_dict.get("file_path")
+            logger.info(f"Starting SOAP :: {stream_key} :: {file_path} :: {len(items)} messages")
+            segments, last_ai_preds = summary.get_merge_ai_preds(conversation_id=stream_key)
+            # Keyed per summary type: the four summaries run in parallel, each in message order
+            chunk_no = message_dict.get("chunk_no")
+            get_summary = summary.get_summary_async if use_asyncio else summary.get_summary
+            results[(state, stream_key)] = [
+                debouncer.submit(executor, (stream_key, name), chunk_no, get_summary,
+                                 name, message_dict, start_time, segments, last_ai_preds, lane=lane)
+                for name in SUMMARIES
+            ]
+        return results
+
+    def runtime(self):
+        # Offsets are committed once the submitted work finishes
+        return ConsumerRuntime(KafkaService(group_id="soap"), batch_handler=self.dispatch_batch, executor=executor)
+
     def executor_task(self):
-        try:
-            while True:
-                kafka_service.post_poll()
-                for consumer in kafka_service.post_consumer:
-                    if consumer.value.decode('utf-8') != '':
-                        if consumer.topic == heconstants.EXECUTOR_TOPIC:
-                            message_to_pass = consumer.value.decode('utf-8')
-                            # kafka_client.commit()
-                            start_time = datetime.utcnow()
-                            message_dict = json.loads(message_to_pass)
-                            if message_dict.get("state") == "Analytics" and not message_dict.get("completed"):
-                                summary = soap()
-                                stream_key = message_dict.get("care_req_id")
-                                file_path = message_dict.get("file_path")
-                                logger.info(f"Starting SOAP :: {stream_key} :: {file_path}")
-                                segments, last_ai_preds = summary.get_merge_ai_preds(conversation_id=stream_key)
-                                executor.submit(summary.get_subjective_summary, message_dict, start_time, segments,
-                                                last_ai_preds
-                                                )
-                                executor.submit(summary.get_objective_summary, message_dict, start_time, segments,
-                                                last_ai_preds)
-                                executor.submit(summary.get_clinical_assessment_summary, message_dict, start_time,
-                                                segments,
-                                                last_ai_preds)
-                                executor.submit(summary.get_care_plan_summary, message_dict, start_time, segments,
-                                                last_ai_preds)
-
-        except Exception as exc:
-            msg = "post message polling failed :: {}".format(exc)
-            logger.error(msg)
-            trace = traceback.format_exc()
-            return msg, 500
+        self.runtime().run()
 
 
 if __name__ == "__main__":
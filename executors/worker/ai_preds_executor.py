@@ -2,18 +2,21 @@ import json
 import logging
 import traceback
 from datetime import datetime
-import requests
 import openai
 from utils import heconstants
+from utils.async_io import blocking, chat_completion_call, post_json_call, run_steps, run_steps_async
 from utils.s3_operation import S3SERVICE
 from services.kafka.kafka_service import KafkaService
+from services.kafka.retry import is_transient, schedule_retry
 from config.logconfig import get_logger
 
-s3 = S3SERVICE()
-producer = KafkaService(group_id="aipreds")
+s3 = S3SERVICE(stage="aipreds")
+producer = KafkaService()
 openai.api_key = heconstants.OPENAI_APIKEY
 logger = get_logger()
 logger.setLevel(logging.INFO)
+# Tried in order until one returns a parsable answer
+EXTRACTION_MODELS = ["gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k-0613", "gpt-4-0613"]
 
 
 class aiPreds:
@@ -89,184 +92,204 @@ class aiPreds:
 
         return entities
 
-    def execute_function(self, message, start_time):
+    def load_inputs(self, conversation_id):
+        """Segments of the conversation so far and the current ai_preds, as (segments, entities)."""
+        merged_segments = []
+        conversation_datas = s3.get_conversation_chunks(conversation_id)
+        if conversation_datas:
+            for conversation_data in conversation_datas:
+                merged_segments += conversation_data["segments"]
+
+        entities = {
+            "age": {"text": None, "value": None, "unit": None},
+            "gender": {"text": None, "value": None, "unit": None},
+            "height": {"text": None, "value": None, "unit": None},
+            "weight": {"text": None, "value": None, "unit": None},
+            "bmi": {"text": None, "value": None, "unit": None},
+            "ethnicity": {"text": None, "value": None, "unit": None},
+            "insurance": {"text": None, "value": None, "unit": None},
+            "physicalActivityExercise": {"text": None, "value": None, "unit": None},
+            "bloodPressure": {"text": None, "value": None, "unit": None},
+            "pulse": {"text": None, "value": None, "unit": None},
+            "respiratoryRate": {"text": None, "value": None, "unit": None},
+            "bodyTemperature": {"text": None, "value": None, "unit": None},
+            "substanceAbuse": {"text": None, "value": None, "unit": None},
+            "entities": {
+                "medications": [],
+                "symptoms": [],
+                "diseases": [],
+                "diagnoses": [],
+                "surgeries": [],
+                "tests": [],
+            },
+            "summaries": {
+                "subjectiveClinicalSummary": [],
+                "objectiveClinicalSummary": [],
+                "clinicalAssessment": [],
+                "carePlanSuggested": [],
+            },
+        }
+
+        ai_preds_file_path = f"{conversation_id}/ai_preds.json"
+        existing_entities = s3.get_json_file_if_exists(ai_preds_file_path)
+        if existing_entities:
+            entities = existing_entities
+        return merged_segments, entities
+
+    def apply_details(self, entities, extracted_info):
+        """Copy the extracted details into entities and return the (text, type) pairs to code."""
+        details = extracted_info.get("details", {})
+        if details:
+            for k, v in details.items():
+                if k in entities:
+                    if entities[k]["text"] is None:
+                        entities[k]["text"] = v
+                    # else:
+                    #     entities[k]["text"] += ", " + v
+
+                    entities[k]["value"] = entities[k]["text"]
+
+        all_texts_and_types = []
+        for k in ["medications", "symptoms", "diseases", "diagnoses", "surgeries", "tests"]:
+            if isinstance(extracted_info.get(k), str):
+                v = extracted_info.get(k, "").replace(" and ", " , ").split(",")
+                for _ in v:
+                    if _.strip():
+                        all_texts_and_types.append((_.strip(), k))
+            elif isinstance(extracted_info.get(k), list):
+                v = extracted_info.get(k, "")
+                for _ in v:
+                    all_texts_and_types.append((_.strip(), k))
+
+        return all_texts_and_types
+
+    def apply_codes(self, entities, extracted_info, all_texts_and_types, codes):
+        """Fill entities["entities"] from extracted_info; codes is the code search prediction or None."""
+        text_to_codes = {}
+
+        if all_texts_and_types:
+            if codes is None:
+                codes = [{"name": _, "code": None} for _ in all_texts_and_types]
+
+            for (text, _type), code in zip(all_texts_and_types, codes):
+                text_to_codes[text] = {"name": code["name"], "code": code["code"], "score": code.get("score")}
+
+        for k in ["medications", "symptoms", "diseases", "diagnoses", "surgeries", "tests"]:
+            if isinstance(extracted_info.get(k), str):
+                v = extracted_info.get(k, "").replace(" and ", " , ").split(",")
+                v = [
+                    {
+                        "text": _.strip(),
+                        "code": text_to_codes.get(_.strip(), {}).get("code", None),
+                        "code_value": text_to_codes.get(_.strip(), {}).get("name", None),
+                        "code_type": "",
+                        "confidence": text_to_codes.get(_.strip(), {}).get("score", None),
+                    }
+                    for _ in v
+                    if _.strip()
+                ]
+                entities["entities"][k] = v
+            elif isinstance(extracted_info.get(k), list):
+                v = extracted_info.get(k, "")
+                val = [
+                    {
+                        "text": _.strip(),
+                        "code": text_to_codes.get(_.strip(), {}).get("code", None),
+                        "code_value": text_to_codes.get(_.strip(), {}).get("name", None),
+                        "code_type": "",
+                        "confidence": text_to_codes.get(_.strip(), {}).get("score", None),
+                    }
+                    for _ in v
+                    if _.strip()
+                ]
+                entities["entities"][k] = val
+
+        return self.clean_null_entries(entities)
+
+    def store_preds(self, message, start_time, entities):
+        conversation_id = message.get("care_req_id")
+        print("entities ::", entities)
+        s3.upload_to_s3(f"{conversation_id}/ai_preds.json", entities, is_json=True)
+        self.publish_analytics(message, start_time)
+
+    def publish_analytics(self, message, start_time):
+        """Hand the conversation to SOAP, with whatever ai_preds.json currently holds."""
+        conversation_id = message.get("care_req_id")
+        file_path = message.get("file_path")
+        chunk_no = message.get("chunk_no")
+        retry_count = message.get("retry_count")
+        data = {
+            "es_id": f"{conversation_id}_SOAP",
+            "chunk_no": chunk_no,
+            "file_path": file_path,
+            "api_path": "asr",
+            "api_type": "asr",
+            "req_type": "encounter",
+            "executor_name": "SOAP_EXECUTOR",
+            "state": "Analytics",
+            "retry_count": retry_count,
+            "uid": None,
+            "request_id": conversation_id,
+            "care_req_id": conversation_id,
+            "encounter_id": None,
+            "provider_id": None,
+            "review_provider_id": None,
+            "completed": False,
+            "exec_duration": 0.0,
+            "start_time": str(start_time),
+            "end_time": str(datetime.utcnow()),
+        }
+        producer.publish_executor_message(data)
+
+    def execute_steps(self, message, start_time):
+        """
+        AiPred for the conversation of message as a step generator (utils.async_io): storage,
+        OpenAI and code search calls are yielded, so both runtimes run this one body.
+        """
         try:
-            conversation_id = message.get("care_req_id")
-            file_path = message.get("file_path")
-            chunk_no = message.get("chunk_no")
-            retry_count = message.get("retry_count")
-            merged_segments = []
-
-            conversation_datas = s3.get_files_matching_pattern(
-                pattern=f"{conversation_id}/{conversation_id}_*json")
-            if conversation_datas:
-                for conversation_data in conversation_datas:
-                    merged_segments += conversation_data["segments"]
-
-            entities = {
-                "age": {"text": None, "value": None, "unit": None},
-                "gender": {"text": None, "value": None, "unit": None},
-                "height": {"text": None, "value": None, "unit": None},
-                "weight": {"text": None, "value": None, "unit": None},
-                "bmi": {"text": None, "value": None, "unit": None},
-                "ethnicity": {"text": None, "value": None, "unit": None},
-                "insurance": {"text": None, "value": None, "unit": None},
-                "physicalActivityExercise": {"text": None, "value": None, "unit": None},
-                "bloodPressure": {"text": None, "value": None, "unit": None},
-                "pulse": {"text": None, "value": None, "unit": None},
-                "respiratoryRate": {"text": None, "value": None, "unit": None},
-                "bodyTemperature": {"text": None, "value": None, "unit": None},
-                "substanceAbuse": {"text": None, "value": None, "unit": None},
-                "entities": {
-                    "medications": [],
-                    "symptoms": [],
-                    "diseases": [],
-                    "diagnoses": [],
-                    "surgeries": [],
-                    "tests": [],
-                },
-                "summaries": {
-                    "subjectiveClinicalSummary": [],
-                    "objectiveClinicalSummary": [],
-                    "clinicalAssessment": [],
-                    "carePlanSuggested": [],
-                },
-            }
-
-            ai_preds_file_path = f"{conversation_id}/ai_preds.json"
-            if s3.check_file_exists(ai_preds_file_path):
-                entities = s3.get_json_file(ai_preds_file_path)
+            merged_segments, entities = yield blocking(self.load_inputs, message.get("care_req_id"))
 
             if merged_segments:
                 text = " ".join([_["text"] for _ in merged_segments])
-                extracted_info = self.get_preds_from_open_ai(text)
+                if not self.long_enough(text):
+                    logger.info(f"Transcript too short for AI PREDICTION :: {message.get('care_req_id')}")
+                    yield blocking(self.publish_analytics, message, start_time)
+                    return
+                extracted_info = yield from self.get_preds_steps(text)
+                if extracted_info is None:
+                    logger.info(f"No AI PREDICTION extracted :: {message.get('care_req_id')}")
+                    yield blocking(self.publish_analytics, message, start_time)
+                    return
                 extracted_info = self.clean_pred(extracted_info)
+                all_texts_and_types = self.apply_details(entities, extracted_info)
 
-                details = extracted_info.get("details", {})
-                if details:
-                    for k, v in details.items():
-                        if k in entities:
-                            if entities[k]["text"] is None:
-                                entities[k]["text"] = v
-                            # else:
-                            #     entities[k]["text"] += ", " + v
-
-                            entities[k]["value"] = entities[k]["text"]
-
-                all_texts_and_types = []
-                for k in ["medications", "symptoms", "diseases", "diagnoses", "surgeries", "tests"]:
-                    if isinstance(extracted_info.get(k), str):
-                        v = extracted_info.get(k, "").replace(" and ", " , ").split(",")
-                        for _ in v:
-                            if _.strip():
-                                all_texts_and_types.append((_.strip(), k))
-                    elif isinstance(extracted_info.get(k), list):
-                        v = extracted_info.get(k, "")
-                        for _ in v:
-                            all_texts_and_types.append((_.strip(), k))
-
-                text_to_codes = {}
-
+                codes = None
                 if all_texts_and_types:
                     try:
-                        codes = \
-                            requests.post(heconstants.AI_SERVER + "/code_search/infer",
-                                          json=all_texts_and_types).json()[
-                                'prediction']
-                    except:
-                        codes = [{"name": _, "code": None} for _ in all_texts_and_types]
-
-                    for (text, _type), code in zip(all_texts_and_types, codes):
-                        text_to_codes[text] = {"name": code["name"], "code": code["code"], "score": code.get("score")}
-
-                for k in ["medications", "symptoms", "diseases", "diagnoses", "surgeries", "tests"]:
-                    if isinstance(extracted_info.get(k), str):
-                        v = extracted_info.get(k, "").replace(" and ", " , ").split(",")
-                        v = [
-                            {
-                                "text": _.strip(),
-                                "code": text_to_codes.get(_.strip(), {}).get("code", None),
-                                "code_value": text_to_codes.get(_.strip(), {}).get("name", None),
-                                "code_type": "",
-                                "confidence": text_to_codes.get(_.strip(), {}).get("score", None),
-                            }
-                            for _ in v
-                            if _.strip()
-                        ]
-                        entities["entities"][k] = v
-                    elif isinstance(extracted_info.get(k), list):
-                        v = extracted_info.get(k, "")
-                        val = [
-                            {
-                                "text": _.strip(),
-                                "code": text_to_codes.get(_.strip(), {}).get("code", None),
-                                "code_value": text_to_codes.get(_.strip(), {}).get("name", None),
-                                "code_type": "",
-                                "confidence": text_to_codes.get(_.strip(), {}).get("score", None),
-                            }
-                            for _ in v
-                            if _.strip()
-                        ]
-                        entities["entities"][k] = val
-
-                # if entities:
-                #     current_segment["ai_preds"] = entities
-                # else:
-                #     current_segment["ai_preds"] = None
-
-                entities = self.clean_null_entries(entities)
-                print("entities ::", entities)
-                s3.upload_to_s3(f"{conversation_id}/ai_preds.json", entities, is_json=True)
-                data = {
-                    "es_id": f"{conversation_id}_SOAP",
-                    "chunk_no": chunk_no,
-                    "file_path": file_path,
-                    "api_path": "asr",
-                    "api_type": "asr",
-                    "req_type": "encounter",
-                    "executor_name": "SOAP_EXECUTOR",
-                    "state": "Analytics",
-                    "retry_count": retry_count,
-                    "uid": None,
-                    "request_id": conversation_id,
-                    "care_req_id": conversation_id,
-                    "encounter_id": None,
-                    "provider_id": None,
-                    "review_provider_id": None,
-                    "completed": False,
-                    "exec_duration": 0.0,
-                    "start_time": str(start_time),
-                    "end_time": str(datetime.utcnow()),
-                }
-                producer.publish_executor_message(data)
+                        codes = (yield post_json_call(heconstants.AI_SERVER + "/code_search/infer",
+                                                      json=all_texts_and_types))['prediction']
+                    except Exception:
+                        codes = None
+
+                entities = self.apply_codes(entities, extracted_info, all_texts_and_types, codes)
+                yield blocking(self.store_preds, message, start_time, entities)
 
         except Exception as exc:
             msg = "Failed to get AI PREDICTION :: {}".format(exc)
             trace = traceback.format_exc()
             logger.error(msg, trace)
-            if retry_count <= 2:
-                data = {
-                    "es_id": f"{conversation_id}_SOAP",
-                    "chunk_no": chunk_no,
-                    "file_path": file_path,
-                    "api_path": "asr",
-                    "api_type": "asr",
-                    "req_type": "encounter",
-                    "executor_name": "SOAP_EXECUTOR",
-                    "state": "Analytics",
-                    "retry_count": retry_count,
-                    "uid": None,
-                    "request_id": conversation_id,
-                    "care_req_id": conversation_id,
-                    "encounter_id": None,
-                    "provider_id": None,
-                    "review_provider_id": None,
-                    "completed": False,
-                    "exec_duration": 0.0,
-                    "start_time": str(start_time),
-                    "end_time": str(datetime.utcnow()),
-                }
-                producer.publish_executor_message(data)
+            if is_transient(exc):
+                schedule_retry(producer, message, msg)
+            else:
+                # Another attempt would fail the same way; summarise what is already stored
+                yield blocking(self.publish_analytics, message, start_time)
+
+    def execute_function(self, message, start_time):
+        run_steps(self.execute_steps(message, start_time))
+
+    async def execute_function_async(self, message, start_time):
+        """execute_function for AsyncExecutorHost: S3, OpenAI and code search are awaited."""
+        await run_steps_async(self.execute_steps(message, start_time))
 
     def string_to_dict(self, input_string):
         # Initialize an empty dictionary
@@ -320,76 +343,100 @@ class aiPreds:
 
         return result
 
+    def long_enough(self, transcript_text, min_length=30):
+        transcript_text = transcript_text.strip()
+        return bool(transcript_text) and len(transcript_text) > min_length
+
+    def extraction_messages(self, transcript_text, min_length=30):
+        if not self.long_enough(transcript_text, min_length):
+            raise Exception("Transcript text is too short")
+        transcript_text = transcript_text.strip()
+
+        template = """
+        "medications": <text>,
+        "symptoms": <text>,
+        "diseases": <text>,
+        "diagnoses": <text>,
+        "surgeries": <text>,
+        "orders": <text>,
+        "age_years": <text>,
+        "gender": <text>,
+        "height_cm": <text>,
+        "weight_kg": <text>,
+        "ethnicity": <text>,
+        "substanceAbuse": <text>,
+        "bloodPressure": <text>,
+        "pulseRate": <text>,
+        "respiratoryRate": <text>,
+        "bodyTemperature_fahrenheit": <text>
+        """
+
+        messages = [
+            {
+                "role": "system",
+                "content": """ Don't make assumptions about what values to plug into functions. return not found if you can't find the information.
+                You are acting as an expert clinical entity extractor.
+                Extract the described information from given clinical notes or consultation transcript.
+                No extra information or hypothesis not present in the given text should be added. Separate items with , wherever needed.
+                All the text returned should be present in the given TEXT. no new text should be returned.""",
+            },
+            {
+                "role": "system",
+                "content": f"Use given template to return the response : {template}",
+            },
+            {"role": "user", "content": f"TEXT: {transcript_text}"},
+        ]
+        return messages
+
+    def get_preds_steps(self, transcript_text, min_length=30):
+        """
+        Extracted entities from the first of EXTRACTION_MODELS with a parsable answer, or
+        None, as a step generator. When every model failed with a transient error, the last
+        one is raised so the message is retried.
+        """
+        try:
+            messages = self.extraction_messages(transcript_text, min_length)
+        except Exception as exc:
+            msg = "Failed to get OPEN AI PREDICTION :: {}".format(exc)
+            logger.error(msg)
+            return None
+
+        errors = []
+        for model_name in EXTRACTION_MODELS:
+            try:
+                response = yield chat_completion_call(
+                    model=model_name,
+                    messages=messages,
+                    # functions=function_list,
+                    # function_call={"name": "ClinicalInformation"},
+                    temperature=0.6,
+                )
+
+                extracted_info = response.choices[0]["message"]["content"]
+                converted_info = self.string_to_dict(extracted_info)
+                logger.info(f"extracted_info :: {converted_info}")
+                # extracted_info = json.loads(
+                #     response.choices[0]["message"]["function_call"]["arguments"]
+                # )
+                return converted_info
+
+            except Exception as ex:
+                logger.error(ex)
+                errors.append(ex)
+        if errors and all(is_transient(ex) for ex in errors):
+            raise errors[-1]
+        return None
+
     def get_preds_from_open_ai(self,
                                transcript_text,
                                function_list=heconstants.faster_clinical_info_extraction_functions,
                                min_length=30,
                                ):
-        try:
-            transcript_text = transcript_text.strip()
-            if not transcript_text or len(transcript_text) <= min_length:
-                raise Exception("Transcript text is too short")
-
-            template = """
-            "medications": <text>,
-            "symptoms": <text>,
-            "diseases": <text>,
-            "diagnoses": <text>,
-            "surgeries": <text>,
-            "orders": <text>,
-            "age_years": <text>,
-            "gender": <text>,
-            "height_cm": <text>,
-            "weight_kg": <text>,
-            "ethnicity": <text>,
-            "substanceAbuse": <text>,
-            "bloodPressure": <text>,
-            "pulseRate": <text>,
-            "respiratoryRate": <text>,
-            "bodyTemperature_fahrenheit": <text>
-            """
-
-            messages = [
-                {
-                    "role": "system",
-                    "content": """ Don't make assumptions about what values to plug into functions. return not found if you can't find the information.
-                    You are acting as an expert clinical entity extractor.
-                    Extract the described information from given clinical notes or consultation transcript.
-                    No extra information or hypothesis not present in the given text should be added. Separate items with , wherever needed.
-                    All the text returned should be present in the given TEXT. no new text should be returned.""",
-                },
-                {
-                    "role": "system",
-                    "content": f"Use given template to return the response : {template}",
-                },
-                {"role": "user", "content": f"TEXT: {transcript_text}"},
-            ]
-
-            for model_name in ["gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k-0613", "gpt-4-0613"]:
-                try:
-                    response = openai.ChatCompletion.create(
-                        model=model_name,
-                        messages=messages,
-                        # functions=function_list,
-                        # function_call={"name": "ClinicalInformation"},
-                        temperature=0.6,
-                    )
-
-                    extracted_info = response.choices[0]["message"]["content"]
-                    converted_info = self.string_to_dict(extracted_info)
-                    logger.info(f"extracted_info :: {converted_info}")
-                    # extracted_info = json.loads(
-                    #     response.choices[0]["message"]["function_call"]["arguments"]
-                    # )
-                    return converted_info
-
-                except Exception as ex:
-                    logger.error(ex)
-                    pass
-        except Exception as exc:
-            msg = "Failed to get OPEN AI PREDICTION :: {}".format(exc)
-            logger.error(msg)
+        return run_steps(self.get_preds_steps(transcript_text, min_length))
 
+    async def get_preds_from_open_ai_async(self, transcript_text, min_length=30):
+        """get_preds_from_open_ai without holding a thread while OpenAI responds."""
+        return await run_steps_async(self.get_preds_steps(transcript_text, min_length))
 
 # if __name__ == "__main__":
     # ai_pred = aiPreds()
@@ -1,20 +1,22 @@
 import logging
 import os
 from datetime import datetime
-from io import BytesIO
 
 import av
 import time
-import requests
 from utils import heconstants
+from utils.async_io import AsyncStorage, IOCall, blocking, post_json_call, run_steps, run_steps_async
+from utils.audio_pool import SharedAudio, decode_duration, decode_duration_async
 from utils.s3_operation import S3SERVICE
+from utils.stream_io import BufferReader
 from pydub.utils import mediainfo
 from services.kafka.kafka_service import KafkaService
+from services.kafka.retry import is_transient, schedule_retry
 from config.logconfig import get_logger
-from pydub import AudioSegment
 
-s3 = S3SERVICE()
-producer = KafkaService(group_id="asr")
+s3 = S3SERVICE(stage="asr")
+async_s3 = AsyncStorage(s3)
+producer = KafkaService()
 logger = get_logger()
 logger.setLevel(logging.INFO)
 
@@ -45,55 +47,53 @@ class ASRExecutor:
         except Exception as e:
             print(f"An error occurred get_audio_video_duration_and_extension file: {e}")
 
-    def execute_function(self, message, start_time):
+    def prepare(self, message):
+        """Duration of the chunks before this one, and the local audio path, as (duration, path)."""
+        file_path = message.get("file_path")
+        conversation_id = message.get("care_req_id")
+        # previous_conversation_ids_datas = []
+        previous_conversation_ids_datas = s3.get_conversation_chunks(conversation_id)
+
+        total_duration_until_now = 0
+        if previous_conversation_ids_datas:
+            total_duration_until_now = sum(
+                [v["duration"] for v in previous_conversation_ids_datas]
+            )
+
+        logger.info(f"total_duration_until_now :: {total_duration_until_now}")
+
+        # if len(user_name.split()) > 1 or len(conversation_id.split()) > 1:
+        #     raise Exception("Invalid user_name or conversation_id")
+
+        conversation_directory = f"{self.AUDIO_DIR}/{conversation_id}"
+
         try:
-            file_path = message.get("file_path")
-            user_name = message.get("user_name")
-            chunk_no = message.get("chunk_no")
-            conversation_id = message.get("care_req_id")
-            retry_count = message.get("retry_count", 0)
-            force_summary = message.get("force_summary", False)
-            api_key = message.get("api_key")
-            received_at = time.time()
-            # previous_conversation_ids_datas = []
-            previous_conversation_ids_datas = s3.get_files_matching_pattern(
-                pattern=f"{conversation_id}/{conversation_id}_*json")
-
-            total_duration_until_now = 0
-            if previous_conversation_ids_datas:
-                total_duration_until_now = sum(
-                    [v["duration"] for v in previous_conversation_ids_datas]
-                )
-
-            logger.info(f"total_duration_until_now :: {total_duration_until_now}")
-
-            # if len(user_name.split()) > 1 or len(conversation_id.split()) > 1:
-            #     raise Exception("Invalid user_name or conversation_id")
-
-            conversation_directory = f"{self.AUDIO_DIR}/{conversation_id}"
-
-            try:
-                os.makedirs(conversation_directory, exist_ok=True)
-            except:
-                pass
-
-            audio_path = os.path.join(conversation_directory, file_path.split("/")[1])
-            logger.info(f"audio_path :: {audio_path}")
-
-            audio_stream = BytesIO()
-            if audio_path:
-                # Read the object from S3 in chunks
-                # with open(audio_path, 'wb') as file:
-                s3_object = s3.get_audio_file(file_path)
-                stream = s3_object['Body']
-                while True:
-                    chunk = stream.read(2048)
-                    if not chunk:
-                        break
-                    audio_stream.write(chunk)
-                    # file.write(chunk)
-            else:
-                raise Exception("No audio file found")
+            os.makedirs(conversation_directory, exist_ok=True)
+        except:
+            pass
+
+        audio_path = os.path.join(conversation_directory, file_path.split("/")[1])
+        logger.info(f"audio_path :: {audio_path}")
+        if not audio_path:
+            raise Exception("No audio file found")
+        return total_duration_until_now, audio_path
+
+    def execute_steps(self, message, start_time):
+        """
+        Transcription of the chunk in message as a step generator (utils.async_io): storage,
+        decoding and the AI server call are yielded, so both runtimes run this one body.
+        """
+        shared_audio = SharedAudio()
+        file_path = message.get("file_path")
+        received_at = time.time()
+        duration = None
+        try:
+            total_duration_until_now, audio_path = yield blocking(self.prepare, message)
+            # Read the whole object from S3 straight into shared memory, so the decode
+            # process reads the same bytes that are posted for transcription
+            audio_buffer = yield IOCall(s3.get_audio_buffer, async_s3.get_audio_buffer, file_path,
+                                        allocate=shared_audio.allocate)
+            audio_stream = BufferReader(audio_buffer, name=file_path.split("/")[1])
 
             # try:
             #     file_type, duration, extension = self.get_audio_video_duration_and_extension(
@@ -120,20 +120,18 @@ class ASRExecutor:
             #     audio_path = audio_path + extension
 
         except Exception as ex:
+            shared_audio.close()
+            # A missing chunk stays missing; only storage errors are worth another attempt
+            if is_transient(ex):
+                schedule_retry(producer, message, f"failed to load audio: {ex}")
             raise ex
 
         try:
-            audio_file = audio_stream
-            # Read audio data with pydub
-            audio = AudioSegment.from_file(audio_file, format="wav")
-            duration_in_milliseconds = len(audio)
-            duration = duration_in_milliseconds / 1000.0
-            audio_stream.name = file_path.split("/")[1]
-            audio_stream.seek(0)
-            transcription_result = requests.post(
-                heconstants.AI_SERVER + "/transcribe/infer",
-                files={"f1": audio_stream},
-            ).json()["prediction"][0]
+            # Decoded in the audio process pool
+            duration = yield IOCall(decode_duration, decode_duration_async, shared_audio, "wav")
+            # A 5xx raises before the response is read and is retried as a transient failure
+            transcription_result = (yield post_json_call(heconstants.AI_SERVER + "/transcribe/infer",
+                                                         files={"f1": audio_stream}))["prediction"][0]
             logger.info(f"transcription_result :: {transcription_result}")
             # todo change fixed ip to DNS
             # transcription_result = requests.post(
@@ -141,18 +139,45 @@ class ASRExecutor:
             #     files={"f1": open(audio_path, "rb")},
             # ).json()["prediction"][0]
         except Exception as ex:
-            print(ex)
-            # esquery
-            data = {
-                "received_at": received_at,
-                "conversation_id": conversation_id,
-                "user_name": user_name,
-                "duration": duration,
-                "success": False,
-                "audio_path": audio_path,
-            }
-            s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True)
-            raise Exception("Transcription failed")
+            yield blocking(self.transcription_failed, message, received_at, duration, audio_path, ex)
+        finally:
+            audio_stream = None
+            shared_audio.close()
+
+        yield blocking(self.store_transcription, message, start_time, received_at, duration, audio_path,
+                       transcription_result, total_duration_until_now)
+
+    def execute_function(self, message, start_time):
+        run_steps(self.execute_steps(message, start_time))
+
+    async def execute_function_async(self, message, start_time):
+        """execute_function for AsyncExecutorHost: S3, decoding and transcription are awaited."""
+        await run_steps_async(self.execute_steps(message, start_time))
+
+    def transcription_failed(self, message, received_at, duration, audio_path, ex):
+        print(ex)
+        # esquery
+        data = {
+            "received_at": received_at,
+            "conversation_id": message.get("care_req_id"),
+            "user_name": message.get("user_name"),
+            "duration": duration,
+            "success": False,
+            "audio_path": audio_path,
+        }
+        s3.upload_to_s3(message.get("file_path").replace("wav", "json"), data, is_json=True)
+        # An empty or corrupt chunk fails to decode on every attempt; the AI server may recover
+        if is_transient(ex):
+            schedule_retry(producer, message, f"transcription failed: {ex}")
+        raise Exception("Transcription failed")
+
+    def store_transcription(self, message, start_time, received_at, duration, audio_path, transcription_result,
+                            total_duration_until_now):
+        file_path = message.get("file_path")
+        user_name = message.get("user_name")
+        chunk_no = message.get("chunk_no")
+        conversation_id = message.get("care_req_id")
+        retry_count = message.get("retry_count", 0)
 
         current_segments = transcription_result["segments"]
         for i in range(len(current_segments)):
@@ -176,9 +201,11 @@ class ASRExecutor:
                     "success": True,
                     "audio_path": audio_path,
                     "language": language,
-                    "retry_count": 0
+                    "retry_count": retry_count or 0
                     }
-            s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True)
+            s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True,
+                            compact=heconstants.compact_segments)
+            s3.append_to_manifest(conversation_id, data)
             data = {
                 "es_id": f"{conversation_id}_AI_PRED",
                 "chunk_no": chunk_no,
@@ -214,33 +241,13 @@ class ASRExecutor:
                     "success": False,
                     "audio_path": audio_path,
                     "language": language,
-                    "retry_count": 0
+                    "retry_count": retry_count or 0
                     }
-            s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True)
+            s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True,
+                            compact=heconstants.compact_segments)
+            s3.append_to_manifest(conversation_id, data)
 
-            if retry_count <= 2:
-                data = {
-                    "es_id": f"{conversation_id}_ASR_EXECUTOR",
-                    "chunk_no": chunk_no,
-                    "file_path": file_path,
-                    "api_path": "asr",
-                    "api_type": "asr",
-                    "req_type": "encounter",
-                    "executor_name": "ASR_EXECUTOR",
-                    "state": "SpeechToText",
-                    "retry_count": None,
-                    "uid": None,
-                    "request_id": conversation_id,
-                    "care_req_id": conversation_id,
-                    "encounter_id": None,
-                    "provider_id": None,
-                    "review_provider_id": None,
-                    "completed": False,
-                    "exec_duration": 0.0,
-                    "start_time": str(start_time),
-                    "end_time": str(datetime.utcnow()),
-                }
-                producer.publish_executor_message(data)
+            schedule_retry(producer, message, "failed to store transcription")
 
 # if __name__ == "__main__":
 # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
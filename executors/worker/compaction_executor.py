@@ -0,0 +1,86 @@
+import io
+import logging
+import time
+import traceback
+import wave
+from datetime import datetime
+
+from utils import heconstants
+from utils.s3_operation import S3SERVICE, compacted_audio_key
+from utils.stream_io import BufferReader
+from services.kafka.kafka_service import KafkaService
+from services.kafka.retry import schedule_recheck
+from config.logconfig import get_logger
+
+s3 = S3SERVICE(stage="compaction")
+producer = KafkaService()
+logger = get_logger()
+logger.setLevel(logging.INFO)
+
+
+class conversationCompactor:
+    """
+    Folds a finished conversation into two immutable objects: one transcript holding every
+    chunk result and one WAV of the whole encounter. The manifest is replaced by a pointer
+    to them, so reads after the encounter cost one small GET plus a cached transcript
+    instead of one request per chunk. The per-chunk objects are left in place.
+    """
+
+    def concat_audio(self, conversation_id, chunk_datas):
+        output = io.BytesIO()
+        writer = None
+        for chunk_data in chunk_datas:
+            key = f"{conversation_id}/{conversation_id}_chunk{chunk_data['chunk_no']}.wav"
+            if not s3.check_file_exists(key):
+                logger.info(f"Compaction missing audio :: {key}")
+                continue
+            with wave.open(BufferReader(s3.get_audio_buffer(key), name=key), "rb") as reader:
+                if writer is None:
+                    writer = wave.open(output, "wb")
+                    writer.setnchannels(reader.getnchannels())
+                    writer.setsampwidth(reader.getsampwidth())
+                    writer.setframerate(reader.getframerate())
+                writer.writeframes(reader.readframes(reader.getnframes()))
+        if writer is None:
+            return None
+        writer.close()
+        return output.getvalue()
+
+    def execute_function(self, message, start_time):
+        conversation_id = message.get("care_req_id")
+        try:
+            expected_chunks = message.get("chunk_count") or 0
+            wait_until = message.get("compaction_wait_until") or time.time() + heconstants.compaction_max_wait
+            chunk_datas, compacted = s3.load_conversation(conversation_id)
+            if compacted:
+                logger.info(f"Already compacted :: {conversation_id}")
+                return
+            if len(chunk_datas) < expected_chunks and time.time() < wait_until:
+                # ASR can still be finishing the last chunks when Completed is published; check
+                # again later through the retry executor instead of holding this worker
+                schedule_recheck(producer, dict(message, compaction_wait_until=wait_until),
+                                 heconstants.compaction_poll_interval,
+                                 f"{len(chunk_datas)} of {expected_chunks} chunks transcribed")
+                return
+            if not chunk_datas:
+                logger.info(f"Nothing to compact :: {conversation_id}")
+                return
+
+            chunk_count = len(chunk_datas)
+            audio_key = None
+            audio = self.concat_audio(conversation_id, chunk_datas)
+            if audio:
+                audio_key = compacted_audio_key(conversation_id, chunk_count)
+                s3.upload_to_s3(audio_key, audio)
+
+            compacted = s3.write_compacted_transcript(conversation_id, chunk_count, audio_key=audio_key)
+            if compacted is None:
+                logger.info(f"Compaction skipped, chunks changed :: {conversation_id}")
+                return
+            logger.info(f"Compacted :: {conversation_id} :: {chunk_count} chunks :: "
+                        f"{(datetime.utcnow() - start_time).total_seconds()}s")
+
+        except Exception as exc:
+            msg = "Failed compaction :: {} :: {}".format(conversation_id, exc)
+            trace = traceback.format_exc()
+            logger.error(msg, trace)
@@ -9,12 +9,14 @@ import wave
 from io import BytesIO
 from utils import heconstants
 from utils.s3_operation import S3SERVICE
+from utils.conversation_catalog import ConversationCatalog
 from utils.send_logs import push_logs
 from services.kafka.kafka_service import KafkaService
 from config.logconfig import get_logger
 
-s3 = S3SERVICE()
-producer = KafkaService(group_id="filedownloader")
+s3 = S3SERVICE(stage="filedownloader")
+catalog = ConversationCatalog(s3)
+producer = KafkaService()
 logger = get_logger()
 logger.setLevel(logging.INFO)
 
@@ -175,9 +177,12 @@ class fileDownloader:
                       source_type="backend")
             rtmp_iterator = self.yield_chunks_from_rtmp_stream(stream_key, user_type, stream_url)
 
+            catalog_start_time = int(time.time())
+            total_frames = 0
+            # Next chunk number; stays 1 (no chunks) when the stream could not be opened
+            chunk_count = 1
             if rtmp_iterator is not None:
                 started = False
-                chunk_count = 1
                 frames_per_chunk = 16000 * heconstants.chunk_duration  # 5 seconds of frames at 16000 Hz
                 bytes_per_frame = 2  # Assuming 16-bit audio (2 bytes per frame)
 
@@ -200,6 +205,7 @@ class fileDownloader:
                             s3_file = f"{stream_key}/{stream_key}.json"
                             if not s3.check_file_exists(s3_file):
                                 s3.upload_to_s3(s3_file, data, is_json=True)
+                            catalog.record(stream_key, catalog_start_time, stage="rtmp_saving_started")
                             logger.info(f"Writing chunks started :: {stream_key}")
                             started = True
 
@@ -218,6 +224,7 @@ class fileDownloader:
                             break
 
                     WAV_F.close()
+                    total_frames += frames_written
                     key = f"{stream_key}/{stream_key}_chunk{chunk_count}.wav"
                     wav_buffer.seek(0)  # Reset buffer pointer to the beginning
                     # Upload the finished chunk to S3
@@ -259,6 +266,9 @@ class fileDownloader:
             if data:
                 data["stage"] = "rtmp_saving_done"
                 s3.upload_to_s3(key, data, is_json=True)
+            if rtmp_iterator is not None:
+                catalog.record(stream_key, catalog_start_time, stage="rtmp_saving_done",
+                               chunk_count=chunk_count - 1, duration=total_frames / 16000)
 
             data = {
                 "es_id": f"{stream_key}_FILE_DOWNLOADER",
@@ -279,6 +289,7 @@ class fileDownloader:
                 "exec_duration": 0.0,
                 "start_time": str(start_time),
                 "end_time": str(datetime.utcnow()),
+                "chunk_count": chunk_count - 1,
             }
             producer.publish_executor_message(data)
 
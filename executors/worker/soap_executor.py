@@ -6,13 +6,14 @@ import nltk
 
 import openai
 from utils import heconstants
+from utils.async_io import blocking, chat_completion_call, run_steps, run_steps_async
 from utils.s3_operation import S3SERVICE
 from services.kafka.kafka_service import KafkaService
 from config.logconfig import get_logger
 
 nltk.download('punkt')
-s3 = S3SERVICE()
-producer = KafkaService(group_id="soap")
+s3 = S3SERVICE(stage="soap")
+producer = KafkaService()
 openai.api_key = heconstants.OPENAI_APIKEY
 logger = get_logger()
 logger.setLevel(logging.INFO)
@@ -27,6 +28,23 @@ remove_lines_with_words = [
     "undetermined",
     "not determined"
 ]
+# Summary file name -> (key in the OpenAI summaries, ai_preds fields listed at its top)
+SUMMARIES = {
+    "subjectiveClinicalSummary": ("subjectiveSummary", [
+        "age",
+        "gender",
+        "height",
+        "weight",
+        "bmi",
+        "ethnicity",
+        "substanceAbuse",
+        "physicalActivityExercise",
+        "allergies",
+    ]),
+    "objectiveClinicalSummary": ("objectiveSummary", ["bloodPressure", "pulse", "respiratoryRate", "bodyTemperature"]),
+    "clinicalAssessment": ("clinicalAssessmentSummary", []),
+    "carePlanSuggested": ("carePlanSummary", []),
+}
 
 
 class soap:
@@ -111,26 +129,31 @@ class soap:
 
         return result
 
-    def get_clinical_summaries_from_openai(self, text, summary_type: Optional[str] = None):
+    def summary_messages(self, text):
+        messages = [
+            {
+                "role": "system",
+                # "content": """Generate clinical summaries following their description for the following transcript""",
+                "content": """"Summarize the medical case in the following format: SUBJECTIVE,
+                OBJECTIVE, ASSESSMENT, PLAN. It is important to maintain accuracy and relevance to the medical
+                context and omit any non-medical chatter, assumptions, or speculations. Provide the asked
+                information in a clear and concise manner, structured, you are not suppose to assume anything and
+                dont use any hypothesis , rememeber to generate results in points.""",
+            },
+            {"role": "user", "content": f"TEXT: {text}"},
+        ]
+        return messages
+
+    def get_clinical_summaries_steps(self, text):
+        """Summaries from the first of GPT_MODELS that answers, or None, as a step generator."""
         try:
-            messages = [
-                {
-                    "role": "system",
-                    # "content": """Generate clinical summaries following their description for the following transcript""",
-                    "content": """"Summarize the medical case in the following format: SUBJECTIVE,
-                    OBJECTIVE, ASSESSMENT, PLAN. It is important to maintain accuracy and relevance to the medical
-                    context and omit any non-medical chatter, assumptions, or speculations. Provide the asked
-                    information in a clear and concise manner, structured, you are not suppose to assume anything and
-                    dont use any hypothesis , rememeber to generate results in points.""",
-                },
-                {"role": "user", "content": f"TEXT: {text}"},
-            ]
+            messages = self.summary_messages(text)
 
             # summary_function = self.filter_summary_properties(summary_type=summary_type)
 
             for model_name in heconstants.GPT_MODELS:
                 try:
-                    response = openai.ChatCompletion.create(
+                    response = yield chat_completion_call(
                         model=model_name,
                         messages=messages,
                         # functions=heconstants.clinical_summary_functions,
@@ -154,6 +177,14 @@ class soap:
         except Exception as exc:
             msg = "Failed to get OPEN AI SUMMARIES :: {}".format(exc)
             self.logger.error(msg)
+        return None
+
+    def get_clinical_summaries_from_openai(self, text, summary_type: Optional[str] = None):
+        return run_steps(self.get_clinical_summaries_steps(text))
+
+    async def get_clinical_summaries_from_openai_async(self, text, summary_type: Optional[str] = None):
+        """get_clinical_summaries_from_openai without holding a thread while OpenAI responds."""
+        return await run_steps_async(self.get_clinical_summaries_steps(text))
 
     def get_merge_ai_preds(self, conversation_id):
         try:
@@ -187,15 +218,15 @@ class soap:
                     "carePlanSuggested": [],
                 },
             }
-            conversation_datas = s3.get_files_matching_pattern(
-                pattern=f"{conversation_id}/{conversation_id}_*json")
+            conversation_datas = s3.get_conversation_chunks(conversation_id)
             if conversation_datas:
                 for conversation_data in conversation_datas:
                     merged_segments += conversation_data["segments"]
 
             ai_preds_file_path = f"{conversation_id}/ai_preds.json"
-            if s3.check_file_exists(ai_preds_file_path):
-                merged_ai_preds = s3.get_json_file(s3_filename=ai_preds_file_path)
+            existing_ai_preds = s3.get_json_file_if_exists(ai_preds_file_path)
+            if existing_ai_preds:
+                merged_ai_preds = existing_ai_preds
                 #     ai_preds = conversation_data["ai_preds"]
                 #     if ai_preds:
                 #         for k in [
@@ -270,176 +301,71 @@ class soap:
         except Exception as e:
             self.logger.error(f"An unexpected error occurred  {e}")
 
-    def get_subjective_summary(self, message, start_time, segments: list = [], last_ai_preds: dict = {}):
-        try:
-            conversation_id = message.get("care_req_id")
-            subjective_summary = []
-            for k in [
-                "age",
-                "gender",
-                "height",
-                "weight",
-                "bmi",
-                "ethnicity",
-                "substanceAbuse",
-                "physicalActivityExercise",
-                "allergies",
-            ]:
-                if k in last_ai_preds:
-                    subjective_summary.append(f"{k.capitalize()}: {last_ai_preds[k]['text']}")
-
-            interest_texts = self.get_interested_text(last_ai_preds, segments)
-
-            if interest_texts and len(" ".join(interest_texts).split()) >= 20:
-                summaries = self.get_clinical_summaries_from_openai("\n".join(interest_texts),
-                                                                    summary_type="subjectiveSummary")
-                try:
-                    subjective_summary += nltk.sent_tokenize(summaries["subjectiveSummary"])
-                except Exception as e:
-                    self.logger.error(f"NLTK error (subjectiveSummary) ::  {e}")
-                    pass
+    def summary_inputs(self, name, segments, last_ai_preds):
+        """
+        Lines from ai_preds that start the summary, and the text to summarise, or None when
+        the interesting part of the conversation is under 20 words.
+        """
+        summary_lines = []
+        for k in SUMMARIES[name][1]:
+            if k in last_ai_preds:
+                summary_lines.append(f"{k.capitalize()}: {last_ai_preds[k]['text']}")
+
+        interest_texts = self.get_interested_text(last_ai_preds, segments)
+        if interest_texts and len(" ".join(interest_texts).split()) >= 20:
+            return summary_lines, "\n".join(interest_texts)
+        return summary_lines, None
+
+    def store_summary(self, name, conversation_id, summary_lines, summaries=None, summarised=False):
+        if summarised:
+            key = SUMMARIES[name][0]
+            try:
+                summary_lines += nltk.sent_tokenize(summaries[key])
+            except Exception as e:
+                self.logger.error(f"NLTK error ({key}) ::  {e}")
+                pass
+
+            summary_lines = [
+                line
+                for line in summary_lines
+                if not any([word in line.lower() for word in remove_lines_with_words])
+            ]
 
-                subjective_summary = [
-                    line
-                    for line in subjective_summary
-                    if not any([word in line.lower() for word in remove_lines_with_words])
-                ]
-
-                data = {"subjectiveClinicalSummary": subjective_summary}
-                s3.upload_to_s3(f"{conversation_id}/subjectiveClinicalSummary.json",
-                                data.get("subjectiveClinicalSummary"), is_json=True)
-            else:
-                data = {"subjectiveClinicalSummary": subjective_summary}
-                s3.upload_to_s3(f"{conversation_id}/subjectiveClinicalSummary.json",
-                                data.get("subjectiveClinicalSummary"), is_json=True)
-
-            print(data)
-        except Exception as e:
-            self.logger.error(f"An unexpected error occurred while generating subjectiveClinicalSummary ::  {e}")
+        data = {name: summary_lines}
+        s3.upload_to_s3(f"{conversation_id}/{name}.json", data.get(name), is_json=True)
+        print(data)
 
-    def get_objective_summary(self, message, start_time, segments: list = [], last_ai_preds: dict = {}):
+    def get_summary_steps(self, name, message, segments, last_ai_preds):
+        """One of the SUMMARIES for the conversation of message, as a step generator."""
         try:
-            conversation_id = message.get("care_req_id")
-            objective_summary = []
-            for k in ["bloodPressure", "pulse", "respiratoryRate", "bodyTemperature"]:
-                if k in last_ai_preds:
-                    objective_summary.append(f"{k.capitalize()}: {last_ai_preds[k]['text']}")
-
-            interest_texts = self.get_interested_text(last_ai_preds, segments)
-
-            if interest_texts and len(" ".join(interest_texts).split()) >= 20:
-                summaries = self.get_clinical_summaries_from_openai("\n".join(interest_texts),
-                                                                    summary_type="objectiveSummary")
-                try:
-                    objective_summary += nltk.sent_tokenize(summaries["objectiveSummary"])
-                except Exception as e:
-                    self.logger.error(f"NLTK error (objectiveSummary) ::  {e}")
-                    pass
-
-                objective_summary = [
-                    line
-                    for line in objective_summary
-                    if not any([word in line.lower() for word in remove_lines_with_words])
-                ]
-
-                data = {
-                    "objectiveClinicalSummary": objective_summary,
-                }
-
-                s3.upload_to_s3(f"{conversation_id}/objectiveClinicalSummary.json",
-                                data.get("objectiveClinicalSummary"), is_json=True)
-
-            else:
-                data = {
-                    "objectiveClinicalSummary": objective_summary,
-                }
-
-                s3.upload_to_s3(f"{conversation_id}/objectiveClinicalSummary.json",
-                                data.get("objectiveClinicalSummary"), is_json=True)
-            print(data)
-
+            summary_lines, text = self.summary_inputs(name, segments, last_ai_preds)
+            summaries = None
+            if text is not None:
+                summaries = yield from self.get_clinical_summaries_steps(text)
+            yield blocking(self.store_summary, name, message.get("care_req_id"), summary_lines, summaries,
+                           summarised=text is not None)
         except Exception as e:
-            self.logger.error(f"An unexpected error occurred while generating  objectiveClinicalSummary ::  {e}")
-
-    def get_clinical_assessment_summary(self, message, start_time, segments: list = [], last_ai_preds: dict = {}):
-        try:
-            conversation_id = message.get("care_req_id")
+            self.logger.error(f"An unexpected error occurred while generating {name} ::  {e}")
 
-            clinical_assessment_summary = []
-            interest_texts = self.get_interested_text(last_ai_preds, segments)
+    def get_summary(self, name, message, start_time, segments: list = [], last_ai_preds: dict = {}):
+        """Build and store one of the SUMMARIES for the conversation of message."""
+        run_steps(self.get_summary_steps(name, message, segments, last_ai_preds))
 
-            if interest_texts and len(" ".join(interest_texts).split()) >= 20:
-                summaries = self.get_clinical_summaries_from_openai("\n".join(interest_texts),
-                                                                    summary_type="clinicalAssessmentSummary")
-                try:
-                    clinical_assessment_summary += nltk.sent_tokenize(
-                        summaries["clinicalAssessmentSummary"]
-                    )
-                except Exception as e:
-                    self.logger.error(f"NLTK error (clinicalAssessmentSummary) ::  {e}")
-                    pass
+    async def get_summary_async(self, name, message, start_time, segments: list = [], last_ai_preds: dict = {}):
+        """get_summary for AsyncExecutorHost; the OpenAI call is awaited, storage runs on a thread."""
+        await run_steps_async(self.get_summary_steps(name, message, segments, last_ai_preds))
 
-                clinical_assessment_summary = [
-                    line
-                    for line in clinical_assessment_summary
-                    if not any([word in line.lower() for word in remove_lines_with_words])
-                ]
-
-                data = {
-                    "clinicalAssessment": clinical_assessment_summary
-                }
-
-                s3.upload_to_s3(f"{conversation_id}/clinicalAssessment.json", data.get("clinicalAssessment"),
-                                is_json=True)
-            else:
-                data = {
-                    "clinicalAssessment": clinical_assessment_summary
-                }
+    def get_subjective_summary(self, message, start_time, segments: list = [], last_ai_preds: dict = {}):
+        self.get_summary("subjectiveClinicalSummary", message, start_time, segments, last_ai_preds)
 
-                s3.upload_to_s3(f"{conversation_id}/clinicalAssessment.json", data.get("clinicalAssessment"),
-                                is_json=True)
-            print(data)
+    def get_objective_summary(self, message, start_time, segments: list = [], last_ai_preds: dict = {}):
+        self.get_summary("objectiveClinicalSummary", message, start_time, segments, last_ai_preds)
 
-        except Exception as e:
-            self.logger.error(f"An unexpected error occurred while generating clinicalAssessment ::  {e}")
+    def get_clinical_assessment_summary(self, message, start_time, segments: list = [], last_ai_preds: dict = {}):
+        self.get_summary("clinicalAssessment", message, start_time, segments, last_ai_preds)
 
     def get_care_plan_summary(self, message, start_time, segments: list = [], last_ai_preds: dict = {}):
-        try:
-            conversation_id = message.get("care_req_id")
-
-            care_plan_summary = []
-            interest_texts = self.get_interested_text(last_ai_preds, segments)
-
-            if interest_texts and len(" ".join(interest_texts).split()) >= 20:
-                summaries = self.get_clinical_summaries_from_openai("\n".join(interest_texts),
-                                                                    summary_type="carePlanSummary")
-                try:
-                    care_plan_summary += nltk.sent_tokenize(summaries["carePlanSummary"])
-                except Exception as e:
-                    self.logger.error(f"NLTK error (carePlanSummary) ::  {e}")
-                    pass
-
-                care_plan_summary = [
-                    line
-                    for line in care_plan_summary
-                    if not any([word in line.lower() for word in remove_lines_with_words])
-                ]
-
-                data = {
-                    "carePlanSuggested": care_plan_summary
-                }
-                s3.upload_to_s3(f"{conversation_id}/carePlanSuggested.json", data.get("carePlanSuggested"),
-                                is_json=True)
-            else:
-                data = {
-                    "carePlanSuggested": care_plan_summary
-                }
-                s3.upload_to_s3(f"{conversation_id}/carePlanSuggested.json", data.get("carePlanSuggested"),
-                                is_json=True)
-            print(data)
-        except Exception as e:
-            self.logger.error(f"An unexpected error occurred while generating carePlanSuggested ::  {e}")
-
+        self.get_summary("carePlanSuggested", message, start_time, segments, last_ai_preds)
 
 # if __name__ == "__main__":
 #     soap_exe = soap()
@@ -0,0 +1,119 @@
+import asyncio
+import functools
+import inspect
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from config.logconfig import get_logger
+from services.kafka.lanes import LANES, pick_lane
+from utils import heconstants
+
+logger = get_logger()
+
+
+class _LaneGate:
+    """
+    In-flight slots for the event loop. When every slot is taken, a freed slot goes to the
+    next waiter picked by weighted round robin over the lanes that have waiters.
+    Only used from the loop thread.
+    """
+
+    def __init__(self, slots: int, weights: dict):
+        self.slots = slots
+        self.weights = weights
+        self.active = 0
+        self._waiters = {lane: deque() for lane in LANES}
+        self._credits = {lane: 0 for lane in LANES}
+
+    async def acquire(self, lane):
+        lane = lane if lane in self._waiters else "live"
+        if self.active < self.slots and not any(self._waiters.values()):
+            self.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        # release() hands its slot over without decrementing active
+        await waiter
+
+    def release(self):
+        while True:
+            ready = [lane for lane in LANES if self._waiters[lane]]
+            if not ready:
+                self.active -= 1
+                return
+            waiter = self._waiters[pick_lane(ready, self.weights, self._credits)].popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def stats(self):
+        return {"in_flight": self.active, "waiting": {lane: len(waiters) for lane, waiters in self._waiters.items()}}
+
+
+class AsyncExecutorHost:
+    """
+    Runs executor work on one asyncio event loop. Usable wherever KeyedExecutor is
+    (submit, submit_lane, stats), selected with EXECUTOR_RUNTIME=asyncio.
+
+    Coroutine functions run on the loop, so a message waiting on OpenAI, the AI server or
+    S3 holds a coroutine rather than a thread, and up to ASYNC_MAX_IN_FLIGHT of them run at
+    once. Plain callables run on the loop's default thread pool (ASYNC_THREAD_WORKERS), which
+    is also what asyncio.to_thread uses for the sync libraries. Tasks with the same key run
+    one at a time in submission order. When all slots are taken, waiting tasks are admitted
+    by lane weight, as in LaneExecutor.
+    """
+
+    def __init__(self, max_in_flight: int = None, thread_workers: int = None, weights: dict = None):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=thread_workers or heconstants.async_thread_workers,
+                                                          thread_name_prefix="async-fallback"))
+        self._gate = _LaneGate(max_in_flight or heconstants.async_max_in_flight, weights or heconstants.lane_weights)
+        self._tails = {}
+        threading.Thread(target=self._run_loop, name="async-host", daemon=True).start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, key, fn, *args, **kwargs):
+        return self.submit_lane(None, key, fn, *args, **kwargs)
+
+    def submit_lane(self, lane, key, fn, *args, **kwargs):
+        """Schedule fn on the loop and return a concurrent.futures.Future for its result."""
+        return asyncio.run_coroutine_threadsafe(self._run(lane, key, fn, args, kwargs), self.loop)
+
+    async def _run(self, lane, key, fn, args, kwargs):
+        # Tasks start in submission order, so the tail is always the previous task of the key
+        previous = self._tails.get(key) if key is not None else None
+        current = asyncio.current_task()
+        if key is not None:
+            self._tails[key] = current
+        try:
+            if previous is not None:
+                # Its outcome is reported to its own caller
+                await asyncio.wait([previous])
+            await self._gate.acquire(lane)
+            try:
+                return await self._call(fn, args, kwargs)
+            finally:
+                self._gate.release()
+        finally:
+            if key is not None and self._tails.get(key) is current:
+                del self._tails[key]
+
+    async def _call(self, fn, args, kwargs):
+        if inspect.iscoroutinefunction(fn):
+            return await fn(*args, **kwargs)
+        result = await self.loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    def shutdown(self, wait=True):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def stats(self):
+        stats = self._gate.stats()
+        stats["keys"] = len(self._tails)
+        return stats
@@ -0,0 +1,318 @@
+import json
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict, namedtuple
+
+from kafka import ConsumerRebalanceListener
+from kafka.structs import OffsetAndMetadata
+
+from config.logconfig import get_logger
+from utils import heconstants
+from utils.metrics import RateMeter, registry, start_metrics_server
+
+logger = get_logger()
+
+MessageRecord = namedtuple("MessageRecord", ["partition", "record", "message"])
+
+
+def group_records(message_records):
+    """
+    Group decoded records by (state, care_req_id), keeping poll order inside each group and
+    the order in which groups were first seen.
+    """
+    groups = OrderedDict()
+    for message_record in message_records:
+        key = (message_record.message.get("state"), message_record.message.get("care_req_id"))
+        groups.setdefault(key, []).append(message_record)
+    return groups
+
+
+def latest_chunk(message_records):
+    """The message with the highest chunk_no, for handlers that re-read the whole conversation."""
+    return max(message_records, key=lambda item: item.message.get("chunk_no") or 0).message
+
+
+class OffsetTracker:
+    """
+    Per-partition bookkeeping of offsets handed to workers.
+
+    Work finishes out of order, so the committable position of a partition is one past the
+    highest offset below which everything has completed; a slow message holds the commit
+    back instead of being skipped on restart.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # partition -> OrderedDict(offset -> done), in offset order
+        self._in_flight = {}
+        self._committable = {}
+
+    def start(self, partition, offset):
+        with self._lock:
+            self._in_flight.setdefault(partition, OrderedDict())[offset] = False
+
+    def complete(self, partition, offset):
+        with self._lock:
+            offsets = self._in_flight.get(partition)
+            if offsets is None or offset not in offsets:
+                # The partition was revoked while this message was being processed
+                return
+            offsets[offset] = True
+            while offsets:
+                first, done = next(iter(offsets.items()))
+                if not done:
+                    break
+                offsets.popitem(last=False)
+                self._committable[partition] = first + 1
+
+    def in_flight(self, partition):
+        with self._lock:
+            return len(self._in_flight.get(partition, ()))
+
+    def total_in_flight(self):
+        with self._lock:
+            return sum(len(offsets) for offsets in self._in_flight.values())
+
+    def pop_committable(self, partitions=None):
+        """Return and forget {partition: next offset} for partitions with new progress."""
+        with self._lock:
+            ready = {partition: offset for partition, offset in self._committable.items()
+                     if partitions is None or partition in partitions}
+            for partition in ready:
+                del self._committable[partition]
+            return ready
+
+    def forget(self, partitions):
+        with self._lock:
+            for partition in partitions:
+                self._in_flight.pop(partition, None)
+                self._committable.pop(partition, None)
+
+
+class _RebalanceListener(ConsumerRebalanceListener):
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def on_partitions_revoked(self, revoked):
+        # Last chance to commit progress on partitions another instance is about to own
+        self.runtime.commit(partitions=set(revoked))
+        self.runtime.tracker.forget(revoked)
+        self.runtime.paused.difference_update(revoked)
+
+    def on_partitions_assigned(self, assigned):
+        pass
+
+
+class ConsumerRuntime:
+    """
+    Poll loop that commits offsets only after the work for them has finished.
+
+    handler(message_dict, record) is called on the polling thread for every decoded message
+    and returns None when the message is done, or the Future (or list of Futures) of the work
+    it scheduled. Alternatively batch_handler(groups) receives everything one poll returned,
+    grouped by (state, care_req_id) into lists of MessageRecord, and returns
+    {group key: result}; every record of a group is done when its result is.
+
+    Completed offsets are committed every COMMIT_INTERVAL_MS; a partition with
+    MAX_IN_FLIGHT_PER_PARTITION unfinished messages is paused until half of them drain, so a
+    burst cannot queue unbounded work in memory.
+
+    Consumer lag per partition, messages/sec by state, handler latency and the queue depth
+    of executor (anything with a stats() method) are reported under "consumer.<stage>" in the
+    metrics registry, served on METRICS_PORT while run() is active.
+    """
+
+    def __init__(self, kafka_service, handler=None, max_in_flight: int = None, commit_interval_ms: int = None,
+                 batch_handler=None, executor=None):
+        self.kafka_service = kafka_service
+        self.stage = kafka_service.group_id
+        self.executor = executor
+        self.rates = RateMeter()
+        self._lag = {}
+        self._last_lag_refresh = 0
+        self.consumer = kafka_service.post_consumer
+        self.handler = handler
+        self.batch_handler = batch_handler
+        self.max_in_flight = max_in_flight or heconstants.max_in_flight_per_partition
+        self.commit_interval = (commit_interval_ms or heconstants.commit_interval_ms) / 1000
+        self.tracker = OffsetTracker()
+        self.paused = set()
+        self._last_commit = time.time()
+        self._stopping = threading.Event()
+        self.consumer.subscribe(kafka_service.topics, listener=_RebalanceListener(self))
+        registry.register_collector(f"consumer.{self.stage}", self.stats)
+
+    def _received(self, message):
+        state = message.get("state")
+        self.rates.mark(state)
+        registry.inc("executor_messages_total", stage=self.stage, state=state)
+        return state
+
+    def _finished(self, partition, offset, state, started_at):
+        self.tracker.complete(partition, offset)
+        if state is not None:
+            registry.observe("executor_handler_latency_ms", (time.perf_counter() - started_at) * 1000,
+                             stage=self.stage, state=state)
+
+    def _track(self, partition, offset, result, state=None, started_at=None):
+        started_at = started_at or time.perf_counter()
+        if result is None:
+            self._finished(partition, offset, state, started_at)
+            return
+        futures = result if isinstance(result, (list, tuple)) else [result]
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                self._finished(partition, offset, state, started_at)
+
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def process_record(self, partition, record):
+        self.tracker.start(partition, record.offset)
+        started_at = time.perf_counter()
+        result, state = None, None
+        try:
+            value = record.value.decode('utf-8')
+            if value != '':
+                message = json.loads(value)
+                state = self._received(message)
+                result = self.handler(message, record)
+        except Exception as exc:
+            logger.error(f"Failed to dispatch :: {partition} :: {record.offset} :: {exc}")
+            logger.error(traceback.format_exc())
+        self._track(partition, record.offset, result, state, started_at)
+
+    def process_batch(self, batches):
+        started_at = time.perf_counter()
+        message_records = []
+        for partition, records in batches.items():
+            for record in records:
+                self.tracker.start(partition, record.offset)
+                try:
+                    value = record.value.decode('utf-8')
+                    if value != '':
+                        message = json.loads(value)
+                        self._received(message)
+                        message_records.append(MessageRecord(partition, record, message))
+                        continue
+                except Exception as exc:
+                    logger.error(f"Failed to decode :: {partition} :: {record.offset} :: {exc}")
+                self.tracker.complete(partition, record.offset)
+
+        groups = group_records(message_records)
+        results = {}
+        try:
+            results = self.batch_handler(groups) or {}
+        except Exception as exc:
+            logger.error(f"Failed to dispatch batch :: {exc}")
+            logger.error(traceback.format_exc())
+        for key, items in groups.items():
+            result = results.get(key)
+            for item in items:
+                self._track(item.partition, item.record.offset, result, key[0], started_at)
+
+    def apply_backpressure(self):
+        for partition in self.consumer.assignment():
+            in_flight = self.tracker.in_flight(partition)
+            if partition not in self.paused and in_flight >= self.max_in_flight:
+                self.consumer.pause(partition)
+                self.paused.add(partition)
+                logger.info(f"Paused {partition} :: {in_flight} in flight")
+            elif partition in self.paused and in_flight <= self.max_in_flight // 2:
+                self.consumer.resume(partition)
+                self.paused.discard(partition)
+                logger.info(f"Resumed {partition} :: {in_flight} in flight")
+
+    def commit(self, partitions=None):
+        offsets = self.tracker.pop_committable(partitions)
+        self._last_commit = time.time()
+        if not offsets:
+            return
+        try:
+            self.consumer.commit({partition: OffsetAndMetadata(offset, None)
+                                  for partition, offset in offsets.items()})
+        except Exception as exc:
+            logger.error(f"Offset commit failed :: {exc}")
+
+    def refresh_lag(self):
+        """
+        Lag is read on the polling thread (the consumer is not thread-safe) at most every
+        LAG_REFRESH_INTERVAL seconds and served from this copy.
+        """
+        if time.time() - self._last_lag_refresh < heconstants.lag_refresh_interval:
+            return
+        self._last_lag_refresh = time.time()
+        assignment = list(self.consumer.assignment())
+        if not assignment:
+            self._lag = {}
+            return
+        try:
+            end_offsets = self.consumer.end_offsets(assignment)
+            lag = {}
+            for partition in assignment:
+                position = self.consumer.position(partition)
+                lag[f"{partition.topic}:{partition.partition}"] = {
+                    "lag": max(0, end_offsets.get(partition, 0) - (position or 0)),
+                    "in_flight": self.tracker.in_flight(partition),
+                    "paused": partition in self.paused,
+                }
+            self._lag = lag
+        except Exception as exc:
+            logger.error(f"Failed to read consumer lag :: {exc}")
+
+    def stats(self):
+        stats = {
+            "stage": self.stage,
+            "lag": self._lag,
+            "total_lag": sum(partition["lag"] for partition in self._lag.values()),
+            "in_flight": self.tracker.total_in_flight(),
+            "messages_per_second": self.rates.rates(),
+        }
+        if self.executor is not None:
+            stats["queue"] = self.executor.stats()
+        return stats
+
+    def poll_once(self):
+        batches = self.consumer.poll(timeout_ms=int(heconstants.CONSUMER_POLL_TIMEOUT),
+                                     max_records=self.kafka_service.max_poll_records)
+        if self.batch_handler is not None:
+            self.process_batch(batches)
+        else:
+            for partition, records in batches.items():
+                for record in records:
+                    self.process_record(partition, record)
+        self.apply_backpressure()
+        self.refresh_lag()
+        if time.time() - self._last_commit >= self.commit_interval:
+            self.commit()
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            # Turn SIGTERM into a normal exit so completed offsets are committed and buffered
+            # messages (including trailing Completed events) are flushed before the process stops
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        start_metrics_server(heconstants.metrics_port)
+        try:
+            while not self._stopping.is_set():
+                try:
+                    self.poll_once()
+                except Exception as exc:
+                    logger.error(f"Executor polling failed :: {exc}")
+                    logger.error(traceback.format_exc())
+                    time.sleep(int(heconstants.KAFKA_SLEEP_TIME))
+        finally:
+            self.commit()
+            self.kafka_service.flush()
+
+    def stop(self):
+        """Make run() return after the current poll, committing what has completed."""
+        self._stopping.set()
@@ -0,0 +1,93 @@
+import inspect
+import threading
+from collections import OrderedDict
+
+from config.logconfig import get_logger
+from utils.metrics import registry
+
+logger = get_logger()
+
+
+class _ChunkState:
+    __slots__ = ("pending",)
+
+    def __init__(self):
+        # chunk_no of every run offered and not started yet
+        self.pending = []
+
+
+class ConversationDebouncer:
+    """
+    Skips work for a chunk while a run for a newer chunk of the same conversation is queued
+    behind it.
+
+    For stages that reprocess the whole conversation on every trigger (AiPred, Analytics)
+    the queued newer run reads everything this one would. Used together with KeyedExecutor,
+    a burst of triggers for one conversation collapses to the run already in progress plus
+    the newest one. A run is never skipped because a newer one already finished: that run
+    may have read the conversation before this chunk's input (a late ASR retry) was stored.
+    Messages without a chunk_no always run. State for the least recently seen keys is
+    dropped beyond max_keys.
+    """
+
+    def __init__(self, stage: str, max_keys: int = 10000):
+        self.stage = stage
+        self.max_keys = max_keys
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _state(self, key):
+        state = self._states.pop(key, None) or _ChunkState()
+        self._states[key] = state
+        while len(self._states) > self.max_keys:
+            self._states.popitem(last=False)
+        return state
+
+    def offer(self, key, chunk_no):
+        """Record that work for chunk_no was queued. Call on the polling thread."""
+        if chunk_no is None:
+            return
+        with self._lock:
+            self._state(key).pending.append(chunk_no)
+
+    def is_stale(self, key, chunk_no):
+        if chunk_no is None:
+            return False
+        with self._lock:
+            state = self._states.get(key)
+            return state is not None and any(pending > chunk_no for pending in state.pending)
+
+    def _skip(self, key, chunk_no):
+        if chunk_no is None:
+            return False
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return False
+            if chunk_no in state.pending:
+                state.pending.remove(chunk_no)
+            if not state.pending:
+                del self._states[key]
+            if not any(pending > chunk_no for pending in state.pending):
+                return False
+        registry.inc("debounce_skipped_total", stage=self.stage)
+        logger.info(f"Skipping stale {self.stage} :: {key} :: chunk {chunk_no}")
+        return True
+
+    def run(self, key, chunk_no, fn, *args, **kwargs):
+        """Run fn unless a run for a newer chunk is queued behind this one."""
+        if self._skip(key, chunk_no):
+            return None
+        return fn(*args, **kwargs)
+
+    async def run_async(self, key, chunk_no, fn, *args, **kwargs):
+        """run() for a coroutine function fn."""
+        if self._skip(key, chunk_no):
+            return None
+        return await fn(*args, **kwargs)
+
+    def submit(self, executor, key, chunk_no, fn, *args, lane=None, **kwargs):
+        """offer() and submit run() to a KeyedExecutor under the same key (and priority lane)."""
+        self.offer(key, chunk_no)
+        run = self.run_async if inspect.iscoroutinefunction(fn) else self.run
+        return executor.submit_lane(lane, key, run, key, chunk_no, fn, *args, **kwargs)
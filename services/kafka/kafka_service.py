@@ -1,12 +1,18 @@
+import atexit
 import json
 import logging
+import threading
 import time
 import traceback
+from typing import Optional
 
 from kafka import KafkaConsumer, KafkaProducer
 from config.logconfig import get_logger
 import multiprocessing
 from utils import heconstants
+from utils.metrics import registry
+from services.kafka.message_bus import create_message_bus, get_message_bus
+from services.kafka.lanes import LANES, message_lane
 
 logger = get_logger()
 # logger = logging.getLogger("Kafka")
@@ -14,18 +20,117 @@ logger = get_logger()
 
 max_poll_records = (multiprocessing.cpu_count() * 2) + 1
 
+# Consumer group (executor stage) that handles each message state
+STAGE_BY_STATE = {
+    "Init": "filedownloader",
+    "SpeechToText": "asr",
+    "AiPred": "aipreds",
+    "Analytics": "soap",
+    "Completed": "compaction",
+    "Failed": "failed",
+}
+
+
+RETRY_GROUP = "retry"
+
+
+def stage_topic(stage: str, lane: str = "live"):
+    # Live traffic keeps the plain stage topic; retry and backfill get their own partitions
+    topic = f"{heconstants.EXECUTOR_TOPIC}.{stage}"
+    return topic if lane == "live" else f"{topic}.{lane}"
+
+
+def retry_topic(delay_seconds: float):
+    return f"{heconstants.EXECUTOR_TOPIC}.retry.{delay_seconds:g}s"
+
+
+def topic_for_message(data: dict):
+    """
+    Topic a message is published to. In the per_stage and migration layouts each state has
+    its own topic per priority lane, so an executor only receives the messages it handles
+    and a retry backlog never sits in front of live chunks on the same partition.
+    """
+    stage = STAGE_BY_STATE.get(data.get("state"))
+    if heconstants.topic_layout == "single" or stage is None:
+        return heconstants.EXECUTOR_TOPIC
+    return stage_topic(stage, message_lane(data))
+
+
+def consumer_topics(group_id: str):
+    """
+    Topics a consumer group subscribes to. The migration layout also reads the shared topic
+    so messages published before the switch are still drained.
+    """
+    if group_id == RETRY_GROUP:
+        return [retry_topic(delay) for delay in heconstants.retry_delays]
+    if heconstants.topic_layout == "single" or group_id not in STAGE_BY_STATE.values():
+        return [heconstants.EXECUTOR_TOPIC]
+    lane_topics = [stage_topic(group_id, lane) for lane in LANES]
+    if heconstants.topic_layout == "migration":
+        return lane_topics + [heconstants.EXECUTOR_TOPIC]
+    return lane_topics
+
+
+_producer = None
+_producer_lock = threading.Lock()
+
+
+def get_producer():
+    """
+    Process-wide producer shared by every KafkaService. Sends are batched for up to
+    PRODUCER_LINGER_MS and compressed with PRODUCER_COMPRESSION; buffered messages are
+    flushed at interpreter exit.
+    """
+    global _producer
+    with _producer_lock:
+        if _producer is None and heconstants.message_bus != "kafka":
+            _producer = get_message_bus().producer(key_serializer=lambda x: x.encode('utf-8'),
+                                                   value_serializer=lambda x: json.dumps(x).encode('utf-8'))
+        if _producer is None:
+            _producer = KafkaProducer(bootstrap_servers=heconstants.BOOTSTRAP_SERVERS,
+                                      linger_ms=heconstants.producer_linger_ms,
+                                      batch_size=heconstants.producer_batch_size,
+                                      compression_type=heconstants.producer_compression,
+                                      # Keyed by care_req_id so a conversation's messages share a partition
+                                      key_serializer=lambda x: x.encode('utf-8'),
+                                      value_serializer=lambda x: json.dumps(x).encode('utf-8'))
+            atexit.register(flush_producer)
+        return _producer
+
+
+def flush_producer(timeout: Optional[float] = None):
+    if _producer is None:
+        return
+    try:
+        _producer.flush(timeout=timeout if timeout is not None else heconstants.producer_flush_timeout)
+    except Exception as exc:
+        logger.error(f"Producer flush failed :: {exc}")
+
 
 class KafkaService:
-    def __init__(self, group_id: str):
-        self.post_consumer = self.create_clients(group_id)
-        self.producer = KafkaProducer(bootstrap_servers=heconstants.BOOTSTRAP_SERVERS,
-                                      value_serializer=lambda x: x.encode('utf-8'))
+    def __init__(self, group_id: Optional[str] = None, message_bus: Optional[str] = None):
+        """
+        Without a group_id only the shared producer is used, so modules that just publish
+        do not join a consumer group. message_bus overrides MESSAGE_BUS for the consumer only.
+        """
+        self.group_id = group_id
+        self.message_bus = message_bus or heconstants.message_bus
+        self.topics = consumer_topics(group_id) if group_id else []
+        self.max_poll_records = int(max_poll_records)
+        self.post_consumer = self.create_clients(group_id) if group_id else None
+        self.producer = get_producer()
 
     def create_clients(self, group_id: str):
+        if self.message_bus != "kafka":
+            # In-process bus (MESSAGE_BUS=memory|sqlite): no broker to wait for
+            bus = get_message_bus() if self.message_bus == heconstants.message_bus \
+                else create_message_bus(self.message_bus)
+            return bus.consumer(*consumer_topics(group_id), group_id=group_id,
+                                              max_poll_records=int(max_poll_records))
         kafka_ping = False
         while kafka_ping == False:
             try:
-                consumer_post_message = KafkaConsumer(heconstants.EXECUTOR_TOPIC,
+                consumer_post_message = KafkaConsumer(*consumer_topics(group_id),
                                                       bootstrap_servers=heconstants.BOOTSTRAP_SERVERS,
                                                       group_id=group_id,
                                                       enable_auto_commit=False,
@@ -39,7 +144,7 @@ class KafkaService:
                 if not topic:
                     logger.info("Rechecking the topics")
                     time.sleep(int(heconstants.KAFKA_SLEEP_TIME))
-                    self.create_clients()
+                    self.create_clients(group_id)
                 else:
                     logger.info(f"{consumer_post_message} Health check completed. Connection successful")
                     kafka_ping = True
@@ -65,16 +170,36 @@ class KafkaService:
             return msg, 500
 
     def publish_executor_message(self, data):
+        return self.publish_to_topic(topic_for_message(data), data)
+
+    def publish_to_topic(self, topic, data):
         try:
-            self.producer.send(heconstants.EXECUTOR_TOPIC, value=json.dumps(data))
-            logger.info("Message sent")
+            key = data.get("care_req_id")
+            sent_at = time.perf_counter()
+            future = self.producer.send(topic, key=str(key) if key is not None else None, value=data)
+            future.add_callback(self._on_delivered, topic, data.get("state"), sent_at)
+            future.add_errback(self._on_failed, topic, data.get("state"), key)
+            logger.info(f"Message queued :: {topic}")
         except Exception as exc:
-            msg = "producer failed to push message in {} :: {}".format(heconstants.EXECUTOR_TOPIC, exc)
+            msg = "producer failed to push message in {} :: {}".format(topic, exc)
             logger.error(msg)
             trace = traceback.format_exc()
             # SentryUtilFunctions().send_event(exc, trace)
             return msg, 500
 
+    @staticmethod
+    def _on_delivered(topic, state, sent_at, metadata):
+        registry.observe("kafka_publish_latency_ms", (time.perf_counter() - sent_at) * 1000, topic=topic)
+        registry.inc("kafka_publish_total", topic=topic, state=state, status="ok")
+
+    @staticmethod
+    def _on_failed(topic, state, key, exc):
+        registry.inc("kafka_publish_total", topic=topic, state=state, status="error")
+        logger.error(f"Message delivery failed :: {topic} :: {state} :: {key} :: {exc}")
+
+    def flush(self, timeout: Optional[float] = None):
+        flush_producer(timeout)
+
 
 # if __name__ == "__main__":
 #     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -0,0 +1,76 @@
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+class KeyedExecutor:
+    """
+    Runs tasks on a shared executor while keeping tasks with the same key in submission order.
+
+    Messages are keyed by care_req_id, so all chunks of a conversation arrive on one partition
+    in order; this keeps them in order past the thread pool too. Different conversations still
+    run in parallel, and at most one worker is busy with a given conversation at a time.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        return self.submit_lane(None, key, fn, *args, **kwargs)
+
+    def submit_lane(self, lane, key, fn, *args, **kwargs):
+        """
+        Like submit, on a LaneExecutor priority lane. The lane applies when the key is idle;
+        tasks queued behind a running task of the same key keep the key's order.
+        """
+        if key is None:
+            # Unkeyed messages have no ordering to preserve
+            return self._submit_to_pool(lane, fn, *args, **kwargs)
+        future = Future()
+        with self._lock:
+            queue = self._queues.get(key)
+            start = queue is None
+            if start:
+                queue = self._queues[key] = deque()
+            queue.append((future, fn, args, kwargs))
+        if start:
+            self._submit_to_pool(lane, self._drain, key)
+        return future
+
+    def _submit_to_pool(self, lane, fn, *args, **kwargs):
+        if lane is not None and hasattr(self.executor, "submit_lane"):
+            return self.executor.submit_lane(lane, fn, *args, **kwargs)
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                future, fn, args, kwargs = queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    def pending_keys(self):
+        with self._lock:
+            return len(self._queues)
+
+    def stats(self):
+        with self._lock:
+            stats = {"keys": len(self._queues), "queued": sum(len(queue) for queue in self._queues.values())}
+        work_queue = getattr(self.executor, "_work_queue", None)
+        if hasattr(self.executor, "stats"):
+            # Tasks waiting for a worker, per priority lane
+            stats["pool_queue"] = self.executor.stats()
+        elif work_queue is not None:
+            # Tasks accepted by the thread pool but not yet picked up by a worker
+            stats["pool_queue"] = work_queue.qsize()
+        return stats
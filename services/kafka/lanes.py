@@ -0,0 +1,102 @@
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from config.logconfig import get_logger
+from utils import heconstants
+
+logger = get_logger()
+
+# Highest priority first
+LANES = ("live", "retry", "backfill")
+
+
+def message_lane(message: dict) -> str:
+    """
+    Priority lane of a message: its "priority" field when set, otherwise retry for
+    messages that carry a retry_count and live for everything else.
+    """
+    lane = message.get("priority") or ("retry" if message.get("retry_count") else "live")
+    return lane if lane in LANES else "live"
+
+
+def highest_lane(messages) -> str:
+    return min((message_lane(message) for message in messages), key=LANES.index, default="live")
+
+
+def pick_lane(ready, weights: dict, credits: dict) -> str:
+    """
+    Smooth weighted round robin: the next lane to serve among the ready ones. credits holds
+    the running per-lane balance between calls.
+    """
+    total = sum(weights.get(lane, 1) for lane in ready)
+    for lane in ready:
+        credits[lane] += weights.get(lane, 1)
+    chosen = max(ready, key=lambda lane: credits[lane])
+    credits[chosen] -= total
+    return chosen
+
+
+class LaneExecutor:
+    """
+    Thread pool with one queue per priority lane instead of a single FIFO.
+
+    Idle workers pick the next lane by smooth weighted round robin over the lanes that have
+    work (LANE_WEIGHTS, live:8,retry:2,backfill:1 by default), so a burst of retries or
+    backfill cannot delay live chunks by more than their share, and the lower lanes still
+    progress while live traffic is continuous.
+    """
+
+    def __init__(self, max_workers: int, weights: dict = None):
+        self.weights = weights or heconstants.lane_weights
+        self._queues = {lane: deque() for lane in LANES}
+        self._current = {lane: 0 for lane in LANES}
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._workers = [threading.Thread(target=self._work, name=f"lane-worker-{n}", daemon=True)
+                         for n in range(max_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_lane("live", fn, *args, **kwargs)
+
+    def submit_lane(self, lane, fn, *args, **kwargs):
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._queues[lane if lane in self._queues else "live"].append((future, fn, args, kwargs))
+            self._condition.notify()
+        return future
+
+    def _next_task(self):
+        ready = [lane for lane in LANES if self._queues[lane]]
+        return self._queues[pick_lane(ready, self.weights, self._current)].popleft()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._shutdown and not any(self._queues.values()):
+                    self._condition.wait()
+                if self._shutdown and not any(self._queues.values()):
+                    return
+                future, fn, args, kwargs = self._next_task()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    def shutdown(self, wait=True):
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def stats(self):
+        with self._condition:
+            return {lane: len(queue) for lane, queue in self._queues.items()}
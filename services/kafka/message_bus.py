@@ -0,0 +1,409 @@
+import abc
+import itertools
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+from typing import Optional
+
+from kafka.structs import TopicPartition
+
+from utils import heconstants
+
+BusRecord = namedtuple("BusRecord", ["topic", "partition", "offset", "timestamp", "key", "value"])
+RecordMetadata = namedtuple("RecordMetadata", ["topic", "partition", "offset", "timestamp"])
+
+
+class MessageLog(abc.ABC):
+    """
+    Append-only per-partition message storage plus committed offsets per consumer group.
+    Records below every group's committed offset are dropped with truncate(); offsets of
+    the remaining records do not change.
+    """
+
+    @abc.abstractmethod
+    def append(self, topic, partition, key, value, timestamp) -> int:
+        ...
+
+    @abc.abstractmethod
+    def read(self, topic, partition, offset, max_records):
+        """Return [(offset, timestamp, key, value)] starting at offset."""
+
+    @abc.abstractmethod
+    def topics(self):
+        ...
+
+    @abc.abstractmethod
+    def end_offset(self, topic, partition) -> int:
+        ...
+
+    @abc.abstractmethod
+    def commit(self, group_id, topic, partition, offset):
+        ...
+
+    @abc.abstractmethod
+    def committed(self, group_id, topic, partition) -> Optional[int]:
+        ...
+
+    @abc.abstractmethod
+    def commits(self, topic, partition) -> dict:
+        """Return {group_id: committed offset} for every group that committed on the partition."""
+
+    @abc.abstractmethod
+    def truncate(self, topic, partition, offset):
+        """Drop the records below offset."""
+
+
+class InMemoryLog(MessageLog):
+    def __init__(self):
+        self._partitions = {}
+        # Offset of the first record still held, per partition
+        self._base_offsets = {}
+        self._offsets = {}
+
+    def append(self, topic, partition, key, value, timestamp):
+        messages = self._partitions.setdefault((topic, partition), [])
+        offset = self._base_offsets.get((topic, partition), 0) + len(messages)
+        messages.append((offset, timestamp, key, value))
+        return offset
+
+    def read(self, topic, partition, offset, max_records):
+        start = max(0, offset - self._base_offsets.get((topic, partition), 0))
+        return self._partitions.get((topic, partition), [])[start:start + max_records]
+
+    def topics(self):
+        return {topic for topic, _ in self._partitions}
+
+    def end_offset(self, topic, partition):
+        return self._base_offsets.get((topic, partition), 0) + len(self._partitions.get((topic, partition), []))
+
+    def commit(self, group_id, topic, partition, offset):
+        self._offsets[(group_id, topic, partition)] = offset
+
+    def committed(self, group_id, topic, partition):
+        return self._offsets.get((group_id, topic, partition))
+
+    def commits(self, topic, partition):
+        return {group_id: offset for (group_id, group_topic, group_partition), offset in self._offsets.items()
+                if group_topic == topic and group_partition == partition}
+
+    def truncate(self, topic, partition, offset):
+        messages = self._partitions.get((topic, partition))
+        if not messages:
+            return
+        base = self._base_offsets.get((topic, partition), 0)
+        drop = min(offset - base, len(messages))
+        if drop > 0:
+            del messages[:drop]
+            self._base_offsets[(topic, partition)] = base + drop
+
+
+class SQLiteLog(MessageLog):
+    """
+    File-backed log, so a single-box deployment keeps queued messages and committed offsets
+    across restarts. Callers serialise access through the bus lock.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS messages (topic TEXT, partition INTEGER, offset INTEGER, "
+                         "timestamp REAL, key BLOB, value BLOB, PRIMARY KEY (topic, partition, offset))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS offsets (group_id TEXT, topic TEXT, partition INTEGER, "
+                         "offset INTEGER, PRIMARY KEY (group_id, topic, partition))")
+        # A fully truncated partition has no rows left, but its committed offsets still mark its end
+        self._next_offsets = {}
+        for topic, partition, next_offset in itertools.chain(
+                self._db.execute("SELECT topic, partition, MAX(offset) + 1 FROM messages GROUP BY topic, partition"),
+                self._db.execute("SELECT topic, partition, MAX(offset) FROM offsets GROUP BY topic, partition")):
+            self._next_offsets[(topic, partition)] = max(self._next_offsets.get((topic, partition), 0), next_offset)
+
+    def append(self, topic, partition, key, value, timestamp):
+        offset = self._next_offsets.get((topic, partition), 0)
+        self._db.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                         (topic, partition, offset, timestamp, key, value))
+        self._next_offsets[(topic, partition)] = offset + 1
+        return offset
+
+    def read(self, topic, partition, offset, max_records):
+        return self._db.execute("SELECT offset, timestamp, key, value FROM messages "
+                                "WHERE topic = ? AND partition = ? AND offset >= ? ORDER BY offset LIMIT ?",
+                                (topic, partition, offset, max_records)).fetchall()
+
+    def topics(self):
+        return {topic for topic, _ in self._next_offsets}
+
+    def end_offset(self, topic, partition):
+        return self._next_offsets.get((topic, partition), 0)
+
+    def commit(self, group_id, topic, partition, offset):
+        self._db.execute("INSERT OR REPLACE INTO offsets VALUES (?, ?, ?, ?)", (group_id, topic, partition, offset))
+
+    def committed(self, group_id, topic, partition):
+        row = self._db.execute("SELECT offset FROM offsets WHERE group_id = ? AND topic = ? AND partition = ?",
+                               (group_id, topic, partition)).fetchone()
+        return row[0] if row else None
+
+    def commits(self, topic, partition):
+        return dict(self._db.execute("SELECT group_id, offset FROM offsets WHERE topic = ? AND partition = ?",
+                                     (topic, partition)))
+
+    def truncate(self, topic, partition, offset):
+        self._db.execute("DELETE FROM messages WHERE topic = ? AND partition = ? AND offset < ?",
+                         (topic, partition, offset))
+
+
+class _DeliveredFuture:
+    """Already-completed stand-in for kafka-python's FutureRecordMetadata."""
+
+    def __init__(self, metadata):
+        self.value = metadata
+
+    def add_callback(self, fn, *args, **kwargs):
+        fn(*args, self.value, **kwargs)
+        return self
+
+    def add_errback(self, fn, *args, **kwargs):
+        return self
+
+    def get(self, timeout=None):
+        return self.value
+
+
+class BusProducer:
+    """The subset of KafkaProducer that KafkaService uses."""
+
+    def __init__(self, bus, key_serializer=None, value_serializer=None, **_):
+        self._bus = bus
+        self._key_serializer = key_serializer
+        self._value_serializer = value_serializer
+
+    def send(self, topic, value=None, key=None):
+        if key is not None and self._key_serializer:
+            key = self._key_serializer(key)
+        if self._value_serializer:
+            value = self._value_serializer(value)
+        return _DeliveredFuture(self._bus.publish(topic, key, value))
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
+
+
+class BusConsumer:
+    """
+    The subset of KafkaConsumer that KafkaService, ConsumerRuntime and the legacy
+    `for record in consumer` loops use. Starts from the earliest offset when the group has
+    not committed one, since in-process consumers may subscribe after the first publish.
+    """
+
+    def __init__(self, bus, *topics, group_id=None, max_poll_records=500, **_):
+        self._bus = bus
+        self.group_id = group_id
+        self.max_poll_records = max_poll_records
+        self.subscription = set()
+        self._listener = None
+        self._assignment = set()
+        self._pending_assignment = None
+        self._positions = {}
+        self._paused = set()
+        self._buffer = []
+        if topics:
+            self.subscribe(topics)
+
+    def subscribe(self, topics, listener=None):
+        self._listener = listener
+        self.subscription = set(topics)
+        self._bus.join(self)
+
+    def _apply_assignment(self):
+        with self._bus.lock:
+            assignment, self._pending_assignment = self._pending_assignment, None
+        if assignment is None:
+            return
+        revoked = self._assignment - assignment
+        added = assignment - self._assignment
+        if revoked and self._listener:
+            self._listener.on_partitions_revoked(revoked)
+        for partition in revoked:
+            self._positions.pop(partition, None)
+            self._paused.discard(partition)
+        for partition in added:
+            committed = self.committed(partition)
+            self._positions[partition] = committed if committed is not None else 0
+        self._assignment = assignment
+        if added and self._listener:
+            self._listener.on_partitions_assigned(added)
+
+    def poll(self, timeout_ms=0, max_records=None):
+        max_records = max_records or self.max_poll_records
+        deadline = time.time() + timeout_ms / 1000
+        while True:
+            self._apply_assignment()
+            with self._bus.lock:
+                batches = {}
+                for partition in sorted(self._assignment - self._paused):
+                    if max_records <= 0:
+                        break
+                    rows = self._bus.log.read(partition.topic, partition.partition,
+                                              self._positions[partition], max_records)
+                    if rows:
+                        batches[partition] = [BusRecord(partition.topic, partition.partition, offset,
+                                                        timestamp, key, value)
+                                              for offset, timestamp, key, value in rows]
+                        self._positions[partition] = rows[-1][0] + 1
+                        max_records -= len(rows)
+                remaining = deadline - time.time()
+                if batches or remaining <= 0:
+                    return batches
+                self._bus.lock.wait(remaining)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._buffer:
+            for records in self.poll(timeout_ms=1000).values():
+                self._buffer.extend(records)
+        return self._buffer.pop(0)
+
+    def commit(self, offsets=None):
+        if offsets is None:
+            offsets = {partition: position for partition, position in self._positions.items()}
+        with self._bus.lock:
+            for partition, offset in offsets.items():
+                self._bus.log.commit(self.group_id, partition.topic, partition.partition,
+                                     getattr(offset, "offset", offset))
+                self._bus.trim(partition.topic, partition.partition)
+
+    def committed(self, partition):
+        with self._bus.lock:
+            return self._bus.log.committed(self.group_id, partition.topic, partition.partition)
+
+    def assignment(self):
+        return set(self._assignment)
+
+    def position(self, partition):
+        return self._positions.get(partition)
+
+    def end_offsets(self, partitions):
+        with self._bus.lock:
+            return {partition: self._bus.log.end_offset(partition.topic, partition.partition)
+                    for partition in partitions}
+
+    def pause(self, *partitions):
+        self._paused.update(partitions)
+
+    def resume(self, *partitions):
+        self._paused.difference_update(partitions)
+
+    def paused(self):
+        return set(self._paused)
+
+    def topics(self):
+        with self._bus.lock:
+            return self._bus.log.topics() | self.subscription
+
+    def close(self, autocommit=True):
+        self._bus.leave(self)
+
+
+class MessageBus:
+    """
+    Broker-free replacement for Kafka inside one process: keyed messages are hashed onto
+    BUS_PARTITIONS partitions per topic, and the partitions of each topic are spread over
+    the members of a consumer group that subscribe to it, with committed offsets kept per
+    group.
+    """
+
+    def __init__(self, log: MessageLog, partitions: int = 4):
+        self.log = log
+        self.partitions = partitions
+        self.lock = threading.Condition()
+        self._groups = {}
+        self._round_robin = itertools.count()
+
+    def partition_for(self, key):
+        if key is None:
+            return next(self._round_robin) % self.partitions
+        return zlib.crc32(key) % self.partitions
+
+    def publish(self, topic, key, value):
+        partition = self.partition_for(key)
+        timestamp = time.time()
+        with self.lock:
+            offset = self.log.append(topic, partition, key, value, timestamp)
+            self.lock.notify_all()
+        return RecordMetadata(topic, partition, offset, timestamp)
+
+    def trim(self, topic, partition):
+        """
+        Drop the records of a partition that every consumer group has committed past. Nothing
+        is dropped while a group subscribed to the topic has not committed on the partition yet,
+        since it starts from the earliest record. Called with the lock held.
+        """
+        commits = self.log.commits(topic, partition)
+        subscribed = {group_id for group_id, members in self._groups.items()
+                      if any(topic in member.subscription for member in members)}
+        if commits and subscribed <= commits.keys():
+            self.log.truncate(topic, partition, min(commits.values()))
+
+    def join(self, consumer):
+        with self.lock:
+            members = self._groups.setdefault(consumer.group_id, [])
+            if consumer not in members:
+                members.append(consumer)
+            self._rebalance(consumer.group_id)
+
+    def leave(self, consumer):
+        with self.lock:
+            members = self._groups.get(consumer.group_id, [])
+            if consumer in members:
+                members.remove(consumer)
+                self._rebalance(consumer.group_id)
+
+    def _rebalance(self, group_id):
+        members = self._groups.get(group_id, [])
+        assignments = {id(member): set() for member in members}
+        topics = sorted(set().union(*(member.subscription for member in members))) if members else []
+        for topic in topics:
+            subscribers = [member for member in members if topic in member.subscription]
+            for partition in range(self.partitions):
+                member = subscribers[partition % len(subscribers)]
+                assignments[id(member)].add(TopicPartition(topic, partition))
+        for member in members:
+            member._pending_assignment = assignments[id(member)]
+        self.lock.notify_all()
+
+    def producer(self, **config):
+        return BusProducer(self, **config)
+
+    def consumer(self, *topics, **config):
+        return BusConsumer(self, *topics, **config)
+
+
+_default_bus = None
+_default_bus_lock = threading.Lock()
+
+
+def create_message_bus(name: Optional[str] = None) -> MessageBus:
+    name = (name or heconstants.message_bus).lower()
+    if name == "memory":
+        return MessageBus(InMemoryLog(), partitions=heconstants.bus_partitions)
+    if name == "sqlite":
+        return MessageBus(SQLiteLog(heconstants.bus_sqlite_path), partitions=heconstants.bus_partitions)
+    raise ValueError(f"Unknown message bus: {name}")
+
+
+def get_message_bus() -> MessageBus:
+    """Process-wide bus selected by the MESSAGE_BUS setting (memory or sqlite)."""
+    global _default_bus
+    if _default_bus is None:
+        with _default_bus_lock:
+            if _default_bus is None:
+                _default_bus = create_message_bus()
+    return _default_bus
@@ -0,0 +1,156 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from botocore.exceptions import BotoCoreError, ClientError
+from openai import error as openai_error
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from config.logconfig import get_logger
+from services.kafka.kafka_service import retry_topic, topic_for_message
+from utils import heconstants
+from utils.metrics import registry
+
+logger = get_logger()
+
+# Failures that may pass on a later attempt: the network, S3, the AI server or OpenAI being
+# unavailable or throttling. Anything else (bad audio, a transcript too short to extract
+# from, unparsable answers) fails the same way every time.
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    asyncio.TimeoutError,
+    requests.RequestException,
+    BotoCoreError,
+    ClientError,
+    openai_error.APIError,
+    openai_error.APIConnectionError,
+    openai_error.RateLimitError,
+    openai_error.ServiceUnavailableError,
+    openai_error.Timeout,
+    openai_error.TryAgain,
+) + ((aiohttp.ClientError,) if aiohttp is not None else ())
+
+
+def _http_status(exc: BaseException):
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code
+    if aiohttp is not None and isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status
+    return None
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Whether retrying the work that raised exc could succeed."""
+    status = _http_status(exc)
+    # The AI server rejecting the request (4xx other than throttling) will reject it again
+    if status is not None and 400 <= status < 500 and status != 429:
+        return False
+    return isinstance(exc, TRANSIENT_ERRORS)
+
+
+def retry_delay(attempt: int) -> float:
+    """Delay tier for the given attempt (1-based); attempts past the last tier reuse it."""
+    delays = heconstants.retry_delays
+    return delays[min(attempt, len(delays)) - 1]
+
+
+def schedule_retry(producer, message: dict, reason: str):
+    """
+    Hand a failed stage message to the retry executor instead of republishing it straight
+    away. The message goes to the delay tier for its attempt with retry_count incremented,
+    and re-enters its stage topic once the (jittered) delay has passed. After
+    RETRY_MAX_ATTEMPTS it is published as Failed instead.
+    """
+    attempt = (message.get("retry_count") or 0) + 1
+    state = message.get("state")
+    # Backfill stays backfill; everything else comes back on the retry lane
+    retry_message = dict(message, retry_count=attempt, retry_reason=reason,
+                         priority="backfill" if message.get("priority") == "backfill" else "retry")
+    if attempt > heconstants.retry_max_attempts:
+        registry.inc("retry_exhausted_total", state=state)
+        logger.error(f"Retries exhausted :: {state} :: {message.get('care_req_id')} :: "
+                     f"chunk {message.get('chunk_no')} :: {reason}")
+        retry_message.update(state="Failed", failed_state=state)
+        producer.publish_executor_message(retry_message)
+        return
+
+    delay = retry_delay(attempt)
+    jitter = 1 + random.uniform(-heconstants.retry_jitter, heconstants.retry_jitter)
+    retry_message["retry_due_at"] = time.time() + delay * jitter
+    registry.inc("retry_scheduled_total", state=state, delay=f"{delay:g}s")
+    logger.info(f"Scheduling retry {attempt} in {delay:g}s :: {state} :: {message.get('care_req_id')} :: "
+                f"chunk {message.get('chunk_no')} :: {reason}")
+    producer.publish_to_topic(retry_topic(delay), retry_message)
+
+
+def schedule_recheck(producer, message: dict, delay: float, reason: str):
+    """
+    Send a stage message back to its stage after delay seconds, for work that is waiting on
+    another stage rather than failing. Goes through the retry executor like schedule_retry
+    but does not count an attempt, so it never ends up Failed.
+    """
+    tier = min(heconstants.retry_delays, key=lambda tier_delay: abs(tier_delay - delay))
+    registry.inc("retry_recheck_total", state=message.get("state"))
+    logger.info(f"Rechecking in {delay:g}s :: {message.get('state')} :: {message.get('care_req_id')} :: {reason}")
+    producer.publish_to_topic(retry_topic(tier), dict(message, retry_due_at=time.time() + delay))
+
+
+class DelayScheduler:
+    """
+    Runs callables at a wall-clock time from one background thread, so waiting retries
+    hold a heap entry rather than a sleeping worker thread each.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, name="retry-scheduler", daemon=True).start()
+
+    def schedule(self, due_at: float, fn, *args) -> Future:
+        future = Future()
+        with self._condition:
+            heapq.heappush(self._heap, (due_at, next(self._counter), future, fn, args))
+            self._condition.notify()
+        return future
+
+    def pending(self):
+        with self._condition:
+            return len(self._heap)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "pending": len(self._heap),
+                "next_due_in": max(0.0, self._heap[0][0] - time.time()) if self._heap else None,
+            }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._condition.wait(timeout=self._heap[0][0] - time.time() if self._heap else None)
+                _, _, future, fn, args = heapq.heappop(self._heap)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+
+def republish(producer, message: dict):
+    """Send a retry whose delay has passed back to the topic of its stage."""
+    message = dict(message)
+    message.pop("retry_due_at", None)
+    producer.publish_to_topic(topic_for_message(message), message)
@@ -14,7 +14,7 @@ from typing import Optional
 
 logger = get_logger()
 logger.setLevel(logging.INFO)
-s3 = S3SERVICE()
+s3 = S3SERVICE(stage="sync_api")
 
 
 def get_merge_ai_preds(conversation_id, only_transcribe: Optional[bool] = False):
@@ -57,8 +57,10 @@ def get_merge_ai_preds(conversation_id, only_transcribe: Optional[bool] = False)
         response_json = {}
         ai_preds_file_path = f"{conversation_id}/ai_preds.json"
 
-        conversation_datas = s3.get_files_matching_pattern(
-            pattern=f"{conversation_id}/{conversation_id}_*json")
+        # One listing tells us which chunks and artifacts exist, and their ETags let cached
+        # objects be served without a request
+        snapshot = s3.get_conversation_snapshot(conversation_id)
+        conversation_datas, compacted = s3.load_conversation(conversation_id, snapshot=snapshot)
 
         if conversation_datas:
             audio_metas = []
@@ -75,19 +77,26 @@ def get_merge_ai_preds(conversation_id, only_transcribe: Optional[bool] = False)
                 response_json["segments"] = merged_segments
 
             if not only_transcribe:
-                if s3.check_file_exists(ai_preds_file_path):
-                    merged_ai_preds = s3.get_json_file(ai_preds_file_path)
-                    for summary_type in ["subjectiveClinicalSummary", "objectiveClinicalSummary", "clinicalAssessment",
-                                         "carePlanSuggested"]:
-                        summary_file = f"{conversation_id}/{summary_type}.json"
-                        if s3.check_file_exists(summary_file):
-                            summary_content = s3.get_json_file(s3_filename=summary_file)
-                            if summary_content:
-                                merged_ai_preds["summaries"][summary_type] = summary_content
-
-                    response_json["ai_preds"] = merged_ai_preds
+                if ai_preds_file_path in snapshot:
+                    summary_files = {
+                        summary_type: f"{conversation_id}/{summary_type}.json"
+                        for summary_type in ["subjectiveClinicalSummary", "objectiveClinicalSummary",
+                                             "clinicalAssessment", "carePlanSuggested"]
+                    }
+                    keys = [ai_preds_file_path] + [key for key in summary_files.values() if key in snapshot]
+                    artifacts, _ = s3.get_json_files_map(keys, etags=snapshot)
+                    if artifacts.get(ai_preds_file_path):
+                        merged_ai_preds = artifacts[ai_preds_file_path]
+                    for summary_type, summary_file in summary_files.items():
+                        summary_content = artifacts.get(summary_file)
+                        if summary_content:
+                            merged_ai_preds["summaries"][summary_type] = summary_content
+
+                    if ai_preds_file_path in artifacts:
+                        response_json["ai_preds"] = merged_ai_preds
 
             response_json["meta"] = audio_metas
+            response_json["compacted"] = compacted
             response_json["success"] = True
 
             if merged_segments:
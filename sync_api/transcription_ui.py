@@ -2,21 +2,25 @@ import streamlit as st
 import requests
 from utils import heconstants
 from utils.s3_operation import S3SERVICE
+from utils.conversation_catalog import ConversationCatalog
 
 
 def main():
     # Define the API endpoint URL
     api_url = heconstants.SYNC_SERVER + "/history"
 
-    s3 = S3SERVICE()
+    s3 = S3SERVICE(stage="transcription_ui")
+    catalog = ConversationCatalog(s3)
 
     # Function to fetch filenames from the API
     def fetch_filenames():
-        dirs = s3.get_dirs_matching_pattern(pattern="carereq*")
-        if dirs:
-            return dirs
-        else:
-            return []
+        conversation_ids = list(catalog.iter_conversation_ids())
+        if catalog.is_backfilled():
+            return conversation_ids
+        # Until the one-time backfill has run, older conversations are only found by listing the bucket
+        cataloged = set(conversation_ids)
+        dirs = s3.get_dirs_matching_pattern(pattern="carereq*") or []
+        return conversation_ids + [d for d in dirs if d not in cataloged]
 
     # Streamlit UI
     st.title("Transcripts")
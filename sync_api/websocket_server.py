@@ -19,8 +19,8 @@ from utils.s3_operation import S3SERVICE
 from services.kafka.kafka_service import KafkaService
 from datetime import datetime
 
-s3 = S3SERVICE()
-producer = KafkaService(group_id="soap")
+s3 = S3SERVICE(stage="websocket")
+producer = KafkaService()
 logger = get_logger()
 logger.setLevel(logging.INFO)
 
@@ -230,6 +230,7 @@ def websocket_handler(env, start_response):
                     logger.info(f"current_stage: {current_stage}, is_rtmp_done: {is_rtmp_done}")
                     current_stream_key_info["stage"] = "finished"
                     s3.upload_to_s3(s3_filename=key, data=current_stream_key_info, is_json=True)
+                    s3.flush_deferred(f"{connection_id}/All_Preds.json")
                     logger.info(f"finished AI rtmp: {connection_id}")
                     push_logs(care_request_id=connection_id,
                               given_msg=f"finished AI rtmp: {connection_id}",
@@ -265,7 +266,7 @@ def websocket_handler(env, start_response):
                                 latest_ai_preds_resp["uid"] = uid
                                 ws.send(json.dumps(latest_ai_preds_resp))
                                 merged_json_key = f"{connection_id}/All_Preds.json"
-                                s3.upload_to_s3(merged_json_key, latest_ai_preds_resp, is_json=True)
+                                s3.upload_to_s3_deferred(merged_json_key, latest_ai_preds_resp, is_json=True)
                                 # with Timeout(2, False):  # Set the timeout to 2 seconds
                                 #     message = ws.receive()
                                 #     logger.info(f"ack :: {message}")
@@ -298,6 +299,8 @@ def websocket_handler(env, start_response):
                         ws.close()
                         break
 
+        s3.flush_deferred(f"{connection_id}/All_Preds.json")
+
 
 if __name__ == "__main__":
     # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -92,7 +92,7 @@ def post_message(stream_key, start_time):
     #     "end_time": str(datetime.utcnow()),
     # }
 
-    KafkaService(group_id="asr").publish_executor_message(data)
+    KafkaService().publish_executor_message(data)
     print("posted")
 
 
@@ -0,0 +1,17 @@
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# heconstants reads its settings at import, so point it at a local secrets file first
+if not os.getenv("SECRETS_FILE"):
+    secrets = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump({"MESSAGE_BUS": "memory", "STORAGE_BACKEND": "memory", "QUICK_LOOP_CHUNK_DURATION": "5",
+               "CHUNK_DURATION": "5", "METRICS_LOG_INTERVAL": "0"}, secrets)
+    secrets.close()
+    os.environ["SECRETS_FILE"] = secrets.name
+os.environ.setdefault("ENVIRONMENT", "test")
@@ -0,0 +1,49 @@
+import asyncio
+import threading
+
+import pytest
+
+from utils.async_io import IOCall, blocking, run_steps, run_steps_async
+
+
+def fetch(name):
+    if name == "missing":
+        raise KeyError(name)
+    return f"{name} on {threading.current_thread().name}"
+
+
+async def fetch_async(name):
+    if name == "missing":
+        raise KeyError(name)
+    return f"{name} awaited"
+
+
+def first_found(names):
+    """Falls back through names like the OpenAI model lists, returning the first result."""
+    errors = []
+    for name in names:
+        try:
+            return (yield IOCall(fetch, fetch_async, name))
+        except KeyError as exc:
+            errors.append(exc)
+    raise errors[-1]
+
+
+def test_run_steps_makes_calls_on_this_thread_and_throws_errors_back_in():
+    assert run_steps(first_found(["missing", "a", "b"])) == f"a on {threading.current_thread().name}"
+    with pytest.raises(KeyError):
+        run_steps(first_found(["missing"]))
+
+
+def test_run_steps_async_awaits_the_async_form():
+    assert asyncio.run(run_steps_async(first_found(["missing", "a"]))) == "a awaited"
+    with pytest.raises(KeyError):
+        asyncio.run(run_steps_async(first_found(["missing"])))
+
+
+def test_blocking_calls_run_on_a_thread_under_asyncio():
+    def steps():
+        return (yield blocking(threading.current_thread))
+
+    assert asyncio.run(run_steps_async(steps())) is not threading.main_thread()
+    assert run_steps(steps()) is threading.current_thread()
@@ -0,0 +1,51 @@
+import asyncio
+
+from services.kafka.debouncer import ConversationDebouncer
+
+
+def offer_and_run(debouncer, chunks, ran):
+    for chunk_no in chunks:
+        debouncer.offer("c1", chunk_no)
+    for chunk_no in chunks:
+        debouncer.run("c1", chunk_no, ran.append, chunk_no)
+
+
+def test_runs_queued_behind_a_newer_chunk_are_skipped():
+    debouncer = ConversationDebouncer(stage="aipreds")
+    ran = []
+    offer_and_run(debouncer, [1, 2, 3], ran)
+    assert ran == [3]
+
+
+def test_late_retry_runs_after_a_newer_chunk_finished():
+    debouncer = ConversationDebouncer(stage="aipreds")
+    ran = []
+    offer_and_run(debouncer, [1, 2, 4, 5], ran)
+    # ASR for chunk 3 succeeded on retry after AiPred for chunk 5 already read the conversation
+    offer_and_run(debouncer, [3], ran)
+    assert ran == [5, 3]
+
+
+def test_messages_without_chunk_no_always_run():
+    debouncer = ConversationDebouncer(stage="soap")
+    ran = []
+    debouncer.offer("c1", 2)
+    debouncer.run("c1", None, ran.append, None)
+    assert ran == [None]
+
+
+def test_run_async_skips_like_run():
+    debouncer = ConversationDebouncer(stage="soap")
+    ran = []
+
+    async def record(chunk_no):
+        ran.append(chunk_no)
+
+    async def main():
+        for chunk_no in (1, 2):
+            debouncer.offer("c1", chunk_no)
+        for chunk_no in (1, 2):
+            await debouncer.run_async("c1", chunk_no, record, chunk_no)
+
+    asyncio.run(main())
+    assert ran == [2]
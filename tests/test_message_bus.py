@@ -0,0 +1,63 @@
+import pytest
+
+from services.kafka.message_bus import InMemoryLog, MessageBus, SQLiteLog
+
+
+def drain(consumer):
+    while True:
+        batches = consumer.poll(timeout_ms=0)
+        if not batches:
+            return
+        consumer.commit()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def bus(request, tmp_path):
+    log = InMemoryLog() if request.param == "memory" else SQLiteLog(str(tmp_path / "bus.db"))
+    return MessageBus(log, partitions=2)
+
+
+def held(bus, topic):
+    return sum(len(bus.log.read(topic, partition, 0, 1000)) for partition in range(bus.partitions))
+
+
+def test_records_are_dropped_once_every_group_committed(bus):
+    stages = [bus.consumer("executor", group_id=group_id) for group_id in ("asr", "aipreds", "soap")]
+    producer = bus.producer()
+    for n in range(20):
+        producer.send("executor", value=b"chunk", key=f"conversation{n % 3}".encode())
+
+    drain(stages[0])
+    drain(stages[1])
+    assert held(bus, "executor") == 20
+
+    drain(stages[2])
+    assert held(bus, "executor") == 0
+    assert sum(bus.log.end_offset("executor", partition) for partition in range(bus.partitions)) == 20
+
+
+def test_group_that_never_polls_holds_the_log(bus):
+    active = bus.consumer("executor", group_id="asr")
+    bus.consumer("executor", group_id="idle")
+    bus.producer().send("executor", value=b"chunk", key=b"conversation")
+
+    drain(active)
+    assert held(bus, "executor") == 1
+
+
+def test_publish_only_service_does_not_join_the_bus(monkeypatch):
+    from services.kafka import kafka_service
+    from utils import heconstants
+
+    memory_bus = MessageBus(InMemoryLog(), partitions=2)
+    monkeypatch.setattr(heconstants, "message_bus", "memory")
+    monkeypatch.setattr(kafka_service, "get_message_bus", lambda: memory_bus)
+    monkeypatch.setattr(kafka_service, "_producer", None)
+
+    producer = kafka_service.KafkaService()
+    consumer = memory_bus.consumer("executor", group_id="asr")
+    producer.publish_to_topic("executor", {"care_req_id": "conversation", "state": "SpeechToText"})
+
+    drain(consumer)
+    assert memory_bus._groups.keys() == {"asr"}
+    assert held(memory_bus, "executor") == 0
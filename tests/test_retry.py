@@ -0,0 +1,21 @@
+import pytest
+import requests
+
+from services.kafka.retry import is_transient
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} from the AI server", response=response)
+
+
+@pytest.mark.parametrize("status_code, transient", [(500, True), (503, True), (429, True), (400, False),
+                                                    (422, False)])
+def test_ai_server_status_decides_whether_to_retry(status_code, transient):
+    assert is_transient(http_error(status_code)) is transient
+
+
+def test_connection_errors_are_retried_and_bad_input_is_not():
+    assert is_transient(requests.ConnectionError("reset"))
+    assert not is_transient(KeyError("prediction"))
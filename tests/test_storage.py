@@ -0,0 +1,76 @@
+import os
+
+from utils.storage import META_DIR, InMemoryBackend, LocalFilesystemBackend, TieredBackend
+
+
+class CountingBackend(InMemoryBackend):
+    def __init__(self):
+        super().__init__()
+        self.listings = 0
+
+    def iter_objects(self, bucket, prefix):
+        self.listings += 1
+        return super().iter_objects(bucket, prefix)
+
+
+def test_tiered_lists_each_prefix_from_the_durable_backend_once():
+    durable = CountingBackend()
+    durable.put_object("asr", "c1/c1_chunk1.json", b"{}")
+    tiered = TieredBackend(durable, max_bytes=1 << 20, persist_workers=1)
+
+    assert [key for key, _ in tiered.iter_objects("asr", "c1/")] == ["c1/c1_chunk1.json"]
+    etag = tiered.put_object("asr", "c1/c1_chunk2.json", b"{\"chunk\": 2}")
+    assert dict(tiered.iter_objects("asr", "c1/")) == {"c1/c1_chunk1.json": durable.get_object(
+        "asr", "c1/c1_chunk1.json").etag, "c1/c1_chunk2.json": etag}
+    assert [key for key, _ in tiered.iter_objects("asr", "c1/c1_chunk2")] == ["c1/c1_chunk2.json"]
+    assert durable.listings == 1
+
+
+def test_tiered_lists_again_after_dropping_a_prefix_from_the_index():
+    durable = CountingBackend()
+    tiered = TieredBackend(durable, max_bytes=1 << 20, persist_workers=1, max_index_keys=2)
+    tiered.put_object("asr", "c1/c1_chunk1.json", b"1")
+    assert len(list(tiered.iter_objects("asr", "c1/"))) == 1
+    assert tiered.flush(timeout=5)
+
+    tiered.put_object("asr", "c2/c2_chunk1.json", b"1")
+    tiered.put_object("asr", "c2/c2_chunk2.json", b"2")
+    listings = durable.listings
+    assert [key for key, _ in tiered.iter_objects("asr", "c1/")] == ["c1/c1_chunk1.json"]
+    assert durable.listings == listings + 1
+
+
+def test_tiered_index_keeps_unpersisted_keys():
+    durable = CountingBackend()
+    tiered = TieredBackend(durable, max_bytes=1 << 20, persist_workers=0, max_index_keys=1)
+    tiered.put_object("asr", "c1/c1_chunk1.json", b"1")
+    tiered.put_object("asr", "c2/c2_chunk1.json", b"1")
+    assert [key for key, _ in tiered.iter_objects("asr", "c1/")] == ["c1/c1_chunk1.json"]
+
+
+def test_local_etag_follows_the_body_when_the_sidecar_is_behind(tmp_path):
+    backend = LocalFilesystemBackend(str(tmp_path))
+    backend.put_object("asr", "c1/c1_chunk1.json", b"1")
+    meta_path = os.path.join(str(tmp_path), META_DIR, "asr", "c1", "c1_chunk1.json.json")
+    with open(meta_path) as file:
+        old_meta = file.read()
+    etag = backend.put_object("asr", "c1/c1_chunk1.json", b"22")
+    # As seen by a reader between the body and sidecar writes of the second put
+    with open(meta_path, "w") as file:
+        file.write(old_meta)
+
+    stored = backend.get_object("asr", "c1/c1_chunk1.json")
+    assert (stored.etag, stored.body.read()) == (etag, b"22")
+    assert list(backend.iter_objects("asr", "c1/")) == [("c1/c1_chunk1.json", None)]
+
+
+def test_local_listing_is_limited_to_the_prefix(tmp_path):
+    backend = LocalFilesystemBackend(str(tmp_path))
+    for key in ("c1/c1_chunk1.json", "c1/c1_chunk2.json", "c2/c2_chunk1.json", "c10.json"):
+        backend.put_object("asr", key, b"{}")
+
+    assert [key for key, _ in backend.iter_objects("asr", "c1/")] == ["c1/c1_chunk1.json", "c1/c1_chunk2.json"]
+    assert [key for key, _ in backend.iter_objects("asr", "c1/c1_chunk2")] == ["c1/c1_chunk2.json"]
+    assert [key for key, _ in backend.iter_objects("asr", "c1")] == ["c1/c1_chunk1.json", "c1/c1_chunk2.json",
+                                                                    "c10.json"]
+    assert list(backend.iter_objects("asr", "missing/")) == []
@@ -0,0 +1,198 @@
+"""
+Awaitable versions of the blocking calls the executors make, for AsyncExecutorHost.
+
+Worker logic is written once as a generator that yields an IOCall for every call that
+blocks. run_steps makes each call on the current thread and run_steps_async awaits it, so
+the two runtimes share everything but the I/O.
+
+aiohttp (installed with openai) and aiobotocore are used when importable; without them
+each call runs the sync library on the loop's default thread pool via asyncio.to_thread.
+aiobotocore is not in requirements.txt: its releases pin botocore to versions other than
+the one boto3 is pinned to here. As shipped, S3 is therefore thread-offloaded only, and
+ASYNC_THREAD_WORKERS bounds concurrent S3 calls. Needs Python 3.9+ (asyncio.to_thread).
+"""
+import asyncio
+
+import openai
+import requests
+
+from config.logconfig import get_logger
+from utils import heconstants
+from utils.metrics import registry
+from utils.storage import ObjectNotFound
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from aiobotocore.session import get_session as get_aiobotocore_session
+except ImportError:
+    get_aiobotocore_session = None
+
+logger = get_logger()
+
+# One HTTP session and S3 client per event loop, so connections are pooled across requests
+_http_sessions = {}
+_s3_clients = {}
+
+
+def _http_session():
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=heconstants.async_http_connections))
+        _http_sessions[loop] = session
+    return session
+
+
+async def post_json(url, json=None, files=None):
+    """
+    POST json or multipart files ({field: file-like}) and return the decoded JSON response,
+    like requests.post(url, json=json, files=files).json(). An error status raises instead,
+    as requests' HTTPError or aiohttp's ClientResponseError.
+    """
+    if aiohttp is None:
+        return await asyncio.to_thread(_post_json, url, json, files)
+    data = None
+    if files:
+        data = aiohttp.FormData()
+        for field, file in files.items():
+            data.add_field(field, file.read(), filename=getattr(file, "name", None) or field)
+    async with _http_session().post(url, json=json if data is None else None, data=data) as response:
+        response.raise_for_status()
+        return await response.json(content_type=None)
+
+
+def _post_json(url, json, files):
+    response = requests.post(url, json=json, files=files)
+    response.raise_for_status()
+    return response.json()
+
+
+async def chat_completion(**kwargs):
+    """openai.ChatCompletion.create without holding a thread while OpenAI responds."""
+    if aiohttp is None:
+        return await asyncio.to_thread(openai.ChatCompletion.create, **kwargs)
+    # Scoped to the current task, so concurrent requests share the loop's connection pool
+    openai.aiosession.set(_http_session())
+    return await openai.ChatCompletion.acreate(**kwargs)
+
+
+async def _s3_client():
+    loop = asyncio.get_running_loop()
+    client = _s3_clients.get(loop)
+    if client is None:
+        context = get_aiobotocore_session().create_client(
+            's3', aws_access_key_id=heconstants.AWS_ACCESS_KEY,
+            aws_secret_access_key=heconstants.AWS_SECRET_ACCESS_KEY)
+        client = await context.__aenter__()
+        _s3_clients[loop] = client
+    return client
+
+
+class AsyncStorage:
+    """
+    Awaitable S3SERVICE. Every method runs the S3SERVICE call with asyncio.to_thread, so the
+    object cache, manifest locks and write-behind buffer behave as they do for the thread
+    executors. get_audio_buffer instead streams the object with aiobotocore when it is
+    installed (it is not a requirement) and STORAGE_BACKEND is s3.
+    """
+
+    def __init__(self, s3service):
+        self.s3 = s3service
+
+    def __getattr__(self, name):
+        method = getattr(self.s3, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+
+        return call
+
+    async def get_audio_buffer(self, s3_filename, bucket_name=None, allocate=None):
+        if get_aiobotocore_session is None or heconstants.storage_backend != "s3":
+            return await asyncio.to_thread(self.s3.get_audio_buffer, s3_filename, bucket_name=bucket_name,
+                                           allocate=allocate)
+        bucket_name = bucket_name or self.s3.default_bucket
+        client = await _s3_client()
+        with registry.timer("storage_get_object", bucket=bucket_name, stage=self.s3.stage) as labels:
+            try:
+                response = await client.get_object(Bucket=bucket_name, Key=s3_filename)
+            except client.exceptions.NoSuchKey:
+                labels["status"] = "not_found"
+                raise ObjectNotFound(s3_filename)
+            size = response["ContentLength"]
+            view = allocate(size) if allocate is not None else memoryview(bytearray(size))
+            position = 0
+            async with response["Body"] as body:
+                while position < size:
+                    data = await body.read(min(1024 * 1024, size - position))
+                    if not data:
+                        break
+                    view[position:position + len(data)] = data
+                    position += len(data)
+            if position < size:
+                raise IOError(f"Incomplete read: got {position} of {size} bytes")
+        return view
+
+
+class IOCall:
+    """One blocking call of a step generator; async_fn is its awaitable form, if it has one."""
+
+    __slots__ = ("fn", "async_fn", "args", "kwargs")
+
+    def __init__(self, fn, async_fn, *args, **kwargs):
+        self.fn = fn
+        self.async_fn = async_fn
+        self.args = args
+        self.kwargs = kwargs
+
+
+def blocking(fn, *args, **kwargs) -> IOCall:
+    """A call with no awaitable form; run_steps_async makes it with asyncio.to_thread."""
+    return IOCall(fn, None, *args, **kwargs)
+
+
+def chat_completion_call(**kwargs) -> IOCall:
+    return IOCall(openai.ChatCompletion.create, chat_completion, **kwargs)
+
+
+def post_json_call(url, json=None, files=None) -> IOCall:
+    return IOCall(_post_json, post_json, url, json, files)
+
+
+def run_steps(steps):
+    """
+    Run a step generator on this thread: make each IOCall it yields, send back the result or
+    throw in the exception, and return what the generator returns.
+    """
+    result, error = None, None
+    while True:
+        try:
+            call = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = call.fn(*call.args, **call.kwargs), None
+        except Exception as exc:
+            result, error = None, exc
+
+
+async def run_steps_async(steps):
+    """run_steps for AsyncExecutorHost: each IOCall is awaited, or run on a thread."""
+    result, error = None, None
+    while True:
+        try:
+            call = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            if call.async_fn is not None:
+                result = await call.async_fn(*call.args, **call.kwargs)
+            else:
+                result = await asyncio.to_thread(call.fn, *call.args, **call.kwargs)
+            error = None
+        except Exception as exc:
+            result, error = None, exc
@@ -0,0 +1,21 @@
+"""
+Functions run inside the audio process pool. They only take picklable arguments and use
+no config or service clients, so they behave the same in a forked or a spawned process.
+"""
+from multiprocessing import shared_memory
+
+from pydub import AudioSegment
+
+from utils.stream_io import BufferReader
+
+
+def decode_duration_shared(shm_name: str, size: int, audio_format: str) -> float:
+    shm = shared_memory.SharedMemory(name=shm_name)
+    view = shm.buf[:size]
+    try:
+        audio = AudioSegment.from_file(BufferReader(view), format=audio_format)
+        return len(audio) / 1000.0
+    finally:
+        audio = None
+        view.release()
+        shm.close()
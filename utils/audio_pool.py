@@ -0,0 +1,131 @@
+import asyncio
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+from pydub import AudioSegment
+
+from config.logconfig import get_logger
+from utils import heconstants
+from utils.audio_decode import decode_duration_shared
+from utils.metrics import registry
+from utils.stream_io import BufferReader
+
+logger = get_logger()
+
+
+class SharedAudio:
+    """
+    Audio bytes held in a shared memory block, so a decode process attaches to them by name
+    instead of receiving a pickled copy. Pass allocate to S3SERVICE.get_audio_buffer to
+    download straight into the block, and close() once the audio is no longer needed.
+    """
+
+    def __init__(self):
+        self.shm = None
+        self.size = 0
+        self._view = None
+
+    def allocate(self, size: int) -> memoryview:
+        # A zero-length block cannot be created; the view still has the real size
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.size = size
+        self._view = self.shm.buf[:size]
+        return self._view
+
+    def close(self):
+        if self.shm is None:
+            return
+        shm, self.shm = self.shm, None
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        try:
+            shm.close()
+        except BufferError:
+            # A reader still holds a view; the mapping goes when that view is collected
+            logger.info(f"Shared audio {shm.name} still referenced at close")
+        shm.unlink()
+
+
+def decode_duration(audio, audio_format: str = "wav") -> float:
+    """
+    Duration in seconds of audio, a SharedAudio or a file-like object. SharedAudio is
+    decoded in the audio process pool when AUDIO_DECODE_WORKERS > 0; anything else, or a
+    disabled pool, is decoded on the calling thread.
+    """
+    pool = get_audio_pool()
+    with registry.timer("audio_decode", mode="process" if pool and isinstance(audio, SharedAudio) else "thread"):
+        if pool is not None and isinstance(audio, SharedAudio):
+            return pool.submit(decode_duration_shared, audio.shm.name, audio.size, audio_format).result()
+        if isinstance(audio, SharedAudio):
+            audio = BufferReader(audio.shm.buf[:audio.size])
+        return len(AudioSegment.from_file(audio, format=audio_format)) / 1000.0
+
+
+async def decode_duration_async(audio, audio_format: str = "wav") -> float:
+    """decode_duration for AsyncExecutorHost: awaits the pool process instead of blocking."""
+    pool = get_audio_pool()
+    if pool is None or not isinstance(audio, SharedAudio):
+        return await asyncio.to_thread(decode_duration, audio, audio_format)
+    with registry.timer("audio_decode", mode="process"):
+        return await asyncio.wrap_future(pool.submit(decode_duration_shared, audio.shm.name, audio.size,
+                                                     audio_format))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _create_pool(preforked: bool) -> ProcessPoolExecutor:
+    if preforked:
+        context = multiprocessing.get_context("fork")
+        # Workers share this tracker with the executor instead of starting their own, so a
+        # shared block the executor unlinks is not reported as leaked by a worker's tracker
+        resource_tracker.ensure_running()
+    elif "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["utils.audio_decode"])
+    else:
+        context = multiprocessing.get_context("spawn")
+    pool = ProcessPoolExecutor(max_workers=heconstants.audio_decode_workers, mp_context=context)
+    if preforked:
+        # A forking pool starts every worker on its first submit, so none is forked later
+        pool.submit(int).result()
+    atexit.register(pool.shutdown, wait=False)
+    return pool
+
+
+def start_audio_pool():
+    """
+    Start the audio pool now. Executors that decode audio call this before they import
+    anything that starts threads, so the workers are forked from a single-threaded process
+    and inherit its imports. Forking once other threads run can copy a lock one of them
+    holds into the child; a pool started after that point is created as in get_audio_pool.
+    """
+    global _pool
+    if heconstants.audio_decode_workers <= 0:
+        return
+    with _pool_lock:
+        if _pool is None:
+            preforked = threading.active_count() == 1 and "fork" in multiprocessing.get_all_start_methods()
+            _pool = _create_pool(preforked)
+
+
+def get_audio_pool():
+    """
+    Process-wide pool for CPU-bound audio work, sized by AUDIO_DECODE_WORKERS (default one
+    process per core), or None when disabled. Pool processes only run functions from
+    utils.audio_decode. Unless start_audio_pool ran first, the pool is created here, in a
+    process that is already multithreaded, so its workers come from a forkserver (or are
+    spawned) and import the executor's main module again at start.
+    """
+    global _pool
+    if heconstants.audio_decode_workers <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = _create_pool(preforked=False)
+        return _pool
@@ -0,0 +1,122 @@
+import time
+from typing import Optional
+
+from utils.s3_operation import S3SERVICE
+
+CATALOG_PREFIX = "_catalog/conversations/"
+# Written once every conversation stored before the catalog existed has an entry
+BACKFILL_MARKER = "_catalog/backfill.json"
+# Keys sort ascending in S3 listings, so newest-first ordering stores the start time inverted
+MAX_EPOCH = 9999999999
+
+
+def _inverted(epoch_seconds: int) -> str:
+    return f"{MAX_EPOCH - int(epoch_seconds):010d}"
+
+
+def _conversation_id(entry_key: str) -> str:
+    return entry_key[len(CATALOG_PREFIX):-len(".json")].split("__", 1)[1]
+
+
+def _start_time_from_id(conversation_id: str) -> int:
+    # Conversation ids carry their creation time as the third "__" field, as sort_dirs_by_time assumes
+    try:
+        timestamp = int(conversation_id.split("__")[2])
+    except (IndexError, ValueError):
+        return 0
+    return timestamp // 1000 if timestamp > MAX_EPOCH else timestamp
+
+
+class ConversationCatalog:
+    """
+    Maintained index of conversations, one small object per conversation.
+
+    Entries live under _catalog/conversations/<inverted start time>__<conversation_id>.json,
+    so a plain prefix listing returns conversations newest first and a time range maps
+    onto a contiguous key range.
+    """
+
+    def __init__(self, s3: Optional[S3SERVICE] = None):
+        self.s3 = s3 or S3SERVICE()
+
+    def entry_key(self, conversation_id, start_time):
+        return f"{CATALOG_PREFIX}{_inverted(start_time)}__{conversation_id}.json"
+
+    def record(self, conversation_id, start_time, stage, chunk_count: int = 0, duration: float = 0.0):
+        """
+        Create or update the catalog entry for a conversation. start_time is epoch seconds and
+        must be the same value on every update so the entry keeps its key.
+        """
+        data = {
+            "conversation_id": conversation_id,
+            "start_time": int(start_time),
+            "stage": stage,
+            "chunk_count": chunk_count,
+            "duration": duration,
+            "updated_at": time.time(),
+        }
+        self.s3.upload_to_s3(self.entry_key(conversation_id, start_time), data, is_json=True)
+        return data
+
+    def query(self, page_size: int = 50, page_token: Optional[str] = None, since: Optional[float] = None,
+              until: Optional[float] = None, bucket_name: Optional[str] = None):
+        """
+        Return (entries, next_page_token), newest first.
+
+        since/until bound the conversation start time (epoch seconds, inclusive). Pass the
+        returned token back as page_token to fetch the next page; it is None on the last page.
+        """
+        start_after = page_token
+        if start_after is None and until is not None:
+            # Everything that started after `until` sorts before this key
+            start_after = f"{CATALOG_PREFIX}{_inverted(until + 1)}~"
+        stop_at = f"{CATALOG_PREFIX}{_inverted(since)}~" if since is not None else None
+
+        keys, next_token = self.s3.list_keys_page(CATALOG_PREFIX, page_size, start_after=start_after,
+                                                  bucket_name=bucket_name)
+        if stop_at is not None:
+            in_range = [key for key in keys if key <= stop_at]
+            if len(in_range) < len(keys):
+                next_token = None
+            keys = in_range
+
+        entries_by_key, _ = self.s3.get_json_files_map(keys, bucket_name=bucket_name)
+        entries = [entries_by_key[key] for key in keys if entries_by_key.get(key)]
+        return entries, next_token
+
+    def list_conversation_ids(self, **query_args):
+        entries, _ = self.query(**query_args)
+        return [entry["conversation_id"] for entry in entries]
+
+    def iter_conversation_ids(self, page_size: int = 1000, bucket_name: Optional[str] = None):
+        """Yield every cataloged conversation id, newest first, read from the entry keys alone."""
+        page_token = None
+        while True:
+            keys, page_token = self.s3.list_keys_page(CATALOG_PREFIX, page_size, start_after=page_token,
+                                                      bucket_name=bucket_name)
+            for key in keys:
+                yield _conversation_id(key)
+            if page_token is None:
+                return
+
+    def is_backfilled(self):
+        return self.s3.check_file_exists(BACKFILL_MARKER)
+
+    def backfill(self, pattern: str = "carereq*"):
+        """
+        Add entries for conversations stored before the catalog existed, found with a directory
+        listing of the bucket, then write the marker that lets readers skip that listing.
+        Safe to rerun; conversations already cataloged keep their entry.
+        """
+        cataloged = set(self.iter_conversation_ids())
+        added = 0
+        for conversation_id in self.s3.get_dirs_matching_pattern(pattern=pattern) or []:
+            if conversation_id not in cataloged:
+                self.record(conversation_id, _start_time_from_id(conversation_id), stage="backfilled")
+                added += 1
+        self.s3.upload_to_s3(BACKFILL_MARKER, {"completed_at": time.time(), "added": added}, is_json=True)
+        return added
+
+
+if __name__ == "__main__":
+    print(f"Backfilled {ConversationCatalog().backfill()} conversations")
@@ -5,14 +5,20 @@ import boto3
 from botocore.exceptions import ClientError
 from elasticsearch import Elasticsearch
 
-AWS_ACCESS_KEY = os.environ["AWS_ACCESS_KEY"]
-AWS_SECRET_ACCESS_KEY = os.environ["AWS_SECRET_ACCESS_KEY"]
+# Local secrets file (same JSON as the secrets manager entry) for deployments without AWS
+SECRETS_FILE = os.getenv("SECRETS_FILE")
+AWS_ACCESS_KEY = os.environ["AWS_ACCESS_KEY"] if not SECRETS_FILE else os.getenv("AWS_ACCESS_KEY")
+AWS_SECRET_ACCESS_KEY = os.environ["AWS_SECRET_ACCESS_KEY"] if not SECRETS_FILE else os.getenv("AWS_SECRET_ACCESS_KEY")
 env = os.environ["ENVIRONMENT"]
 
 logger = logging.getLogger("heconstants")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
 def get_secret():
+    if SECRETS_FILE:
+        with open(SECRETS_FILE) as secrets_file:
+            return secrets_file.read()
+
     secret_name = f"{env}/healiom"
     region_name = "us-east-2"
 
@@ -165,4 +171,49 @@ chunk_duration = int(secret_values.get('CHUNK_DURATION'))
 es_host = secret_values.get('ES_HOST')
 es_user = secret_values.get('ES_USER')
 es_pass = secret_values.get('ES_PASS')
-
+s3_max_workers = int(secret_values.get('S3_MAX_WORKERS', 16))
+s3_cache_max_bytes = int(secret_values.get('S3_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+compact_segments = str(secret_values.get('COMPACT_SEGMENTS', 'false')).lower() == 'true'
+gzip_json = str(secret_values.get('GZIP_JSON', 'false')).lower() == 'true'
+storage_backend = secret_values.get('STORAGE_BACKEND', 's3')
+local_storage_root = secret_values.get('LOCAL_STORAGE_ROOT', 'storage')
+# STORAGE_BACKEND=tiered: memory tier persisted asynchronously to this backend
+tiered_durable_backend = secret_values.get('TIERED_DURABLE_BACKEND', 's3')
+tiered_memory_max_bytes = int(secret_values.get('TIERED_MEMORY_MAX_BYTES', 256 * 1024 * 1024))
+tiered_persist_workers = int(secret_values.get('TIERED_PERSIST_WORKERS', 2))
+tiered_flush_timeout = float(secret_values.get('TIERED_FLUSH_TIMEOUT', 30))
+# Keys the tiered backend keeps listed in memory before re-listing least recently used prefixes
+tiered_index_max_keys = int(secret_values.get('TIERED_INDEX_MAX_KEYS', 100000))
+service_stage = os.getenv("SERVICE_STAGE", "unknown")
+metrics_log_interval = float(secret_values.get('METRICS_LOG_INTERVAL', 60))
+compaction_max_wait = float(secret_values.get('COMPACTION_MAX_WAIT', 300))
+compaction_poll_interval = float(secret_values.get('COMPACTION_POLL_INTERVAL', 5))
+write_behind_window = float(secret_values.get('WRITE_BEHIND_WINDOW', 2))
+# single: everything on EXECUTOR_TOPIC; per_stage: one topic per state; migration: publish per stage, consume both
+topic_layout = secret_values.get('TOPIC_LAYOUT', 'single')
+max_in_flight_per_partition = int(secret_values.get('MAX_IN_FLIGHT_PER_PARTITION', 64))
+commit_interval_ms = int(secret_values.get('COMMIT_INTERVAL_MS', 5000))
+producer_linger_ms = int(secret_values.get('PRODUCER_LINGER_MS', 5))
+producer_batch_size = int(secret_values.get('PRODUCER_BATCH_SIZE', 64 * 1024))
+producer_compression = secret_values.get('PRODUCER_COMPRESSION', 'lz4') or None
+producer_flush_timeout = float(secret_values.get('PRODUCER_FLUSH_TIMEOUT', 10))
+retry_delays = [float(delay) for delay in str(secret_values.get('RETRY_DELAYS', '1,10,60')).split(',')]
+retry_max_attempts = int(secret_values.get('RETRY_MAX_ATTEMPTS', 3))
+retry_jitter = float(secret_values.get('RETRY_JITTER', 0.2))
+# kafka, or memory / sqlite to run the executors without a broker
+message_bus = secret_values.get('MESSAGE_BUS', 'kafka')
+bus_partitions = int(secret_values.get('BUS_PARTITIONS', 4))
+bus_sqlite_path = secret_values.get('BUS_SQLITE_PATH', 'message_bus.sqlite3')
+metrics_port = int(secret_values.get('METRICS_PORT', 9100))
+lag_refresh_interval = float(secret_values.get('LAG_REFRESH_INTERVAL', 10))
+lane_weights = {lane: int(weight) for lane, weight in (
+    item.split(':') for item in str(secret_values.get('LANE_WEIGHTS', 'live:8,retry:2,backfill:1')).split(','))}
+# Bus the single-process pipeline reads new streams (Init) from; stage hand-offs stay in process
+pipeline_ingress_bus = secret_values.get('PIPELINE_INGRESS_BUS', 'kafka')
+# Processes for CPU-bound audio decoding in ASR; 0 decodes on the worker thread
+audio_decode_workers = int(secret_values.get('AUDIO_DECODE_WORKERS', os.cpu_count() or 1))
+# threads, or asyncio to run the ASR, AiPred and SOAP executors on an event loop
+executor_runtime = secret_values.get('EXECUTOR_RUNTIME', 'threads')
+async_max_in_flight = int(secret_values.get('ASYNC_MAX_IN_FLIGHT', 1000))
+async_thread_workers = int(secret_values.get('ASYNC_THREAD_WORKERS', 32))
+async_http_connections = int(secret_values.get('ASYNC_HTTP_CONNECTIONS', 100))
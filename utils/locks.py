@@ -0,0 +1,15 @@
+import threading
+
+
+class LockStripes:
+    """
+    A fixed set of locks shared out by key hash, for serialising work per key without
+    keeping a lock for every key ever seen. Keys that share a stripe also wait on each
+    other, so never hold one stripe while taking another.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def __getitem__(self, key) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
@@ -0,0 +1,239 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config.logconfig import get_logger
+
+logger = get_logger()
+
+# Upper bounds in milliseconds; the last bucket catches everything slower
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """
+        Approximate percentile: the upper bound of the bucket holding the q-th observation,
+        capped at the largest value seen.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": (self.total / self.count) if self.count else 0.0,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+class RateMeter:
+    """Events per second per key over a sliding window, kept as one bucket per second."""
+
+    def __init__(self, window_seconds: int = 60):
+        self.window_seconds = window_seconds
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def mark(self, key, count=1):
+        second = int(time.time())
+        with self._lock:
+            buckets = self._buckets.setdefault(key, deque())
+            if buckets and buckets[-1][0] == second:
+                buckets[-1][1] += count
+            else:
+                buckets.append([second, count])
+
+    def rates(self):
+        horizon = int(time.time()) - self.window_seconds
+        with self._lock:
+            rates = {}
+            for key, buckets in self._buckets.items():
+                while buckets and buckets[0][0] <= horizon:
+                    buckets.popleft()
+                rates[key] = sum(count for _, count in buckets) / self.window_seconds
+            return rates
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and latency histograms keyed by metric name plus labels.
+
+    Per-conversation call counts are kept separately in a bounded LRU so that attributing
+    calls to a care_req_id cannot grow the label space without limit.
+    """
+
+    def __init__(self, max_conversations: int = 1000):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._conversations = OrderedDict()
+        self._collectors = {}
+        self.max_conversations = max_conversations
+
+    def register_collector(self, name, collect):
+        """
+        Add a callable whose return value is reported under name in every snapshot,
+        for gauges that are cheaper to read on demand than to push.
+        """
+        with self._lock:
+            self._collectors[name] = collect
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def count_conversation(self, care_req_id, operation):
+        if not care_req_id:
+            return
+        with self._lock:
+            calls = self._conversations.pop(care_req_id, None) or {}
+            calls[operation] = calls.get(operation, 0) + 1
+            self._conversations[care_req_id] = calls
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+
+    def conversation_calls(self, care_req_id):
+        with self._lock:
+            return dict(self._conversations.get(care_req_id, {}))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Time the block in milliseconds into <name>_latency_ms and count it in <name>_total
+        with a status label of ok or error.
+        """
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield labels
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            status = labels.pop("status", status)
+            self.observe(f"{name}_latency_ms", (time.perf_counter() - start) * 1000, **labels)
+            self.inc(f"{name}_total", status=status, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                "counters": [dict(name=name, value=value, **dict(labels))
+                             for (name, labels), value in sorted(self._counters.items())],
+                "histograms": [dict(name=name, **dict(labels), **histogram.summary())
+                               for (name, labels), histogram in sorted(self._histograms.items())],
+            }
+            collectors = list(self._collectors.items())
+        for name, collect in collectors:
+            try:
+                snapshot[name] = collect()
+            except Exception as exc:
+                snapshot[name] = {"error": str(exc)}
+        return snapshot
+
+
+registry = MetricsRegistry()
+
+_periodic_log_started = False
+_periodic_log_lock = threading.Lock()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = json.dumps(registry.snapshot()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server = None
+
+
+def start_metrics_server(port: int):
+    """
+    Serve the registry snapshot as JSON on GET /metrics from a daemon thread. A port of 0
+    disables it; a port that is already taken is logged and skipped.
+    """
+    global _metrics_server
+    if not port or _metrics_server is not None:
+        return _metrics_server
+    try:
+        _metrics_server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    except OSError as exc:
+        logger.error(f"Metrics server not started on port {port} :: {exc}")
+        return None
+    threading.Thread(target=_metrics_server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Metrics served on :{port}/metrics")
+    return _metrics_server
+
+
+def start_periodic_log(interval_seconds: float):
+    """
+    Log a JSON snapshot of the registry every interval_seconds from a daemon thread.
+    Safe to call more than once; only the first call starts the thread.
+    """
+    global _periodic_log_started
+    if not interval_seconds or interval_seconds <= 0:
+        return
+    with _periodic_log_lock:
+        if _periodic_log_started:
+            return
+        _periodic_log_started = True
+
+    def log_loop():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                logger.info(f"metrics :: {json.dumps(registry.snapshot())}")
+            except Exception as exc:
+                logger.error(f"Failed to log metrics :: {exc}")
+
+    threading.Thread(target=log_loop, name="metrics-log", daemon=True).start()
@@ -0,0 +1,107 @@
+import gzip
+import json
+
+try:
+    import msgpack
+except ImportError:  # compact payloads fall back to columnar JSON
+    msgpack = None
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/x-msgpack"
+GZIP_CONTENT_ENCODING = "gzip"
+COLUMNAR_SEGMENTS_KEY = "segments_columnar"
+
+
+def segments_to_columns(segments):
+    """
+    Convert a list of segment dicts into {"fields": [...], "columns": [[...], ...]}.
+
+    Returns None when the segments do not all share the same keys, in which case the
+    rows are stored unchanged.
+    """
+    if not segments or not all(isinstance(segment, dict) for segment in segments):
+        return None
+    fields = list(segments[0].keys())
+    if any(list(segment.keys()) != fields for segment in segments):
+        return None
+    return {
+        "fields": fields,
+        "columns": [[segment[field] for segment in segments] for field in fields],
+    }
+
+
+def columns_to_segments(columnar):
+    fields = columnar["fields"]
+    return [dict(zip(fields, row)) for row in zip(*columnar["columns"])]
+
+
+def _compact_chunk(chunk_data):
+    if not isinstance(chunk_data, dict):
+        return chunk_data
+    columnar = segments_to_columns(chunk_data.get("segments"))
+    if columnar is None:
+        return chunk_data
+    compacted = {k: v for k, v in chunk_data.items() if k != "segments"}
+    compacted[COLUMNAR_SEGMENTS_KEY] = columnar
+    return compacted
+
+
+def _expand_chunk(chunk_data):
+    if not isinstance(chunk_data, dict) or COLUMNAR_SEGMENTS_KEY not in chunk_data:
+        return chunk_data
+    expanded = {k: v for k, v in chunk_data.items() if k != COLUMNAR_SEGMENTS_KEY}
+    expanded["segments"] = columns_to_segments(chunk_data[COLUMNAR_SEGMENTS_KEY])
+    return expanded
+
+
+def compact_document(data):
+    """
+    Store the segments of a chunk result, or of every chunk in a manifest, column-wise.
+    """
+    if isinstance(data, dict) and isinstance(data.get("chunks"), dict):
+        compacted = dict(data)
+        compacted["chunks"] = {k: _compact_chunk(v) for k, v in data["chunks"].items()}
+        return compacted
+    return _compact_chunk(data)
+
+
+def expand_document(data):
+    if isinstance(data, dict) and isinstance(data.get("chunks"), dict):
+        data["chunks"] = {k: _expand_chunk(v) for k, v in data["chunks"].items()}
+        return data
+    return _expand_chunk(data)
+
+
+def encode_payload(data, compact: bool = False, compress: bool = False):
+    """
+    Serialise data for upload and return (body, content_type, content_encoding).
+
+    Compact payloads use the columnar segment layout, packed with msgpack when it is installed.
+    Compressed payloads are gzipped and carry a gzip Content-Encoding.
+    """
+    if not compact:
+        body, content_type = json.dumps(data).encode('utf-8'), JSON_CONTENT_TYPE
+    else:
+        data = compact_document(data)
+        if msgpack is not None:
+            body, content_type = msgpack.packb(data, use_bin_type=True), MSGPACK_CONTENT_TYPE
+        else:
+            body, content_type = json.dumps(data, separators=(',', ':')).encode('utf-8'), JSON_CONTENT_TYPE
+    if compress:
+        return gzip.compress(body, compresslevel=6), content_type, GZIP_CONTENT_ENCODING
+    return body, content_type, None
+
+
+def decode_payload(body: bytes, content_type: str = None, content_encoding: str = None):
+    """
+    Parse a stored payload, transparently handling gzip, plain JSON, columnar JSON and msgpack.
+    """
+    if content_encoding == GZIP_CONTENT_ENCODING:
+        body = gzip.decompress(body)
+    if content_type == MSGPACK_CONTENT_TYPE:
+        if msgpack is None:
+            raise ValueError("msgpack payload received but msgpack is not installed")
+        data = msgpack.unpackb(body, raw=False)
+    else:
+        data = json.loads(body.decode('utf-8'))
+    return expand_document(data)
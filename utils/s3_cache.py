@@ -0,0 +1,110 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Chunk result files are written once per chunk and only rewritten while a chunk is still failing
+FINALIZED_CHUNK_PATTERN = re.compile(r".*_chunk\d+\.json$")
+# Compacted transcripts are versioned by chunk count and never rewritten
+COMPACTED_TRANSCRIPT_PATTERN = re.compile(r".*/compacted/transcript_\d+\.json$")
+
+
+class CachedObject:
+    __slots__ = ("body", "etag", "content_type", "content_encoding", "immutable")
+
+    def __init__(self, body: bytes, etag: Optional[str], content_type: Optional[str] = None,
+                 content_encoding: Optional[str] = None, immutable: bool = False):
+        self.body = body
+        self.etag = etag
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.immutable = immutable
+
+
+class S3ObjectCache:
+    """
+    Bounded in-process LRU of raw S3 object bodies keyed by bucket + key.
+
+    Bodies are kept as bytes and parsed by the caller on every hit, so callers that mutate
+    the returned JSON never corrupt the cache. Entries are evicted once the total cached
+    body size exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, bucket: str, key: str) -> Optional[CachedObject]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get((bucket, key))
+            if entry is not None:
+                self._entries.move_to_end((bucket, key))
+            return entry
+
+    def put(self, bucket: str, key: str, body: bytes, etag: Optional[str], content_type: Optional[str] = None,
+            content_encoding: Optional[str] = None, immutable: bool = False):
+        if not self.enabled or len(body) > self.max_bytes:
+            self.invalidate(bucket, key)
+            return
+        with self._lock:
+            previous = self._entries.pop((bucket, key), None)
+            if previous is not None:
+                self._size -= len(previous.body)
+            self._entries[(bucket, key)] = CachedObject(body, etag, content_type, content_encoding, immutable)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.body)
+                self.evictions += 1
+
+    def invalidate(self, bucket: str, key: str):
+        with self._lock:
+            entry = self._entries.pop((bucket, key), None)
+            if entry is not None:
+                self._size -= len(entry.body)
+
+    def record_hit(self, revalidated: bool = False):
+        with self._lock:
+            self.hits += 1
+            if revalidated:
+                self.revalidations += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+def is_immutable(key: str, json_data) -> bool:
+    if COMPACTED_TRANSCRIPT_PATTERN.match(key):
+        return True
+    return bool(
+        FINALIZED_CHUNK_PATTERN.match(key)
+        and isinstance(json_data, dict)
+        and json_data.get("success")
+    )
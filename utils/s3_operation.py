@@ -1,102 +1,392 @@
-import json
+import atexit
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional
 import fnmatch
-import boto3
 from botocore.exceptions import NoCredentialsError
 from utils import heconstants
+from utils.locks import LockStripes
+from utils.s3_cache import S3ObjectCache, is_immutable
+from utils.payload_codec import decode_payload, encode_payload
+from utils.metrics import registry, start_periodic_log
+from utils.storage import InstrumentedBackend, NotModified, ObjectNotFound, StorageBackend, flush_storage_backend, \
+    get_storage_backend
+from utils.stream_io import read_into_buffer
+from utils.write_behind import WriteBehindBuffer
 
-# Setup S3 client
-s3_client = boto3.client('s3', aws_access_key_id=heconstants.AWS_ACCESS_KEY,
-                         aws_secret_access_key=heconstants.AWS_SECRET_ACCESS_KEY)
+# Read-through cache shared by every S3SERVICE instance in the process
+object_cache = S3ObjectCache(max_bytes=heconstants.s3_cache_max_bytes)
+registry.register_collector("s3_cache", object_cache.stats)
+
+# Coalesces rapid rewrites of hot documents; anything still pending is written at exit
+write_buffer = WriteBehindBuffer(window_seconds=heconstants.write_behind_window)
+registry.register_collector("write_behind", write_buffer.stats)
+
+
+def flush_all_writes():
+    """Write out deferred documents, then wait for a tiered backend to persist everything."""
+    write_buffer.flush()
+    flush_storage_backend()
+
+
+atexit.register(flush_all_writes)
+
+# Serialises compaction and reopening of a conversation within this process
+_manifest_locks = LockStripes()
+
+
+def chunk_no_from_key(conversation_id, key) -> Optional[int]:
+    """chunk_no of a chunk result key ({conversation_id}/{conversation_id}_chunk<n>.json), else None."""
+    prefix = f"{conversation_id}/{conversation_id}_chunk"
+    if not key.startswith(prefix) or not key.endswith(".json"):
+        return None
+    chunk_no = key[len(prefix):-len(".json")]
+    return int(chunk_no) if chunk_no.isdigit() else None
+
+
+def manifest_key(conversation_id):
+    # Only written once a conversation is compacted: a pointer to its compacted transcript
+    return f"{conversation_id}/chunk_manifest.json"
+
+
+def compacted_transcript_key(conversation_id, chunk_count):
+    # Versioned by chunk count so a compacted object is never overwritten in place
+    return f"{conversation_id}/compacted/transcript_{chunk_count}.json"
+
+
+def compacted_audio_key(conversation_id, chunk_count):
+    return f"{conversation_id}/compacted/audio_{chunk_count}.wav"
 
 
 class S3SERVICE:
-    def __init__(self):
+    def __init__(self, backend: Optional[StorageBackend] = None, stage: Optional[str] = None):
         self.default_bucket = heconstants.ASR_BUCKET
+        self.stage = stage or heconstants.service_stage
+        # S3 by default; STORAGE_BACKEND=local|memory runs the pipeline without AWS.
+        # Every call is counted per operation, bucket, stage and conversation.
+        self.backend = InstrumentedBackend(backend or get_storage_backend(), self.stage)
+        start_periodic_log(heconstants.metrics_log_interval)
 
-    def upload_to_s3(self, s3_filename, data, bucket_name: Optional[str] = None, is_json: Optional[bool] = False):
+    def upload_to_s3(self, s3_filename, data, bucket_name: Optional[str] = None, is_json: Optional[bool] = False,
+                     compact: Optional[bool] = False, compress: Optional[bool] = None):
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
+            if compress is None:
+                compress = heconstants.gzip_json
+            content_type, content_encoding = None, None
             if is_json:
-                data = json.dumps(data).encode('utf-8')
-            s3_client.put_object(Bucket=bucket_name, Key=s3_filename, Body=data)
+                json_data = data
+                data, content_type, content_encoding = encode_payload(json_data, compact=compact, compress=compress)
+            etag = self.backend.put_object(bucket_name, s3_filename, data, content_type=content_type,
+                                           content_encoding=content_encoding)
+            if is_json:
+                # Keep our own write in the cache so the next read only needs a 304 revalidation
+                object_cache.put(bucket_name, s3_filename, data, etag,
+                                 content_type=content_type,
+                                 content_encoding=content_encoding,
+                                 immutable=is_immutable(s3_filename, json_data))
+            else:
+                object_cache.invalidate(bucket_name, s3_filename)
             print(f"Upload Successful: {s3_filename}")
         except FileNotFoundError:
             print("The file was not found")
         except NoCredentialsError:
             print("Credentials not available")
 
-    def get_json_file(self, s3_filename, bucket_name: Optional[str] = None):
+    def upload_to_s3_deferred(self, s3_filename, data, bucket_name: Optional[str] = None,
+                              is_json: Optional[bool] = False, compact: Optional[bool] = False,
+                              compress: Optional[bool] = None):
+        """
+        Like upload_to_s3 for documents that are rewritten far more often than they are read:
+        rewrites of the same key within WRITE_BEHIND_WINDOW seconds are coalesced into one PUT.
+        Only reads in this process see the pending document; other processes see the previous
+        version for up to the window, so keys polled elsewhere (transcript.json, read by the
+        websocket server for live captions) are written with upload_to_s3. Call flush_deferred
+        when the stream ends.
+        """
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        if not write_buffer.put(bucket_name, s3_filename, data, self.upload_to_s3,
+                                is_json=is_json, compact=compact, compress=compress):
+            self.upload_to_s3(s3_filename, data, bucket_name=bucket_name, is_json=is_json,
+                              compact=compact, compress=compress)
+
+    def flush_deferred(self, s3_filename: Optional[str] = None, bucket_name: Optional[str] = None):
+        write_buffer.flush(key=s3_filename, bucket=bucket_name)
+
+    def get_json_file(self, s3_filename, bucket_name: Optional[str] = None, known_etag: Optional[str] = None):
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=s3_filename)
-            file_content = s3_object['Body'].read().decode('utf-8')
-            json_data = json.loads(file_content)
+            pending = write_buffer.get(bucket_name, s3_filename)
+            if pending is not None:
+                return pending
+            cached = object_cache.get(bucket_name, s3_filename)
+            # known_etag comes from a listing taken by the caller, so a match needs no request at all
+            if cached is not None and (cached.immutable or (known_etag and cached.etag == known_etag)):
+                object_cache.record_hit()
+                return decode_payload(cached.body, cached.content_type, cached.content_encoding)
+
+            try:
+                stored = self.backend.get_object(bucket_name, s3_filename,
+                                                 if_none_match=cached.etag if cached is not None else None)
+            except NotModified:
+                object_cache.record_hit(revalidated=True)
+                return decode_payload(cached.body, cached.content_type, cached.content_encoding)
+
+            object_cache.record_miss()
+            body = stored.body.read()
+            json_data = decode_payload(body, stored.content_type, stored.content_encoding)
+            # A body that does not match the listed ETag was caught mid-write; cache only settled ones
+            if not known_etag or stored.etag == known_etag:
+                object_cache.put(bucket_name, s3_filename, body, stored.etag,
+                                 content_type=stored.content_type,
+                                 content_encoding=stored.content_encoding,
+                                 immutable=is_immutable(s3_filename, json_data))
             return json_data
         except FileNotFoundError:
             print("The file was not found")
         except NoCredentialsError:
             print("Credentials not available")
 
+    def cache_stats(self):
+        return object_cache.stats()
+
+    def get_json_file_if_exists(self, s3_filename, bucket_name: Optional[str] = None):
+        try:
+            return self.get_json_file(s3_filename, bucket_name=bucket_name)
+        except ObjectNotFound:
+            return None
+
     def get_audio_file(self, s3_filename, bucket_name: Optional[str] = None):
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=s3_filename)
-            return s3_object
+            stored = self.backend.get_object(bucket_name, s3_filename)
+            return {"Body": stored.body, "ContentLength": stored.content_length, "ETag": stored.etag}
         except FileNotFoundError:
             print("The file was not found")
         except NoCredentialsError:
             print("Credentials not available")
 
+    def get_audio_buffer(self, s3_filename, bucket_name: Optional[str] = None, allocate=None):
+        """
+        Download an object into a preallocated buffer sized from its ContentLength and
+        return it as a memoryview. allocate(size) can supply the buffer (see SharedAudio).
+        """
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        stored = self.backend.get_object(bucket_name, s3_filename)
+        return read_into_buffer(stored.body, stored.content_length, allocate=allocate)
+
     def check_file_exists(self, key, bucket_name: Optional[str] = None):
-        try:
-            if bucket_name is None:
-                bucket_name = self.default_bucket
-            s3_client.head_object(Bucket=bucket_name, Key=key)
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        if write_buffer.has_pending(bucket_name, key):
             return True
-        except s3_client.exceptions.ClientError:
-            return False
+        return self.backend.object_exists(bucket_name, key)
+
+    def get_json_files_map(self, keys, bucket_name: Optional[str] = None, max_workers: Optional[int] = None,
+                           etags: Optional[dict] = None):
+        """
+        Fetch many JSON objects concurrently.
+
+        Returns ({key: json_data}, {key: error}); a failing key is reported in the second
+        dict and does not abort the rest of the batch; keys that do not exist are simply
+        left out. etags (key -> ETag from a listing) lets cached objects be served without
+        a request.
+        """
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        if max_workers is None:
+            max_workers = heconstants.s3_max_workers
+        keys = list(keys)
+        results, failures = {}, {}
+        if not keys:
+            return results, failures
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(keys)))) as pool:
+            futures = {pool.submit(self.get_json_file, key, bucket_name, (etags or {}).get(key)): key
+                       for key in keys}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    results[key] = future.result()
+                except ObjectNotFound:
+                    continue
+                except Exception as exc:
+                    print(f"An error occurred with file {key}: {exc}")
+                    failures[key] = str(exc)
+        return results, failures
+
+    def get_json_files(self, keys, bucket_name: Optional[str] = None, max_workers: Optional[int] = None):
+        """
+        Fetch many JSON objects concurrently and return (json_data_list, failures).
+
+        The list is ordered by chunk_no; documents without one keep their input order after the chunks.
+        """
+        keys = list(keys)
+        results, failures = self.get_json_files_map(keys, bucket_name=bucket_name, max_workers=max_workers)
+
+        def order(item):
+            index, data = item
+            chunk_no = data.get("chunk_no") if isinstance(data, dict) else None
+            return (chunk_no is None, chunk_no or 0, index)
+
+        ordered = sorted(
+            [(index, results[key]) for index, key in enumerate(keys) if results.get(key) is not None],
+            key=order,
+        )
+        return [data for _, data in ordered], failures
+
+    def list_keys_matching_pattern(self, pattern, bucket_name: Optional[str] = None):
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        # Extract the prefix from the pattern (up to the first wildcard)
+        prefix = pattern.split('*')[0]
+
+        return [key for key, _ in self.backend.iter_objects(bucket_name, prefix) if fnmatch.fnmatch(key, pattern)]
 
     def get_files_matching_pattern(self, pattern, bucket_name: Optional[str] = None):
-        json_data_list = []
         try:
-            if bucket_name is None:
-                bucket_name = self.default_bucket
-            # Extract the prefix from the pattern (up to the first wildcard)
-            prefix = pattern.split('*')[0]
-
-            # Paginate through results if there are more files than the max returned in one call
-            paginator = s3_client.get_paginator('list_objects_v2')
-            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-                if 'Contents' in page:
-                    # Filter the objects whose keys match the pattern and read each JSON file
-                    for obj in page['Contents']:
-                        if fnmatch.fnmatch(obj['Key'], pattern):
-                            try:
-                                response = s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
-                                file_content = response['Body'].read().decode('utf-8')
-                                json_data = json.loads(file_content)
-                                json_data_list.append(json_data)
-                            except NoCredentialsError:
-                                print("Credentials not available for file:", obj['Key'])
-                            except s3_client.exceptions.ClientError as e:
-                                print(f"An error occurred with file {obj['Key']}: {e}")
-            json_data_list.sort(key=lambda x: x['chunk_no'])
+            keys = self.list_keys_matching_pattern(pattern, bucket_name=bucket_name)
+            json_data_list, _ = self.get_json_files(keys, bucket_name=bucket_name)
             return json_data_list
-        except Exception as exc:
-            print(f"Error get_files_matching_pattern file: {exc}")
-            return []
         except NoCredentialsError:
             print("Credentials not available")
             return []
-        except s3_client.exceptions.ClientError as e:
-            print(f"An error occurred: {e}")
+        except Exception as exc:
+            print(f"Error get_files_matching_pattern file: {exc}")
             return []
 
+    def get_conversation_snapshot(self, conversation_id, bucket_name: Optional[str] = None):
+        """
+        List {conversation_id}/ once and return {key: etag} for every object in it.
+
+        Lets readers decide which artifacts exist without a HEAD per artifact.
+        """
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        return dict(self.backend.iter_objects(bucket_name, f"{conversation_id}/"))
+
+    def append_to_manifest(self, conversation_id, chunk_data, bucket_name: Optional[str] = None):
+        """
+        Record a chunk result whose chunk object has just been written.
+
+        The chunk objects are the segment log of a conversation, so nothing is rewritten per
+        chunk. Only a chunk rewritten after compaction (a late retry) needs work: the
+        conversation is reopened, so readers go back to the chunk objects instead of the
+        compacted transcript.
+        """
+        chunk_no = chunk_data.get("chunk_no")
+        if chunk_no is None:
+            return
+        key = manifest_key(conversation_id)
+        with _manifest_locks[key]:
+            try:
+                manifest = self.get_json_file_if_exists(key, bucket_name=bucket_name)
+                compacted = (manifest or {}).get("compacted")
+                if not compacted:
+                    return
+                transcript = self.get_json_file(compacted["transcript"], bucket_name=bucket_name)
+                if str(chunk_no) in (transcript or {}).get("chunks", {}):
+                    self.upload_to_s3(key, {"conversation_id": conversation_id, "compacted": None},
+                                      bucket_name=bucket_name, is_json=True)
+            except Exception as exc:
+                print(f"Error append_to_manifest {key}: {exc}")
+
+    def _update_manifest_totals(self, manifest):
+        manifest["chunk_count"] = len(manifest["chunks"])
+        manifest["total_duration"] = sum(
+            [v.get("duration") or 0 for v in manifest["chunks"].values()]
+        )
+
+    def write_compacted_transcript(self, conversation_id, chunk_count, audio_key: Optional[str] = None,
+                                   bucket_name: Optional[str] = None):
+        """
+        Store every chunk result as an immutable compacted transcript and write the manifest
+        as a small pointer to it, so later readers serve the chunks from one cached object.
+
+        chunk_count is the number of chunks the caller compacted the audio for; if the
+        conversation has moved on since, nothing is written and None is returned.
+        """
+        key = manifest_key(conversation_id)
+        with _manifest_locks[key]:
+            chunk_datas, compacted = self.load_conversation(conversation_id, bucket_name=bucket_name)
+            if compacted:
+                return compacted
+            if len(chunk_datas) != chunk_count:
+                return None
+            manifest = {
+                "conversation_id": conversation_id,
+                "chunks": {str(v["chunk_no"]): v for v in chunk_datas},
+            }
+            self._update_manifest_totals(manifest)
+            transcript_key = compacted_transcript_key(conversation_id, chunk_count)
+            compacted = {"transcript": transcript_key, "audio": audio_key}
+            self.upload_to_s3(transcript_key, manifest, bucket_name=bucket_name, is_json=True,
+                              compact=heconstants.compact_segments)
+            pointer = {
+                "conversation_id": conversation_id,
+                "chunk_count": manifest["chunk_count"],
+                "total_duration": manifest["total_duration"],
+                "compacted": compacted,
+            }
+            self.upload_to_s3(key, pointer, bucket_name=bucket_name, is_json=True)
+        return compacted
+
+    def get_conversation_chunks(self, conversation_id, bucket_name: Optional[str] = None,
+                                snapshot: Optional[dict] = None):
+        """
+        Return the chunk results of a conversation ordered by chunk_no.
+
+        See load_conversation; pass a snapshot from get_conversation_snapshot to reuse a
+        listing the caller already has.
+        """
+        chunk_datas, _ = self.load_conversation(conversation_id, bucket_name=bucket_name, snapshot=snapshot)
+        return chunk_datas
+
+    def load_conversation(self, conversation_id, bucket_name: Optional[str] = None,
+                          snapshot: Optional[dict] = None):
+        """
+        Return (chunk_datas, compacted) where compacted is None for a live conversation and
+        {"transcript": key, "audio": key} once it has been compacted.
+
+        Chunk objects are found with one listing of the conversation (or the snapshot passed
+        in), and those already cached with the listed ETag cost no request, so a reader only
+        fetches the chunks written since its last read. Once compacted, the chunks in the
+        compacted transcript are served from it and only later chunks are read on their own.
+        """
+        try:
+            if bucket_name is None:
+                bucket_name = self.default_bucket
+            if snapshot is None:
+                snapshot = self.get_conversation_snapshot(conversation_id, bucket_name=bucket_name)
+            chunks, compacted = {}, None
+            key = manifest_key(conversation_id)
+            if key in snapshot:
+                manifest = self.get_json_file(key, bucket_name=bucket_name, known_etag=snapshot[key])
+                compacted = (manifest or {}).get("compacted")
+                if compacted:
+                    transcript = self.get_json_file(compacted["transcript"], bucket_name=bucket_name)
+                    chunks = dict(transcript.get("chunks", {}))
+            chunk_etags = {}
+            for chunk_key, etag in snapshot.items():
+                chunk_no = chunk_no_from_key(conversation_id, chunk_key)
+                if chunk_no is not None and str(chunk_no) not in chunks:
+                    chunk_etags[chunk_key] = etag
+            chunk_files, _ = self.get_json_files_map(chunk_etags, bucket_name=bucket_name, etags=chunk_etags)
+            for chunk_data in chunk_files.values():
+                if isinstance(chunk_data, dict) and chunk_data.get("chunk_no") is not None:
+                    chunks[str(chunk_data["chunk_no"])] = chunk_data
+            chunk_datas = list(chunks.values())
+            chunk_datas.sort(key=lambda x: x['chunk_no'])
+            return chunk_datas, compacted
+        except Exception as exc:
+            print(f"Error load_conversation: {exc}")
+            return [], None
+
     def sort_dirs_by_time(self, dirs_list):
         # Function to extract the timestamp from each directory name
         def extract_timestamp(dir_name):
@@ -109,6 +399,29 @@ class S3SERVICE:
         sorted_dirs = sorted(dirs_list, key=extract_timestamp, reverse=True)
         return sorted_dirs
 
+    def list_common_prefixes(self, prefix, delimiter: str = '/', bucket_name: Optional[str] = None):
+        """
+        Return the "directory" names directly under prefix using a Delimiter listing,
+        which returns one entry per directory instead of one per object.
+        """
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        return [common_prefix.rstrip(delimiter)
+                for common_prefix in self.backend.list_common_prefixes(bucket_name, prefix, delimiter)]
+
+    def list_keys_page(self, prefix, page_size: int, start_after: Optional[str] = None,
+                       bucket_name: Optional[str] = None):
+        """
+        Return (keys, next_start_after) for a single page of a prefix listing.
+        """
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        objects, is_truncated = self.backend.list_objects_page(bucket_name, prefix, page_size,
+                                                               start_after=start_after)
+        keys = [key for key, _ in objects]
+        next_start_after = keys[-1] if keys and is_truncated else None
+        return keys, next_start_after
+
     def get_dirs_matching_pattern(self, pattern, bucket_name: Optional[str] = None):
         dirs_matching_pattern = set()
         try:
@@ -117,36 +430,35 @@ class S3SERVICE:
             # Extract the prefix from the pattern (up to the first wildcard)
             prefix = pattern.split('*')[0]
 
-            # Paginate through results if there are more objects than the max returned in one call
-            paginator = s3_client.get_paginator('list_objects_v2')
-            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-                if 'Contents' in page:
-                    # Filter the objects whose keys match the pattern and check if they represent directories
-                    for obj in page['Contents']:
-                        if fnmatch.fnmatch(obj['Key'], pattern):
-                            dirname = os.path.dirname(obj['Key'])
-                            dirs_matching_pattern.add(dirname)
+            if '/' not in pattern:
+                # Top-level pattern: list directory names only rather than every object below them
+                dirs_list = [d for d in self.list_common_prefixes(prefix, bucket_name=bucket_name)
+                             if fnmatch.fnmatch(d, pattern)]
+                return self.sort_dirs_by_time(dirs_list)
+
+            # Filter the objects whose keys match the pattern and check if they represent directories
+            for key, _ in self.backend.iter_objects(bucket_name, prefix):
+                if fnmatch.fnmatch(key, pattern):
+                    dirname = os.path.dirname(key)
+                    dirs_matching_pattern.add(dirname)
 
             # Convert the set of directory names to a list
             dirs_list = list(dirs_matching_pattern)
             sorted_dirs = self.sort_dirs_by_time(dirs_list)
             return sorted_dirs
-        except Exception as exc:
-            print(f"Error get_dirs_matching_pattern: {exc}")
-            return []
         except NoCredentialsError:
             print("Credentials not available")
             return []
-        except s3_client.exceptions.ClientError as e:
-            print(f"An error occurred: {e}")
+        except Exception as exc:
+            print(f"Error get_dirs_matching_pattern: {exc}")
             return []
 
     def list_files_in_directory(self, directory, bucket_name: Optional[str] = None):
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
-            response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=directory)
-            return [item['Key'] for item in response.get('Contents', [])]
+            objects, _ = self.backend.list_objects_page(bucket_name, directory, 1000)
+            return [key for key, _ in objects]
         except Exception as e:
             print(f"Error listing files: {e}")
 
@@ -154,7 +466,7 @@ class S3SERVICE:
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
-            s3_client.download_file(bucket_name, key, local_path)
+            self.backend.download_file(bucket_name, key, local_path)
             print(f"Download Successful: {local_path}")
         except Exception as e:
             print(f"Error downloading file: {e}")
@@ -0,0 +1,631 @@
+import abc
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config.logconfig import get_logger
+from utils import heconstants
+from utils.metrics import registry
+from utils.stream_io import BufferReader
+
+logger = get_logger()
+
+TEMP_PREFIX = ".tmp-"
+META_DIR = ".meta"
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class NotModified(Exception):
+    pass
+
+
+class StoredObject:
+    """
+    Result of StorageBackend.get_object. body is a file-like object exposing read() and,
+    where the backend can, readinto() on body or body._raw_stream.
+    """
+
+    def __init__(self, body, content_length: int, etag: Optional[str] = None, content_type: Optional[str] = None,
+                 content_encoding: Optional[str] = None):
+        self.body = body
+        self.content_length = content_length
+        self.etag = etag
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+
+
+def _etag(body: bytes) -> str:
+    return '"%s"' % hashlib.md5(body).hexdigest()
+
+
+class StorageBackend(abc.ABC):
+    """
+    Object storage operations used by S3SERVICE. Keys are '/'-separated, as in S3.
+    """
+
+    @abc.abstractmethod
+    def put_object(self, bucket: str, key: str, body: bytes, content_type: Optional[str] = None,
+                   content_encoding: Optional[str] = None) -> str:
+        """Store body and return its ETag."""
+
+    @abc.abstractmethod
+    def get_object(self, bucket: str, key: str, if_none_match: Optional[str] = None) -> StoredObject:
+        """Raise ObjectNotFound if the key is missing, NotModified if if_none_match is still current."""
+
+    @abc.abstractmethod
+    def object_exists(self, bucket: str, key: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def iter_objects(self, bucket: str, prefix: str):
+        """Yield (key, etag) for every object under prefix in key order."""
+
+    @abc.abstractmethod
+    def list_objects_page(self, bucket: str, prefix: str, max_keys: int, start_after: Optional[str] = None):
+        """Return ([(key, etag), ...], is_truncated) for one page of keys after start_after."""
+
+    @abc.abstractmethod
+    def list_common_prefixes(self, bucket: str, prefix: str, delimiter: str = '/'):
+        """Return the distinct prefixes (each ending in delimiter) directly under prefix."""
+
+    def download_file(self, bucket: str, key: str, local_path: str):
+        stored = self.get_object(bucket, key)
+        with open(local_path, "wb") as file:
+            shutil.copyfileobj(stored.body, file)
+
+
+class S3Backend(StorageBackend):
+    def __init__(self):
+        import boto3
+        from botocore.config import Config
+
+        # Sized so bulk reads can keep every worker on its own connection
+        self.client = boto3.client('s3', aws_access_key_id=heconstants.AWS_ACCESS_KEY,
+                                   aws_secret_access_key=heconstants.AWS_SECRET_ACCESS_KEY,
+                                   config=Config(max_pool_connections=max(heconstants.s3_max_workers, 10)))
+
+    def put_object(self, bucket, key, body, content_type=None, content_encoding=None):
+        request = {"Bucket": bucket, "Key": key, "Body": body}
+        if content_type:
+            request["ContentType"] = content_type
+        if content_encoding:
+            request["ContentEncoding"] = content_encoding
+        return self.client.put_object(**request).get('ETag')
+
+    def get_object(self, bucket, key, if_none_match=None):
+        request = {"Bucket": bucket, "Key": key}
+        if if_none_match:
+            request["IfNoneMatch"] = if_none_match
+        try:
+            s3_object = self.client.get_object(**request)
+        except self.client.exceptions.NoSuchKey:
+            raise ObjectNotFound(key)
+        except self.client.exceptions.ClientError as e:
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if status == 304:
+                raise NotModified(key)
+            if status == 404:
+                raise ObjectNotFound(key)
+            raise
+        return StoredObject(s3_object['Body'], s3_object['ContentLength'], s3_object.get('ETag'),
+                            s3_object.get('ContentType'), s3_object.get('ContentEncoding'))
+
+    def object_exists(self, bucket, key):
+        try:
+            self.client.head_object(Bucket=bucket, Key=key)
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+    def iter_objects(self, bucket, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'], obj.get('ETag')
+
+    def list_objects_page(self, bucket, prefix, max_keys, start_after=None):
+        request = {"Bucket": bucket, "Prefix": prefix, "MaxKeys": max_keys}
+        if start_after:
+            request["StartAfter"] = start_after
+        response = self.client.list_objects_v2(**request)
+        objects = [(item['Key'], item.get('ETag')) for item in response.get('Contents', [])]
+        return objects, bool(response.get('IsTruncated'))
+
+    def list_common_prefixes(self, bucket, prefix, delimiter='/'):
+        prefixes = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter=delimiter):
+            for common_prefix in page.get('CommonPrefixes', []):
+                prefixes.append(common_prefix['Prefix'])
+        return prefixes
+
+    def download_file(self, bucket, key, local_path):
+        self.client.download_file(bucket, key, local_path)
+
+
+class _SortedKeysMixin:
+    def list_objects_page(self, bucket, prefix, max_keys, start_after=None):
+        objects = [(key, etag) for key, etag in self.iter_objects(bucket, prefix)
+                   if start_after is None or key > start_after]
+        return objects[:max_keys], len(objects) > max_keys
+
+    def list_common_prefixes(self, bucket, prefix, delimiter='/'):
+        prefixes = []
+        for key, _ in self.iter_objects(bucket, prefix):
+            rest = key[len(prefix):]
+            if delimiter in rest:
+                common_prefix = prefix + rest.split(delimiter, 1)[0] + delimiter
+                if not prefixes or prefixes[-1] != common_prefix:
+                    prefixes.append(common_prefix)
+        return prefixes
+
+
+class LocalFilesystemBackend(_SortedKeysMixin, StorageBackend):
+    """
+    Stores objects as files under root/<bucket>/<key>.
+
+    Writes go to a temp file in the target directory and are renamed into place, so readers
+    never see a partial object. Reads are memory-mapped. Content type, encoding and ETag are
+    kept in a sidecar under root/.meta/, written after the body together with the body file's
+    inode, size and mtime. The ETag is recomputed from the body when those no longer match,
+    so a read racing a write never pairs one version's body with another's ETag.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def _path(self, *parts):
+        path = os.path.abspath(os.path.join(self.root, *parts))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Key escapes storage root: {parts}")
+        return path
+
+    def _atomic_write(self, path, body: bytes):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(body)
+                file.flush()
+                stat = os.fstat(file.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return stat
+
+    @staticmethod
+    def _file_id(stat):
+        return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+    def put_object(self, bucket, key, body, content_type=None, content_encoding=None):
+        body = bytes(body)
+        etag = _etag(body)
+        stat = self._atomic_write(self._path(bucket, key), body)
+        meta = {"etag": etag, "content_type": content_type, "content_encoding": content_encoding,
+                "file": self._file_id(stat)}
+        self._atomic_write(self._path(META_DIR, bucket, key + ".json"), json.dumps(meta).encode('utf-8'))
+        return etag
+
+    def _meta(self, bucket, key):
+        try:
+            with open(self._path(META_DIR, bucket, key + ".json"), "rb") as file:
+                return json.loads(file.read().decode('utf-8'))
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _meta_etag(self, meta, stat):
+        """The sidecar's ETag if it describes the body file with this stat, else None."""
+        if "file" in meta and meta["file"] != self._file_id(stat):
+            return None
+        return meta.get("etag")
+
+    def get_object(self, bucket, key, if_none_match=None):
+        path = self._path(bucket, key)
+        meta = self._meta(bucket, key)
+        try:
+            with open(path, "rb") as file:
+                stat = os.fstat(file.fileno())
+                size = stat.st_size
+                view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)) if size else memoryview(b"")
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+        etag = self._meta_etag(meta, stat) or _etag(view)
+        if if_none_match and if_none_match == etag:
+            raise NotModified(key)
+        return StoredObject(BufferReader(view, name=os.path.basename(key)), size, etag,
+                            meta.get("content_type"), meta.get("content_encoding"))
+
+    def object_exists(self, bucket, key):
+        return os.path.isfile(self._path(bucket, key))
+
+    def iter_objects(self, bucket, prefix):
+        bucket_root = self._path(bucket)
+        # Only the directory holding the prefix can contain matching keys
+        prefix_directory = os.path.dirname(prefix)
+        walk_root = self._path(bucket, *prefix_directory.split('/')) if prefix_directory else bucket_root
+        keys = []
+        for directory, _, files in os.walk(walk_root):
+            for name in files:
+                if name.startswith(TEMP_PREFIX):
+                    continue
+                key = os.path.relpath(os.path.join(directory, name), bucket_root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        for key in sorted(keys):
+            try:
+                stat = os.stat(self._path(bucket, key))
+            except FileNotFoundError:
+                continue
+            # None while a write is between its body and its sidecar; readers then revalidate
+            yield key, self._meta_etag(self._meta(bucket, key), stat)
+
+    def download_file(self, bucket, key, local_path):
+        try:
+            shutil.copyfile(self._path(bucket, key), local_path)
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+
+
+class InMemoryBackend(_SortedKeysMixin, StorageBackend):
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def put_object(self, bucket, key, body, content_type=None, content_encoding=None):
+        body = bytes(body)
+        etag = _etag(body)
+        with self._lock:
+            self._objects[(bucket, key)] = (body, etag, content_type, content_encoding)
+        return etag
+
+    def get_object(self, bucket, key, if_none_match=None):
+        with self._lock:
+            stored = self._objects.get((bucket, key))
+        if stored is None:
+            raise ObjectNotFound(key)
+        body, etag, content_type, content_encoding = stored
+        if if_none_match and if_none_match == etag:
+            raise NotModified(key)
+        return StoredObject(BufferReader(memoryview(body), name=key.split('/')[-1]), len(body), etag,
+                            content_type, content_encoding)
+
+    def object_exists(self, bucket, key):
+        with self._lock:
+            return (bucket, key) in self._objects
+
+    def iter_objects(self, bucket, prefix):
+        with self._lock:
+            objects = sorted((key, stored[1]) for (b, key), stored in self._objects.items()
+                             if b == bucket and key.startswith(prefix))
+        for key, etag in objects:
+            yield key, etag
+
+
+class _TieredObject:
+    __slots__ = ("body", "etag", "content_type", "content_encoding", "version", "persisted")
+
+    def __init__(self, body, etag, content_type, content_encoding, version):
+        self.body = body
+        self.etag = etag
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.version = version
+        self.persisted = False
+
+
+class TieredBackend(_SortedKeysMixin, StorageBackend):
+    """
+    Memory tier in front of a durable backend, for running every stage in one process.
+
+    Writes land in memory and return at once; persist_workers background threads copy them
+    to the durable backend, one upload per key at a time, and a key rewritten before it was
+    persisted is uploaded once with its latest body. Reads are served from memory and fall
+    through to the durable backend for objects this process has not written. Persisted
+    objects are evicted least recently used beyond max_bytes; unpersisted ones never are.
+
+    Listings come from an index of keys and ETags. The durable backend is listed once per
+    prefix, and after that the index is kept up to date by this process's own writes. This
+    assumes no other process writes under a prefix once it has been listed, which holds for
+    the conversation data that the pipeline owns. Index entries are grouped by first path
+    segment and dropped least recently used beyond max_index_keys. A dropped group is listed
+    from the durable backend again the next time it is needed.
+    """
+
+    def __init__(self, durable: StorageBackend, max_bytes: int, persist_workers: int = 2,
+                 max_index_keys: int = 100000):
+        self.durable = durable
+        self.max_bytes = max_bytes
+        self.max_index_keys = max_index_keys
+        # (bucket, first path segment) -> {key: etag}
+        self._index = OrderedDict()
+        self._index_keys = 0
+        self._index_drops = 0
+        # (bucket, prefix) listed from the durable backend and covered by the index since
+        self._listed = set()
+        self._objects = OrderedDict()
+        self._bytes = 0
+        self._versions = 0
+        self._queue = []
+        self._queued = set()
+        self._persisting = set()
+        self._condition = threading.Condition()
+        self.persisted = 0
+        self.persist_failures = 0
+        for n in range(persist_workers):
+            threading.Thread(target=self._persist_loop, name=f"tiered-persist-{n}", daemon=True).start()
+
+    def put_object(self, bucket, key, body, content_type=None, content_encoding=None):
+        body = bytes(body)
+        etag = _etag(body)
+        with self._condition:
+            self._versions += 1
+            previous = self._objects.pop((bucket, key), None)
+            if previous is not None:
+                self._bytes -= len(previous.body)
+            self._objects[(bucket, key)] = _TieredObject(body, etag, content_type, content_encoding, self._versions)
+            self._bytes += len(body)
+            if (bucket, key) not in self._queued:
+                self._queued.add((bucket, key))
+                self._queue.append((bucket, key))
+                self._condition.notify()
+            self._index_key(bucket, key, etag)
+            self._evict()
+            self._trim_index()
+        return etag
+
+    def _index_key(self, bucket, key, etag, overwrite=True):
+        group_key = (bucket, key.split('/', 1)[0])
+        group = self._index.setdefault(group_key, {})
+        self._index.move_to_end(group_key)
+        if key not in group:
+            self._index_keys += 1
+        elif not overwrite:
+            return
+        group[key] = etag
+
+    def _trim_index(self):
+        if self._index_keys <= self.max_index_keys:
+            return
+        for (bucket, top), group in list(self._index.items()):
+            # Keys still waiting to be persisted cannot be listed from the durable backend
+            if any(not self._objects[(bucket, key)].persisted for key in group if (bucket, key) in self._objects):
+                continue
+            del self._index[(bucket, top)]
+            self._index_keys -= len(group)
+            self._index_drops += 1
+            self._listed = {(b, prefix) for b, prefix in self._listed
+                            if b != bucket or ('/' in prefix and prefix.split('/', 1)[0] != top)}
+            if self._index_keys <= self.max_index_keys:
+                return
+
+    def _is_listed(self, bucket, prefix):
+        # Covered by a listing of the prefix itself or of one of its parent directories
+        if (bucket, prefix) in self._listed:
+            return True
+        parts = prefix.split('/')[:-1]
+        return any((bucket, '/'.join(parts[:n]) + '/') in self._listed for n in range(1, len(parts) + 1))
+
+    def _indexed(self, bucket, prefix):
+        if '/' in prefix:
+            groups = [self._index.get((bucket, prefix.split('/', 1)[0]), {})]
+        else:
+            groups = [group for (b, top), group in self._index.items() if b == bucket and top.startswith(prefix)]
+        return {key: etag for group in groups for key, etag in group.items() if key.startswith(prefix)}
+
+    def _evict(self):
+        if self._bytes <= self.max_bytes:
+            return
+        for bucket_key in [bucket_key for bucket_key, stored in self._objects.items() if stored.persisted]:
+            self._bytes -= len(self._objects.pop(bucket_key).body)
+            if self._bytes <= self.max_bytes:
+                return
+
+    def _next_key(self):
+        for index, bucket_key in enumerate(self._queue):
+            if bucket_key not in self._persisting:
+                return self._queue.pop(index)
+        return None
+
+    def _persist_loop(self):
+        while True:
+            with self._condition:
+                bucket_key = self._next_key()
+                while bucket_key is None:
+                    self._condition.wait()
+                    bucket_key = self._next_key()
+                self._queued.discard(bucket_key)
+                self._persisting.add(bucket_key)
+                stored = self._objects[bucket_key]
+            bucket, key = bucket_key
+            try:
+                self.durable.put_object(bucket, key, stored.body, content_type=stored.content_type,
+                                        content_encoding=stored.content_encoding)
+                registry.inc("tiered_persist_total", bucket=bucket, status="ok")
+                failed = False
+            except Exception as exc:
+                registry.inc("tiered_persist_total", bucket=bucket, status="error")
+                logger.error(f"Persisting {key} failed :: {exc}")
+                failed = True
+            with self._condition:
+                self._persisting.discard(bucket_key)
+                current = self._objects.get(bucket_key)
+                if failed:
+                    self.persist_failures += 1
+                    if bucket_key not in self._queued:
+                        # Retried after the keys queued since, so one bad key cannot stall the rest
+                        self._queued.add(bucket_key)
+                        self._queue.append(bucket_key)
+                else:
+                    self.persisted += 1
+                    if current is not None and current.version == stored.version:
+                        current.persisted = True
+                        self._evict()
+                self._condition.notify_all()
+            if failed:
+                time.sleep(1)
+
+    def get_object(self, bucket, key, if_none_match=None):
+        with self._condition:
+            stored = self._objects.get((bucket, key))
+            if stored is not None:
+                self._objects.move_to_end((bucket, key))
+        if stored is None:
+            return self.durable.get_object(bucket, key, if_none_match=if_none_match)
+        if if_none_match and if_none_match == stored.etag:
+            raise NotModified(key)
+        return StoredObject(BufferReader(memoryview(stored.body), name=key.split('/')[-1]), len(stored.body),
+                            stored.etag, stored.content_type, stored.content_encoding)
+
+    def object_exists(self, bucket, key):
+        with self._condition:
+            if (bucket, key) in self._objects:
+                return True
+        return self.durable.object_exists(bucket, key)
+
+    def iter_objects(self, bucket, prefix):
+        with self._condition:
+            listed = self._is_listed(bucket, prefix)
+            drops = self._index_drops
+        durable = []
+        if not listed:
+            durable = list(self.durable.iter_objects(bucket, prefix))
+            with self._condition:
+                # A key written here since the listing started already has its newer ETag
+                for key, etag in durable:
+                    self._index_key(bucket, key, etag, overwrite=False)
+                # Keys persisted and dropped from the index mid-listing may be missing from both
+                if self._index_drops == drops:
+                    self._listed.add((bucket, prefix))
+        with self._condition:
+            objects = dict(durable)
+            objects.update(self._indexed(bucket, prefix))
+            self._trim_index()
+        for key in sorted(objects):
+            yield key, objects[key]
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every write so far is persisted. Returns False on timeout."""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while self._queue or self._persisting:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._condition:
+            return {
+                "objects": len(self._objects),
+                "bytes": self._bytes,
+                "pending": len(self._queue) + len(self._persisting),
+                "indexed_keys": self._index_keys,
+                "persisted": self.persisted,
+                "persist_failures": self.persist_failures,
+            }
+
+
+class InstrumentedBackend(StorageBackend):
+    """
+    Wraps a backend and records every call in the metrics registry as storage_<op>_total
+    and storage_<op>_latency_ms, labelled by bucket, caller stage and status. Calls are also
+    attributed to the conversation named by the first segment of the key or prefix.
+    """
+
+    def __init__(self, backend: StorageBackend, stage: str):
+        self.backend = backend
+        self.stage = stage
+
+    def _call(self, operation, bucket, key, function, *args, **kwargs):
+        registry.count_conversation(key.split('/', 1)[0] if '/' in key else None, operation)
+        with registry.timer(f"storage_{operation}", bucket=bucket, stage=self.stage) as labels:
+            try:
+                return function(*args, **kwargs)
+            except NotModified:
+                labels["status"] = "not_modified"
+                raise
+            except ObjectNotFound:
+                labels["status"] = "not_found"
+                raise
+
+    def put_object(self, bucket, key, body, content_type=None, content_encoding=None):
+        return self._call("put_object", bucket, key, self.backend.put_object, bucket, key, body,
+                          content_type=content_type, content_encoding=content_encoding)
+
+    def get_object(self, bucket, key, if_none_match=None):
+        return self._call("get_object", bucket, key, self.backend.get_object, bucket, key,
+                          if_none_match=if_none_match)
+
+    def object_exists(self, bucket, key):
+        return self._call("object_exists", bucket, key, self.backend.object_exists, bucket, key)
+
+    def iter_objects(self, bucket, prefix):
+        # Materialise the listing so the timer covers every page request
+        return iter(self._call("iter_objects", bucket, prefix,
+                               lambda: list(self.backend.iter_objects(bucket, prefix))))
+
+    def list_objects_page(self, bucket, prefix, max_keys, start_after=None):
+        return self._call("list_objects_page", bucket, prefix, self.backend.list_objects_page, bucket, prefix,
+                          max_keys, start_after=start_after)
+
+    def list_common_prefixes(self, bucket, prefix, delimiter='/'):
+        return self._call("list_common_prefixes", bucket, prefix, self.backend.list_common_prefixes, bucket,
+                          prefix, delimiter)
+
+    def download_file(self, bucket, key, local_path):
+        return self._call("download_file", bucket, key, self.backend.download_file, bucket, key, local_path)
+
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+def create_storage_backend(name: Optional[str] = None) -> StorageBackend:
+    name = (name or heconstants.storage_backend).lower()
+    if name == "s3":
+        return S3Backend()
+    if name == "local":
+        return LocalFilesystemBackend(heconstants.local_storage_root)
+    if name == "memory":
+        return InMemoryBackend()
+    if name == "tiered":
+        backend = TieredBackend(create_storage_backend(heconstants.tiered_durable_backend),
+                                max_bytes=heconstants.tiered_memory_max_bytes,
+                                persist_workers=heconstants.tiered_persist_workers,
+                                max_index_keys=heconstants.tiered_index_max_keys)
+        registry.register_collector("tiered_storage", backend.stats)
+        return backend
+    raise ValueError(f"Unknown storage backend: {name}")
+
+
+def get_storage_backend() -> StorageBackend:
+    """
+    Process-wide backend selected by the STORAGE_BACKEND setting (s3, local, memory or tiered).
+    """
+    global _default_backend
+    if _default_backend is None:
+        with _default_backend_lock:
+            if _default_backend is None:
+                _default_backend = create_storage_backend()
+    return _default_backend
+
+
+def flush_storage_backend(timeout: Optional[float] = None):
+    """Wait for a tiered backend to persist its pending writes; other backends write through."""
+    if _default_backend is not None and hasattr(_default_backend, "flush"):
+        if not _default_backend.flush(timeout if timeout is not None else heconstants.tiered_flush_timeout):
+            logger.error("Timed out persisting the storage memory tier")
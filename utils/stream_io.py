@@ -0,0 +1,82 @@
+import io
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def read_into_buffer(stream, content_length: int, chunk_size: int = READ_CHUNK_SIZE, allocate=None) -> memoryview:
+    """
+    Read a body of known length straight into one preallocated bytearray.
+
+    Uses readinto on the underlying socket stream when available (botocore's StreamingBody
+    keeps it in _raw_stream), so the data is copied once instead of being accumulated
+    through many small read() calls and buffer growths. allocate(content_length) may return
+    a writable memoryview to read into instead, e.g. a shared memory block.
+    """
+    view = allocate(content_length) if allocate is not None else memoryview(bytearray(content_length))
+    raw = getattr(stream, "_raw_stream", stream)
+    readinto = getattr(raw, "readinto", None)
+    position = 0
+    while position < content_length:
+        if readinto is not None:
+            read = readinto(view[position:position + chunk_size])
+        else:
+            data = stream.read(min(chunk_size, content_length - position))
+            read = len(data)
+            view[position:position + read] = data
+        if not read:
+            break
+        position += read
+    if position < content_length:
+        raise IOError(f"Incomplete read: got {position} of {content_length} bytes")
+    return view
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over a memoryview, so downloaded audio can be handed to
+    pydub or requests without copying it into a BytesIO.
+    """
+
+    def __init__(self, view: memoryview, name: str = None):
+        super().__init__()
+        self._view = view
+        self._position = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._position + size)
+        data = self._view[self._position:end].tobytes()
+        self._position = max(self._position, end)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, target):
+        remaining = len(self._view) - self._position
+        size = min(len(target), remaining)
+        target[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = len(self._view) + offset
+        self._position = max(0, min(self._position, len(self._view)))
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def __len__(self):
+        return len(self._view)
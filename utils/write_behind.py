@@ -0,0 +1,113 @@
+import copy
+import threading
+import time
+
+from config.logconfig import get_logger
+from utils.locks import LockStripes
+
+logger = get_logger()
+
+
+class _PendingWrite:
+    __slots__ = ("upload", "data", "upload_args", "deferred_at", "writes")
+
+    def __init__(self, upload, data, upload_args):
+        self.upload = upload
+        self.data = data
+        self.upload_args = upload_args
+        self.deferred_at = time.time()
+        self.writes = 1
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces rapid rewrites of the same object.
+
+    The first deferred write of a key schedules one upload window_seconds later; every
+    rewrite inside that window only replaces the pending document, so a key is PUT at most
+    once per window however often it changes. Pending documents are served to readers in
+    this process and are written out by flush() at stream end and at interpreter exit.
+    """
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Keeps uploads of one key in order when a timer and an explicit flush race
+        self._key_locks = LockStripes()
+        self.deferred = 0
+        self.coalesced = 0
+        self.flushed = 0
+
+    @property
+    def enabled(self):
+        return self.window_seconds > 0
+
+    def put(self, bucket: str, key: str, data, upload, **upload_args):
+        """
+        Defer upload(key, data, bucket_name=bucket, **upload_args). Returns False when the
+        buffer is disabled and the caller should write through.
+        """
+        if not self.enabled:
+            return False
+        schedule = False
+        with self._lock:
+            self.deferred += 1
+            pending = self._pending.get((bucket, key))
+            if pending is None:
+                self._pending[(bucket, key)] = _PendingWrite(upload, data, upload_args)
+                schedule = True
+            else:
+                pending.data = data
+                pending.upload_args = upload_args
+                pending.writes += 1
+                self.coalesced += 1
+        if schedule:
+            timer = threading.Timer(self.window_seconds, self.flush_key, args=(bucket, key))
+            timer.daemon = True
+            timer.start()
+        return True
+
+    def get(self, bucket: str, key: str):
+        """Return a copy of the pending document for key, or None if nothing is pending."""
+        with self._lock:
+            pending = self._pending.get((bucket, key))
+            return copy.deepcopy(pending.data) if pending is not None else None
+
+    def has_pending(self, bucket: str, key: str) -> bool:
+        with self._lock:
+            return (bucket, key) in self._pending
+
+    def flush_key(self, bucket: str, key: str):
+        with self._key_locks[(bucket, key)]:
+            with self._lock:
+                pending = self._pending.pop((bucket, key), None)
+            if pending is None:
+                return
+            try:
+                pending.upload(key, pending.data, bucket_name=bucket, **pending.upload_args)
+                with self._lock:
+                    self.flushed += 1
+            except Exception as exc:
+                logger.error(f"Write-behind flush failed :: {key} :: {exc}")
+
+    def flush(self, key: str = None, bucket: str = None):
+        """
+        Write out pending documents now: one key when key is given, otherwise every key
+        (optionally limited to bucket).
+        """
+        with self._lock:
+            targets = [(b, k) for (b, k) in self._pending
+                       if (key is None or k == key) and (bucket is None or b == bucket)]
+        for target_bucket, target_key in targets:
+            self.flush_key(target_bucket, target_key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "deferred": self.deferred,
+                "coalesced": self.coalesced,
+                "flushed": self.flushed,
+                "window_seconds": self.window_seconds,
+            }